@@ -0,0 +1,161 @@
+"""Асинхронный доступ к базе данных.
+
+Функции модуля db синхронные и могут ждать блокировку SQLite до 30 секунд.
+Здесь они выполняются в отдельном пуле потоков, чтобы обработчики FastAPI и
+aiogram, работающие в одном цикле событий, не блокировали друг друга.
+"""
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import metrics
+from write_queue import WriteQueue
+from user_cache import UserCache
+
+# Потоков не больше, чем соединений в пуле: лишние потоки все равно ждали бы свободное соединение
+DB_EXECUTOR_WORKERS = int(os.environ.get("DB_EXECUTOR_WORKERS", db.DB_POOL_SIZE))
+
+_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+
+# Групповая фиксация ставок и открытий сундуков: сколько намерений в одной транзакции и сколько ждать попутчиков
+WRITE_BATCH_SIZE = int(os.environ.get("WRITE_BATCH_SIZE", "32"))
+WRITE_LINGER = float(os.environ.get("WRITE_LINGER_MS", "2")) / 1000
+
+
+def _timed_call(func, args, kwargs):
+    # Замер идет в потоке пула: ожидание свободного потока в длительность вызова не входит
+    with metrics.DB_CALL_LATENCY.time(getattr(func, "__name__", "unknown")):
+        return func(*args, **kwargs)
+
+
+async def run(func, *args, **kwargs):
+    """Выполняет синхронную функцию, работающую с бд, в пуле потоков бд."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, _timed_call, func, args, kwargs)
+
+
+def shutdown():
+    writes.stop()
+    _executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _async(name: str):
+    async def wrapper(*args, **kwargs):
+        return await run(getattr(db, name), *args, **kwargs)
+    wrapper.__name__ = name
+    wrapper.__doc__ = f"Асинхронная версия db.{name}."
+    return wrapper
+
+
+get_versions = _async("get_versions")
+get_user = _async("get_user")
+get_user_by_username = _async("get_user_by_username")
+create_poll = _async("create_poll")
+set_poll_message_id = _async("set_poll_message_id")
+auto_close_due_polls = _async("auto_close_due_polls")
+next_poll_close_at = _async("next_poll_close_at")
+get_poll = _async("get_poll")
+get_active_poll_versions = _async("get_active_poll_versions")
+get_poll_with_bets = _async("get_poll_with_bets")
+get_poll_card_versions = _async("get_poll_card_versions")
+list_polls = _async("list_polls")
+list_all_polls = _async("list_all_polls")
+get_bets_for_poll = _async("get_bets_for_poll")
+close_poll = _async("close_poll")
+check_poll_totals = _async("check_poll_totals")
+get_rating = _async("get_rating")
+get_user_rank = _async("get_user_rank")
+add_balance = _async("add_balance")
+list_chests = _async("list_chests")
+get_ledger = _async("get_ledger")
+get_ledger_daily = _async("get_ledger_daily")
+get_bootstrap = _async("get_bootstrap")
+compact_ledger = _async("compact_ledger")
+
+
+async def _apply_writes(intents):
+    return await run(db.apply_writes, intents)
+
+
+writes = WriteQueue(_apply_writes, batch_size=WRITE_BATCH_SIZE, linger=WRITE_LINGER)
+
+
+async def place_bet(telegram_id: int, poll_id: int, option_id: int, amount: int):
+    """Ставка через групповую фиксацию (см. write_queue)."""
+    return await writes.submit("place_bet", (telegram_id, poll_id, option_id, amount))
+
+
+async def open_chest(telegram_id: int, chest_id: int, count: int = 1):
+    """Открытие сундуков через групповую фиксацию (см. write_queue)."""
+    return await writes.submit("open_chest", (telegram_id, chest_id, count))
+
+
+known_users = UserCache()
+
+
+async def ensure_user(telegram_id: int, username: str | None):
+    """Создает пользователя или обновляет его имя; для уже известного процессу пользователя бд не трогает."""
+    if known_users.matches(telegram_id, username):
+        return
+    user = await run(db.upsert_user, telegram_id, username)
+    known_users.put(telegram_id, user["username"])
+
+
+async def place_user_bet(telegram_id: int, username: str | None, poll_id: int, option_id: int, amount: int):
+    """Ставка от имени пользователя Telegram, созданного при необходимости.
+
+    Если пользователя удалили из бд в другом процессе (восстановление из копии),
+    кэш здесь об этом не знает: запись сбрасывается, пользователь создается заново
+    и ставка повторяется один раз.
+    """
+    await ensure_user(telegram_id, username)
+    result = await place_bet(telegram_id, poll_id, option_id, amount)
+    if result.get("error") == db.USER_NOT_FOUND:
+        known_users.invalidate(telegram_id)
+        await ensure_user(telegram_id, username)
+        result = await place_bet(telegram_id, poll_id, option_id, amount)
+    return result
+
+
+async def open_user_chest(telegram_id: int, chest_id: int, count: int = 1):
+    """Открытие сундуков пользователем, которого процесс уже видел (через вход в Mini App).
+
+    Как и у ставок: если пользователя удалили из бд в другом процессе, а кэш
+    здесь помнит его, запись сбрасывается, пользователь создается заново и
+    открытие повторяется один раз. Незнакомого процессу пользователя открытие
+    сундука не создает.
+    """
+    result = await open_chest(telegram_id, chest_id, count)
+    if result.get("error") == db.USER_NOT_FOUND and known_users.matches(telegram_id, None):
+        known_users.invalidate(telegram_id)
+        # Имя вернется при следующем входе: сброшенная запись кэша заставит обновить его
+        await ensure_user(telegram_id, None)
+        result = await open_chest(telegram_id, chest_id, count)
+    return result
+
+
+async def auth_user(telegram_id: int, username: str | None):
+    """Пользователь со свежим балансом, созданный при необходимости, за одно обращение к бд."""
+    if known_users.matches(telegram_id, username):
+        user = await get_user(telegram_id)
+        if user:
+            return user
+    user = await run(db.upsert_user, telegram_id, username)
+    known_users.put(telegram_id, user["username"])
+    return user
+
+
+async def bootstrap(telegram_id: int, username: str | None, sections: list[str], polls_limit: int = 50, rating_limit: int = 100):
+    """Вход в Mini App: пользователь создается при необходимости, затем все секции читаются одним снимком."""
+    known = known_users.matches(telegram_id, username)
+    if not known:
+        user = await run(db.upsert_user, telegram_id, username)
+        known_users.put(telegram_id, user["username"])
+    data = await get_bootstrap(telegram_id, sections, polls_limit, rating_limit)
+    if known and "user" in sections and data["user"] is None:
+        # Процесс помнил пользователя, а в бд его уже нет (например, после пересоздания бд)
+        user = await run(db.upsert_user, telegram_id, username)
+        known_users.put(telegram_id, user["username"])
+        data = await get_bootstrap(telegram_id, sections, polls_limit, rating_limit)
+    return data
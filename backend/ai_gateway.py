@@ -0,0 +1,224 @@
+"""Шлюз к AI-модели для команд /ask и /describe.
+
+Запросы к модели долгие и платные, поэтому они идут через один шлюз:
+- одновременно выполняется не больше max_concurrency запросов, а очередь
+  ожидающих ограничена, лишние сразу получают отказ (GatewayBusy);
+- у каждого пользователя свой лимит запросов за окно времени (RateLimited);
+- ответы на одинаковые запросы (тот же текст, та же картинка) берутся из
+  LRU-кэша с TTL, без обращения к модели и без скачивания картинки, а
+  одинаковые запросы, пришедшие одновременно, ждут один общий вызов модели;
+- картинки уменьшаются и пережимаются в JPEG в отдельном пуле потоков, а не
+  в цикле событий, где в это время обрабатываются ставки.
+
+Модель подключается через бэкенд: GeminiBackend для работы и FakeBackend
+для проверки пропускной способности без сети и ключа API. Клиент Gemini и
+PIL тяжелые, поэтому импортируются при первом запросе, а не при старте.
+"""
+import asyncio
+import hashlib
+import io
+import os
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Protocol
+
+AI_BACKEND = os.environ.get("AI_BACKEND", "gemini")
+AI_MAX_CONCURRENCY = int(os.environ.get("AI_MAX_CONCURRENCY", "4"))
+AI_MAX_WAITING = int(os.environ.get("AI_MAX_WAITING", "16"))
+# Не больше AI_USER_RATE запросов от одного пользователя за AI_USER_PERIOD секунд
+AI_USER_RATE = int(os.environ.get("AI_USER_RATE", "5"))
+AI_USER_PERIOD = float(os.environ.get("AI_USER_PERIOD", "60"))
+AI_CACHE_SIZE = int(os.environ.get("AI_CACHE_SIZE", "256"))
+AI_CACHE_TTL = float(os.environ.get("AI_CACHE_TTL", "3600"))
+AI_IMAGE_MAX_SIDE = int(os.environ.get("AI_IMAGE_MAX_SIDE", "1024"))
+AI_IMAGE_QUALITY = int(os.environ.get("AI_IMAGE_QUALITY", "85"))
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f"Слишком много запросов, повторите через {retry_after:.0f} с")
+        self.retry_after = retry_after
+
+
+class GatewayBusy(Exception):
+    pass
+
+
+class AIBackend(Protocol):
+    async def generate_text(self, prompt: str) -> str | None: ...
+
+    async def describe_image(self, prompt: str, jpeg: bytes) -> str | None: ...
+
+
+class GeminiBackend:
+    def __init__(self, api_key: str, text_model: str = "gemini-pro", vision_model: str = "gemini-pro-vision"):
+        self.api_key = api_key
+        self.model_names = (text_model, vision_model)
+        self._loading: asyncio.Task | None = None
+
+    def _load(self) -> tuple:
+        import google.generativeai as genai
+        genai.configure(api_key=self.api_key)
+        return tuple(genai.GenerativeModel(name) for name in self.model_names)
+
+    async def _models(self) -> tuple:
+        # Импорт клиента занимает около секунды, поэтому он идет в потоке, а одновременные первые запросы ждут один импорт
+        if self._loading is None or (self._loading.done() and (self._loading.cancelled() or self._loading.exception())):
+            self._loading = asyncio.create_task(asyncio.to_thread(self._load))
+        return await asyncio.shield(self._loading)
+
+    @staticmethod
+    def _text(response) -> str | None:
+        # Пустой ответ означает, что сработали фильтры безопасности
+        return response.text if response.parts else None
+
+    async def generate_text(self, prompt: str) -> str | None:
+        text_model, _ = await self._models()
+        return self._text(await text_model.generate_content_async(prompt))
+
+    async def describe_image(self, prompt: str, jpeg: bytes) -> str | None:
+        _, vision_model = await self._models()
+        return self._text(await vision_model.generate_content_async([prompt, {"mime_type": "image/jpeg", "data": jpeg}]))
+
+
+class FakeBackend:
+    """Отвечает детерминированно после задержки latency; для бенчмарков и отладки без сети."""
+
+    def __init__(self, latency: float = 0.5):
+        self.latency = latency
+        self.calls = 0
+
+    async def generate_text(self, prompt: str) -> str | None:
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return f"Ответ на: {prompt[:200]}"
+
+    async def describe_image(self, prompt: str, jpeg: bytes) -> str | None:
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return f"Картинка {len(jpeg)} байт: {prompt[:200]}"
+
+
+def make_backend(name: str = AI_BACKEND, api_key: str | None = None) -> AIBackend:
+    if name == "fake":
+        return FakeBackend(float(os.environ.get("AI_FAKE_LATENCY", "0.5")))
+    if name == "gemini":
+        return GeminiBackend(api_key or os.environ.get("GEMINI_API_KEY", ""))
+    raise ValueError(f"Неизвестный AI_BACKEND: {name}")
+
+
+def downscale_image(data: bytes, max_side: int = AI_IMAGE_MAX_SIDE, quality: int = AI_IMAGE_QUALITY) -> bytes:
+    """Уменьшает картинку до max_side по большей стороне и пережимает в JPEG."""
+    from PIL import Image
+    with Image.open(io.BytesIO(data)) as img:
+        # Для JPEG draft декодирует сразу в уменьшенном масштабе, не разворачивая полный размер
+        img.draft("RGB", (max_side, max_side))
+        img = img.convert("RGB")
+        img.thumbnail((max_side, max_side))
+        out = io.BytesIO()
+        img.save(out, format="JPEG", quality=quality, optimize=True)
+        return out.getvalue()
+
+
+class AIGateway:
+    def __init__(self, backend: AIBackend, max_concurrency: int = AI_MAX_CONCURRENCY, max_waiting: int = AI_MAX_WAITING,
+                 user_rate: int = AI_USER_RATE, user_period: float = AI_USER_PERIOD,
+                 cache_size: int = AI_CACHE_SIZE, cache_ttl: float = AI_CACHE_TTL):
+        self.backend = backend
+        self.max_concurrency = max_concurrency
+        self.max_waiting = max_waiting
+        self.user_rate = user_rate
+        self.user_period = user_period
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self._semaphore: asyncio.Semaphore | None = None
+        self._waiting = 0
+        self._requests: dict[int, deque] = {}
+        self._cache: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._images = ThreadPoolExecutor(max_workers=2, thread_name_prefix="ai-image")
+
+    @staticmethod
+    def _key(*parts: str) -> str:
+        return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+    def _cached(self, key: str) -> str | None:
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return entry[1]
+
+    def _remember(self, key: str, answer: str):
+        self._cache[key] = (time.monotonic() + self.cache_ttl, answer)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _check_rate(self, user_id: int):
+        now = time.monotonic()
+        recent = self._requests.setdefault(user_id, deque())
+        while recent and recent[0] <= now - self.user_period:
+            recent.popleft()
+        if len(recent) >= self.user_rate:
+            raise RateLimited(recent[0] + self.user_period - now)
+        recent.append(now)
+        # Не копим пустые окна неактивных пользователей
+        if len(self._requests) > 10000:
+            for uid in [uid for uid, times in self._requests.items() if not times or times[-1] <= now - self.user_period]:
+                del self._requests[uid]
+
+    async def _call(self, request: Callable[[], Awaitable[str | None]]) -> str | None:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        if self._semaphore.locked() and self._waiting >= self.max_waiting:
+            raise GatewayBusy("AI сейчас перегружен, попробуйте чуть позже")
+        self._waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self._waiting -= 1
+        try:
+            return await request()
+        finally:
+            self._semaphore.release()
+
+    async def _answer(self, key: str, user_id: int, produce: Callable[[], Awaitable[str | None]]) -> str | None:
+        cached = self._cached(key)
+        if cached is not None:
+            return cached
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            return await asyncio.shield(inflight)
+        self._check_rate(user_id)
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            answer = await produce()
+            if answer is not None:
+                self._remember(key, answer)
+            future.set_result(answer)
+            return answer
+        except BaseException as e:
+            future.set_exception(e)
+            # Ошибку получают ожидающие; если их нет, asyncio не должен ругаться на непрочитанное исключение
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+    async def ask(self, user_id: int, prompt: str) -> str | None:
+        return await self._answer(self._key("ask", prompt), user_id, lambda: self._call(lambda: self.backend.generate_text(prompt)))
+
+    async def describe(self, user_id: int, prompt: str, image_key: str, load_image: Callable[[], Awaitable[bytes]]) -> str | None:
+        """Описание картинки; image_key (например, file_unique_id Telegram) позволяет ответить из кэша, не скачивая ее."""
+        async def produce() -> str | None:
+            data = await load_image()
+            jpeg = await asyncio.get_running_loop().run_in_executor(self._images, downscale_image, data)
+            return await self._call(lambda: self.backend.describe_image(prompt, jpeg))
+
+        return await self._answer(self._key("describe", prompt, image_key), user_id, produce)
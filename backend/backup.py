@@ -0,0 +1,179 @@
+"""Резервные копии базы данных на лету и восстановление из них.
+
+Копия снимается через онлайн-API резервного копирования SQLite одним шагом:
+в режиме WAL это одна читающая транзакция, поэтому снимок согласован и при
+этом не блокирует запись ставок. Пошаговое копирование здесь не подходит:
+любая запись другого соединения перезапускает его с начала, и под нагрузкой
+копия может не закончиться никогда.
+
+Снимок переводится в обычный журнал (один файл без -wal) и сжимается gzip
+потоково, без чтения файла в память.
+
+Восстановление не подменяет файл бд: другие процессы (бот, воркеры) держат
+его открытым вместе с -wal/-shm, и подмена привела бы к тому, что они пишут
+в старый файл, а при закрытии удаляют WAL уже новой бд. Вместо этого
+проверенная копия подключается через ATTACH и переливается в рабочую бд
+одной транзакцией записи, а читатели видят либо старые, либо новые данные
+целиком. На время переливания создается файл-флаг (db.restore_flag_path):
+писатели всех процессов видят его до BEGIN IMMEDIATE и ждут окончания
+восстановления (до DB_RESTORE_WAIT), а не падают, когда ожидание блокировки
+превысит busy timeout. Не дождутся только записи, уже ждавшие блокировку в
+момент создания флага, если переливание идет дольше busy timeout.
+Счетчики изменений (meta, polls.version) при этом сдвигаются выше
+текущих, чтобы кэши всех процессов считали свои данные устаревшими.
+
+Все функции синхронные и долгие: из асинхронного кода их нужно вызывать
+через asyncio.to_thread.
+"""
+import gzip
+import os
+import shutil
+import sqlite3
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+import db
+
+BACKUP_DIR = os.environ.get("BACKUP_DIR") or None
+BACKUP_GZIP_LEVEL = int(os.environ.get("BACKUP_GZIP_LEVEL", "6"))
+CHUNK_SIZE = 1024 * 1024
+
+
+def snapshot(dest: Path, source: Path | None = None):
+    """Согласованная копия бд в dest, снятая без остановки записи."""
+    src = sqlite3.connect(source or db.DB_PATH, timeout=30)
+    dst = sqlite3.connect(dest)
+    try:
+        src.backup(dst)
+        dst.execute("PRAGMA journal_mode = DELETE")
+    finally:
+        dst.close()
+        src.close()
+
+
+def compress(source: Path, dest: Path):
+    with open(source, "rb") as raw, gzip.open(dest, "wb", compresslevel=BACKUP_GZIP_LEVEL) as packed:
+        shutil.copyfileobj(raw, packed, CHUNK_SIZE)
+
+
+def create_backup() -> Path:
+    """Снимает и сжимает копию бд; возвращает путь к .db.gz во временном каталоге (удалять через remove_backup)."""
+    workdir = Path(tempfile.mkdtemp(prefix="tgapp-backup-", dir=BACKUP_DIR))
+    try:
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        raw = workdir / f"{Path(db.DB_PATH).stem}-{stamp}.db"
+        snapshot(raw)
+        packed = raw.with_name(raw.name + ".gz")
+        compress(raw, packed)
+        raw.unlink()
+        return packed
+    except Exception:
+        shutil.rmtree(workdir, ignore_errors=True)
+        raise
+
+
+def remove_backup(path: Path):
+    shutil.rmtree(path.parent, ignore_errors=True)
+
+
+def upload_path(file_name: str) -> Path:
+    """Путь во временном каталоге для загружаемой копии (удалять через remove_backup)."""
+    workdir = Path(tempfile.mkdtemp(prefix="tgapp-restore-", dir=BACKUP_DIR))
+    return workdir / Path(file_name).name
+
+
+def decompress(source: Path) -> Path:
+    if source.suffix != ".gz":
+        return source
+    dest = source.with_suffix("")
+    with gzip.open(source, "rb") as packed, open(dest, "wb") as raw:
+        shutil.copyfileobj(packed, raw, CHUNK_SIZE)
+    source.unlink()
+    return dest
+
+
+def _open(path: Path) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def prepare(path: Path) -> int:
+    """Проверяет копию (целостность, версия схемы) и доводит ее схему до текущей. Возвращает исходную версию схемы."""
+    conn = _open(path)
+    try:
+        try:
+            result = conn.execute("PRAGMA integrity_check").fetchone()[0]
+        except sqlite3.DatabaseError as e:
+            raise ValueError(f"файл не является базой данных SQLite: {e}")
+        if result != "ok":
+            raise ValueError(f"проверка целостности не пройдена: {result}")
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users'").fetchone():
+            raise ValueError("в файле нет таблиц приложения")
+        version = db.get_schema_version(conn)
+        if version > db.SCHEMA_VERSION:
+            raise ValueError(f"копия создана более новой версией приложения (схема {version}, поддерживается до {db.SCHEMA_VERSION})")
+        db.migrate(conn)
+        return version
+    finally:
+        conn.close()
+
+
+def _copy_into_live(live: sqlite3.Connection):
+    """Переливает данные из подключенной как restored копии в рабочую бд; вызывается внутри транзакции записи."""
+    tables = [row["name"] for row in live.execute(
+        "SELECT name FROM main.sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' AND name NOT IN ('schema_version', 'meta')"
+    )]
+    counters = {row["key"]: row["value"] for row in live.execute("SELECT key, value FROM main.meta")}
+    restored_counters = {row["key"]: row["value"] for row in live.execute("SELECT key, value FROM restored.meta")}
+    poll_version_offset = live.execute("SELECT IFNULL(MAX(version), 0) + 1 FROM main.polls").fetchone()[0]
+    for table in tables:
+        columns = ", ".join(f'"{row["name"]}"' for row in live.execute(f'PRAGMA main.table_info("{table}")'))
+        live.execute(f'DELETE FROM main."{table}"')
+        live.execute(f'INSERT INTO main."{table}" ({columns}) SELECT {columns} FROM restored."{table}"')
+    if live.execute("SELECT 1 FROM restored.sqlite_master WHERE name = 'sqlite_sequence'").fetchone():
+        live.execute("DELETE FROM main.sqlite_sequence")
+        live.execute("INSERT INTO main.sqlite_sequence (name, seq) SELECT name, seq FROM restored.sqlite_sequence")
+    live.execute("UPDATE main.polls SET version = version + ?", (poll_version_offset,))
+    for key in counters.keys() | restored_counters.keys():
+        value = max(counters.get(key, 0), restored_counters.get(key, 0)) + 1
+        live.execute("INSERT INTO main.meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value", (key, value))
+
+
+def restore_backup(path: Path) -> int:
+    """Восстанавливает рабочую бд из загруженной копии (.db или .db.gz) без перезапуска. Возвращает исходную версию схемы копии.
+
+    Пул соединений этого процесса на время переливания приостанавливается:
+    начатые запросы завершаются, новые ждут, а после восстановления
+    соединения открываются заново.
+    """
+    path = decompress(path)
+    version = prepare(path)
+    pool = db.get_pool()
+    pool.pause()
+    # Флаг ставится после паузы: иначе пауза ждала бы запросы этого процесса, которые сами ждут снятия флага
+    flag = db.restore_flag_path()
+    flag.touch()
+    try:
+        live = _open(db.DB_PATH)
+        try:
+            # Строки переливаются целиком, проверять связи между ними по ходу не нужно
+            live.execute("PRAGMA foreign_keys = OFF")
+            live.execute("ATTACH DATABASE ? AS restored", (str(path),))
+            live.execute("BEGIN IMMEDIATE")
+            try:
+                _copy_into_live(live)
+                live.commit()
+            except Exception:
+                live.rollback()
+                raise
+            live.execute("DETACH DATABASE restored")
+        finally:
+            live.close()
+        db.LEADERBOARD.invalidate()
+        db.CHEST_TABLE.invalidate()
+    finally:
+        flag.unlink(missing_ok=True)
+        pool.resume()
+    return version
@@ -0,0 +1,6 @@
+"""Бенчмарки горячих путей бэкенда.
+
+Каждый бенчмарк работает с временной базой данных: путь к ней задается через
+переменную окружения DB_PATH до импорта модуля db, поэтому запускать их нужно
+как модули из каталога backend, например `python -m benchmarks.close_poll_lock`.
+"""
@@ -0,0 +1,55 @@
+"""Бенчмарк горячих путей ставок: функции db напрямую и HTTP API через ASGI.
+
+Запуск из каталога backend:
+    python -m benchmarks --users 2000 --polls 20 --bets-per-poll 300 --calls 1000 --concurrency 16
+
+Для каждой операции выводятся среднее и p50/p95/p99 задержки, пропускная
+способность, число ошибок и суммарное время ожидания блокировки записи SQLite.
+"""
+import argparse
+import asyncio
+import os
+import time
+
+from benchmarks.seed import use_temp_db, seed_dataset
+from benchmarks.fake_telegram import BENCH_ENV
+
+use_temp_db()
+os.environ.update(BENCH_ENV)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--polls", type=int, default=20)
+    parser.add_argument("--options", type=int, default=3)
+    parser.add_argument("--bets-per-poll", type=int, default=300)
+    parser.add_argument("--close-bettors", type=int, default=1000, help="ставок в каждом разрешаемом опросе")
+    parser.add_argument("--calls", type=int, default=1000, help="вызовов каждой операции")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--skip-api", action="store_true")
+    args = parser.parse_args()
+
+    import db
+    from benchmarks import db_bench, api_bench
+    from benchmarks.stats import LatencyRecorder, LockWaitTracer
+
+    tracer = LockWaitTracer()
+    tracer.install()
+    db.init_db()
+    started = time.perf_counter()
+    with db.connection() as conn:
+        dataset = seed_dataset(conn, args.users, args.polls, args.options, args.bets_per_poll)
+    print(f"База заполнена за {time.perf_counter() - started:.1f} с: {args.users} пользователей, "
+          f"{args.polls} опросов по {args.bets_per_poll} ставок, файл {db.DB_PATH}\n")
+
+    print(LatencyRecorder.header())
+    for row in db_bench.run(dataset, args.calls, args.concurrency, tracer, args.close_bettors):
+        print(row)
+    if not args.skip_api:
+        for row in asyncio.run(api_bench.run(dataset, args.calls, args.concurrency, tracer)):
+            print(row)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Пропускная способность AI-шлюза на поддельной модели, без сети и ключа API.
+
+Пользователи параллельно отправляют /ask и /describe: часть вопросов
+повторяется и должна отвечаться из кэша, картинки уменьшаются в пуле
+потоков. Отдельно замеряется, насколько задерживается цикл событий, пока
+идут запросы (это время ожидания обработчиков ставок).
+
+Запуск: `python -m benchmarks.ai_bench --requests 500 --users 50 --latency 0.5`
+"""
+import argparse
+import asyncio
+import io
+import random
+import time
+
+from PIL import Image
+
+from ai_gateway import AIGateway, FakeBackend, GatewayBusy, RateLimited
+from benchmarks.stats import LatencyRecorder
+
+
+def make_photo(side: int) -> bytes:
+    img = Image.effect_noise((side, side), 64).convert("RGB")
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=90)
+    return out.getvalue()
+
+
+async def loop_lag(stop: asyncio.Event, interval: float = 0.01) -> float:
+    """Наибольшая задержка пробуждения цикла событий за время работы."""
+    loop = asyncio.get_running_loop()
+    worst = 0.0
+    while not stop.is_set():
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        worst = max(worst, loop.time() - expected)
+    return worst
+
+
+async def run(requests: int, users: int, latency: float, concurrency: int, repeat: float, photos: float, side: int):
+    backend = FakeBackend(latency)
+    gateway = AIGateway(backend, max_concurrency=concurrency, max_waiting=requests, user_rate=requests, cache_size=requests)
+    photo = make_photo(side)
+    rng = random.Random(1)
+    ask, describe = LatencyRecorder("ai.ask"), LatencyRecorder("ai.describe")
+    rejected = 0
+
+    async def one(i: int):
+        nonlocal rejected
+        user_id = i % users
+        # Доля repeat запросов повторяет один из немногих популярных вопросов
+        prompt = f"вопрос {rng.randrange(10)}" if rng.random() < repeat else f"вопрос {i}"
+        is_photo = rng.random() < photos
+        recorder = describe if is_photo else ask
+
+        async def load_image() -> bytes:
+            return photo
+
+        started = time.perf_counter()
+        try:
+            if is_photo:
+                await gateway.describe(user_id, prompt, f"photo-{i % 20}", load_image)
+            else:
+                await gateway.ask(user_id, prompt)
+            recorder.add(time.perf_counter() - started)
+        except (RateLimited, GatewayBusy):
+            rejected += 1
+            recorder.fail()
+
+    stop = asyncio.Event()
+    lag = asyncio.create_task(loop_lag(stop))
+    started = time.perf_counter()
+    ask.started = describe.started = started
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    ask.finished = describe.finished = time.perf_counter()
+    stop.set()
+    worst_lag = await lag
+
+    print(f"Запросов: {requests}, пользователей: {users}, параллельно к модели: {concurrency}, задержка модели: {latency * 1000:.0f} мс")
+    print(LatencyRecorder.header())
+    print(ask.row())
+    print(describe.row())
+    print(f"Вызовов модели: {backend.calls}, из кэша: {requests - rejected - backend.calls}, отклонено: {rejected}")
+    print(f"Картинка {side}x{side}: {len(photo) // 1024} КБ; наибольшая задержка цикла событий: {worst_lag * 1000:.1f} мс")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.5, help="задержка ответа поддельной модели, с")
+    parser.add_argument("--concurrency", type=int, default=4, help="одновременных запросов к модели")
+    parser.add_argument("--repeat", type=float, default=0.3, help="доля повторяющихся вопросов")
+    parser.add_argument("--photos", type=float, default=0.3, help="доля запросов /describe")
+    parser.add_argument("--side", type=int, default=2560, help="сторона исходной картинки, px")
+    args = parser.parse_args()
+    asyncio.run(run(args.requests, args.users, args.latency, args.concurrency, args.repeat, args.photos, args.side))
+
+
+if __name__ == "__main__":
+    main()
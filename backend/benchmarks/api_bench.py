@@ -0,0 +1,56 @@
+"""Нагрузка на HTTP API через ASGI (без сети) с ботом на поддельной сессии Telegram."""
+import asyncio
+import random
+import time
+
+import httpx
+
+from benchmarks.fake_telegram import FakeSession
+from benchmarks.seed import seed_poll
+from benchmarks.stats import LatencyRecorder, LockWaitTracer
+
+
+async def _drive(client: httpx.AsyncClient, name: str, make_request, calls: int, concurrency: int, tracer: LockWaitTracer) -> str:
+    recorder = LatencyRecorder(name)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                response = await make_request(client, i)
+                ok = response.status_code < 400
+            except Exception:
+                ok = False
+            recorder.add(time.perf_counter() - started, ok)
+
+    tracer.take()
+    recorder.started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(calls)))
+    recorder.finished = time.perf_counter()
+    return recorder.row(tracer.take())
+
+
+async def run(dataset: dict, calls: int, concurrency: int, tracer: LockWaitTracer) -> list[str]:
+    import db
+    import bot
+    import main
+
+    bot.init_bot()
+    bot.bot.session = FakeSession()
+    user_ids = dataset["user_ids"]
+    with db.connection() as conn:
+        bet_polls = [seed_poll(conn, user_ids[0], options=2) for _ in range(max(1, calls // len(user_ids) + 1))]
+
+    def bet(client, i):
+        poll_id, option_ids = bet_polls[i // len(user_ids)]
+        payload = {"telegram_id": user_ids[i % len(user_ids)], "poll_id": poll_id, "option_id": random.choice(option_ids), "amount": 10}
+        return client.post("/api/bet", json=payload)
+
+    rows = []
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        rows.append(await _drive(client, "POST /api/bet", bet, calls, concurrency, tracer))
+        rows.append(await _drive(client, "GET /api/polls", lambda c, i: c.get("/api/polls"), calls, concurrency, tracer))
+        rows.append(await _drive(client, "GET /api/rating", lambda c, i: c.get("/api/rating"), calls, concurrency, tracer))
+    return rows
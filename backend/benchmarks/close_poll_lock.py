@@ -0,0 +1,59 @@
+"""Время удержания блокировки записи в db.close_poll в зависимости от числа ставок.
+
+Запуск: `python -m benchmarks.close_poll_lock [число_ставок ...]`
+"""
+import os
+import sys
+import time
+
+from benchmarks.seed import use_temp_db, seed_users, seed_poll
+
+use_temp_db()
+# Одно соединение в пуле, чтобы трассировка BEGIN/COMMIT видела именно транзакцию close_poll
+os.environ["DB_POOL_SIZE"] = "1"
+
+import db  # noqa: E402
+
+DEFAULT_BETTOR_COUNTS = (10, 100, 1000, 5000, 20000)
+
+
+def measure(bettors: int, first_user_id: int) -> tuple[float, float]:
+    """Возвращает (удержание блокировки, общее время вызова) в миллисекундах."""
+    with db.connection() as conn:
+        user_ids = seed_users(conn, bettors, start_id=first_user_id)
+        poll_id, option_ids = seed_poll(conn, user_ids[0], options=3, bettor_ids=user_ids)
+
+    marks = {}
+
+    def trace(statement: str):
+        if statement.startswith("BEGIN IMMEDIATE"):
+            marks["begin"] = time.perf_counter()
+        elif statement.startswith("COMMIT"):
+            marks["commit"] = time.perf_counter()
+
+    with db.connection() as conn:
+        conn.set_trace_callback(trace)
+    started = time.perf_counter()
+    result = db.close_poll(user_ids[0], poll_id, option_ids[0])
+    finished = time.perf_counter()
+    with db.connection() as conn:
+        conn.set_trace_callback(None)
+    if not result.get("ok"):
+        raise RuntimeError(result.get("error"))
+    committed = marks.get("commit", finished)
+    return (committed - marks["begin"]) * 1000, (finished - started) * 1000
+
+
+def main(argv: list[str]):
+    counts = [int(arg) for arg in argv] or DEFAULT_BETTOR_COUNTS
+    db.init_db()
+    print(f"{'ставок':>8} | {'блокировка, мс':>15} | {'вызов, мс':>10} | {'мкс/ставка':>10}")
+    next_user_id = 1
+    for count in counts:
+        lock_ms, total_ms = measure(count, next_user_id)
+        next_user_id += count
+        print(f"{count:>8} | {lock_ms:>15.2f} | {total_ms:>10.2f} | {lock_ms * 1000 / count:>10.2f}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,51 @@
+"""Микробенчмарки функций db на горячих путях, с параллельными вызовами из пула потоков."""
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+from benchmarks.seed import seed_poll
+from benchmarks.stats import LatencyRecorder, LockWaitTracer
+
+
+def _run(name: str, func, calls: int, concurrency: int, tracer: LockWaitTracer) -> str:
+    recorder = LatencyRecorder(name)
+
+    def one(i: int):
+        with recorder.measure():
+            result = func(i)
+        if isinstance(result, dict) and result.get("ok") is False:
+            recorder.fail()
+
+    tracer.take()
+    recorder.started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(calls)))
+    recorder.finished = time.perf_counter()
+    return recorder.row(tracer.take())
+
+
+def run(dataset: dict, calls: int, concurrency: int, tracer: LockWaitTracer, close_bettors: int) -> list[str]:
+    user_ids = dataset["user_ids"]
+    polls = dataset["polls"]
+    rows = []
+
+    # Каждой ставке нужен свой опрос или свой пользователь: повторная ставка в том же опросе отклоняется
+    with db.connection() as conn:
+        bet_polls = [seed_poll(conn, user_ids[0], options=2) for _ in range(max(1, calls // len(user_ids) + 1))]
+
+    def place_bet(i: int):
+        poll_id, option_ids = bet_polls[i // len(user_ids)]
+        return db.place_bet(user_ids[i % len(user_ids)], poll_id, random.choice(option_ids), 10)
+
+    rows.append(_run("db.place_bet", place_bet, calls, concurrency, tracer))
+    rows.append(_run("db.open_chest", lambda i: db.open_chest(random.choice(user_ids), random.randint(1, 3)), calls, concurrency, tracer))
+    rows.append(_run("db.open_chest (x10)", lambda i: db.open_chest(random.choice(user_ids), random.randint(1, 3), 10), calls, concurrency, tracer))
+    rows.append(_run("db.list_polls", lambda i: db.list_polls(open_only=True, limit=50), calls, concurrency, tracer))
+    rows.append(_run("db.get_rating", lambda i: db.get_rating(limit=100), calls, concurrency, tracer))
+    rows.append(_run("db.get_poll", lambda i: db.get_poll(random.choice(polls)[0]), calls, concurrency, tracer))
+
+    with db.connection() as conn:
+        to_close = [seed_poll(conn, user_ids[0], options=3, bettor_ids=random.sample(user_ids, min(close_bettors, len(user_ids)))) for _ in range(min(calls, 50))]
+    rows.append(_run(f"db.close_poll ({close_bettors})", lambda i: db.close_poll(user_ids[0], to_close[i][0], to_close[i][1][0]), len(to_close), concurrency, tracer))
+    return rows
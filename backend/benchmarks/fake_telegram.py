@@ -0,0 +1,70 @@
+"""Поддельный Telegram для бенчмарков: сессия aiogram без сети и генератор обновлений."""
+import asyncio
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import TelegramMethod
+from aiogram.types import Chat, Message, User
+
+BENCH_ENV = {
+    "BOT_TOKEN": "123456:BENCHMARK",
+    "CHAT_ID": "-100",
+    "ADMIN_IDS": "1",
+    "GEMINI_API_KEY": "benchmark",
+}
+
+
+class FakeSession(BaseSession):
+    """Отвечает на любые методы Bot API мгновенно (или с задержкой latency) и считает вызовы."""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls: Counter[str] = Counter()
+        self._message_ids = 1000
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: int | None = None):
+        self.calls[type(method).__name__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        returning = str(getattr(method, "__returning__", bool))
+        if "bool" in returning:
+            return True
+        if "Message" in returning:
+            self._message_ids += 1
+            chat_id = getattr(method, "chat_id", 0) or 0
+            return Message(message_id=self._message_ids, date=datetime.now(timezone.utc), chat=Chat(id=int(chat_id), type="supergroup"))
+        if "User" in returning:
+            return User(id=1, is_bot=True, first_name="bench", username="bench_bot")
+        return True
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+
+def callback_update(update_id: int, telegram_id: int, chat_id: int, message_id: int, data: str) -> dict:
+    """Обновление callback_query в формате, который Telegram присылает на webhook."""
+    now = int(time.time())
+    user = {"id": telegram_id, "is_bot": False, "first_name": f"user{telegram_id}", "username": f"user{telegram_id}"}
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user,
+            "chat_instance": "bench",
+            "data": data,
+            "message": {
+                "message_id": message_id,
+                "date": now,
+                "chat": {"id": chat_id, "type": "supergroup", "title": "bench"},
+                "from": {"id": 1, "is_bot": True, "first_name": "bench"},
+                "text": "poll",
+            },
+        },
+    }
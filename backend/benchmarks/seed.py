@@ -0,0 +1,51 @@
+"""Наполнение временной базы данных тестовыми пользователями, опросами и ставками."""
+import os
+import random
+import tempfile
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+
+def use_temp_db() -> Path:
+    """Направляет модуль db во временный файл; вызывать до `import db`."""
+    path = Path(tempfile.mkdtemp(prefix="tgapp-bench-")) / "bench.db"
+    os.environ["DB_PATH"] = str(path)
+    os.environ.pop("RECREATE_DB_ON_STARTUP", None)
+    return path
+
+
+def seed_users(conn, count: int, start_id: int = 1, balance: int = 1_000_000) -> list[int]:
+    ids = list(range(start_id, start_id + count))
+    conn.execute("BEGIN")
+    conn.executemany("INSERT OR IGNORE INTO users (telegram_id, username, balance) VALUES (?, ?, ?)", [(i, f"user{i}", balance) for i in ids])
+    conn.commit()
+    return ids
+
+
+def seed_poll(conn, creator_id: int, options: int = 2, bettor_ids: list[int] = (), amount: int = 100, status: str = "accepting_bets") -> tuple[int, list[int]]:
+    """Создает опрос с вариантами и ставками bettor_ids, равномерно распределенными по вариантам, вместе с накопленными суммами."""
+    cur = conn.cursor()
+    cur.execute("BEGIN")
+    closes_at = (datetime.now(timezone.utc) + timedelta(minutes=20)).isoformat(timespec="microseconds")
+    cur.execute("INSERT INTO polls (question, creator_id, status, closes_at) VALUES (?, ?, ?, ?)", (f"Bench poll by {creator_id}", creator_id, status, closes_at))
+    poll_id = cur.lastrowid
+    option_ids = []
+    for i in range(options):
+        cur.execute("INSERT INTO poll_options (poll_id, option_text) VALUES (?, ?)", (poll_id, f"Option {i + 1}"))
+        option_ids.append(cur.lastrowid)
+    bets = [(poll_id, option_ids[i % options], telegram_id, amount + random.randint(0, amount)) for i, telegram_id in enumerate(bettor_ids)]
+    cur.executemany("INSERT INTO bets (poll_id, option_id, telegram_id, amount) VALUES (?, ?, ?, ?)", bets)
+    cur.execute("UPDATE poll_options SET total_bet = (SELECT IFNULL(SUM(amount), 0) FROM bets WHERE option_id = poll_options.id), bettors = (SELECT COUNT(*) FROM bets WHERE option_id = poll_options.id) WHERE poll_id = ?", (poll_id,))
+    cur.execute("UPDATE polls SET total_pool = (SELECT IFNULL(SUM(amount), 0) FROM bets WHERE poll_id = ?) WHERE id = ?", (poll_id, poll_id))
+    conn.commit()
+    return poll_id, option_ids
+
+
+def seed_dataset(conn, users: int, polls: int, options: int, bets_per_poll: int) -> dict:
+    """Типичный набор данных: пользователи и открытые опросы с уже сделанными ставками."""
+    user_ids = seed_users(conn, users)
+    open_polls = []
+    for i in range(polls):
+        bettors = random.sample(user_ids, min(bets_per_poll, len(user_ids)))
+        open_polls.append(seed_poll(conn, user_ids[i % len(user_ids)], options=options, bettor_ids=bettors))
+    return {"user_ids": user_ids, "polls": open_polls}
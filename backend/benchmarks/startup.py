@@ -0,0 +1,122 @@
+"""Время холодного старта веб-воркера.
+
+Каждый замер идет в новом процессе интерпретатора:
+- импорт: сколько занимает `import main` и какие тяжелые библиотеки
+  (aiogram, клиент Gemini, PIL) оказываются загружены к его концу;
+- готовность: uvicorn запускается с приложением, и /health опрашивается,
+  пока не ответит (API готов) и пока не сообщит bot=ready (модуль бота
+  загружен в фоне).
+
+Бот не подключается к Telegram (BOT_MODE=external), поэтому сеть не нужна.
+
+Запуск: `python -m benchmarks.startup --runs 5`
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import httpx
+
+from benchmarks.seed import use_temp_db
+from benchmarks.fake_telegram import BENCH_ENV
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+HEAVY_MODULES = ["aiogram", "google.generativeai", "PIL.Image", "bot"]
+
+IMPORT_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import main
+elapsed = time.perf_counter() - started
+print(json.dumps({"import": elapsed, "loaded": [m for m in %r if m in sys.modules]}))
+""" % (HEAVY_MODULES,)
+
+
+def bench_env() -> dict:
+    env = dict(os.environ, **BENCH_ENV)
+    env.update(BOT_MODE="external", BOT_UPDATE_MODE="polling", PYTHONUNBUFFERED="1")
+    return env
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def measure_import(env: dict) -> dict:
+    out = subprocess.run([sys.executable, "-c", IMPORT_PROBE], cwd=BACKEND_DIR, env=env, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def measure_ready(env: dict, timeout: float = 60.0) -> dict:
+    port = free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    result = {"health": None, "bot": None}
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=1.0) as client:
+            while time.perf_counter() - started < timeout and result["bot"] is None and server.poll() is None:
+                try:
+                    body = client.get("/health").json()
+                except httpx.TransportError:
+                    time.sleep(0.01)
+                    continue
+                now = time.perf_counter() - started
+                if result["health"] is None:
+                    result["health"] = now
+                if body.get("bot") == "ready":
+                    result["bot"] = now
+                elif body.get("bot") == "failed":
+                    break
+                time.sleep(0.01)
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+    return result
+
+
+def summary(name: str, values: list) -> str:
+    values = [v for v in values if v is not None]
+    if not values:
+        return f"{name:<28} нет данных"
+    return f"{name:<28} медиана {statistics.median(values) * 1000:>8.0f} мс   мин {min(values) * 1000:>8.0f}   макс {max(values) * 1000:>8.0f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    use_temp_db()
+    env = bench_env()
+    # Первый прогон прогревает кэш байткода и файловый кэш ОС, в статистику он не входит
+    measure_import(env)
+    imports, health, ready = [], [], []
+    loaded = []
+    for _ in range(args.runs):
+        probe = measure_import(env)
+        imports.append(probe["import"])
+        loaded = probe["loaded"]
+        timings = measure_ready(env)
+        health.append(timings["health"])
+        ready.append(timings["bot"])
+
+    print(f"Прогонов: {args.runs}")
+    print(summary("import main", imports))
+    print(summary("/health отвечает", health))
+    print(summary("бот загружен (bot=ready)", ready))
+    print(f"Загружены после import main: {', '.join(loaded) or 'ничего из ' + ', '.join(HEAVY_MODULES)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Сбор задержек и ожидания блокировки SQLite для отчетов бенчмарков."""
+import statistics
+import threading
+import time
+from contextlib import contextmanager
+
+import db
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(q / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class LatencyRecorder:
+    def __init__(self, name: str):
+        self.name = name
+        self.samples: list[float] = []
+        self.errors = 0
+        self.started = self.finished = 0.0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def measure(self):
+        started = time.perf_counter()
+        ok = True
+        try:
+            yield
+        except Exception:
+            ok = False
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.samples.append(elapsed)
+                self.errors += not ok
+
+    def fail(self):
+        with self._lock:
+            self.errors += 1
+
+    def add(self, elapsed: float, ok: bool = True):
+        with self._lock:
+            self.samples.append(elapsed)
+            self.errors += not ok
+
+    def row(self, lock_wait: float = 0.0) -> str:
+        values = sorted(self.samples)
+        wall = (self.finished - self.started) or sum(values) or 1e-9
+        ms = lambda seconds: seconds * 1000  # noqa: E731
+        return (f"{self.name:<22} {len(values):>6} {ms(statistics.fmean(values)) if values else 0:>8.2f} "
+                f"{ms(percentile(values, 50)):>8.2f} {ms(percentile(values, 95)):>8.2f} {ms(percentile(values, 99)):>8.2f} "
+                f"{len(values) / wall:>9.0f} {self.errors:>6} {ms(lock_wait):>10.1f}")
+
+    @staticmethod
+    def header() -> str:
+        return (f"{'операция':<22} {'n':>6} {'avg, мс':>8} {'p50':>8} {'p95':>8} {'p99':>8} "
+                f"{'оп/с':>9} {'ошибки':>6} {'ждали, мс':>10}")
+
+
+class LockWaitTracer:
+    """Суммирует время ожидания BEGIN IMMEDIATE на соединениях пула.
+
+    Трассировка SQLite сообщает о начале каждого оператора; время от начала
+    BEGIN IMMEDIATE до следующего оператора на том же соединении - это время
+    ожидания блокировки записи.
+    """
+
+    def __init__(self):
+        self.total = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def install(self):
+        tracer = self
+        original_connect = db.ConnectionPool._connect
+
+        def traced_connect(pool):
+            conn = original_connect(pool)
+            begun = {}
+
+            def trace(statement: str):
+                now = time.perf_counter()
+                started = begun.pop("at", None)
+                if started is not None:
+                    with tracer._lock:
+                        tracer.total += now - started
+                        tracer.count += 1
+                if statement.startswith("BEGIN IMMEDIATE"):
+                    begun["at"] = now
+
+            conn.set_trace_callback(trace)
+            return conn
+
+        db.ConnectionPool._connect = traced_connect
+        db.close_pool()
+
+    def take(self) -> float:
+        with self._lock:
+            total, self.total, self.count = self.total, 0.0, 0
+        return total
@@ -0,0 +1,82 @@
+"""Пропускная способность webhook-режима на поддельном Telegram.
+
+Пачки обновлений (нажатия кнопок ставок от разных пользователей) отправляются
+параллельно на эндпоинт webhook приложения FastAPI через ASGI, без сети.
+Сессия бота заменена на FakeSession, поэтому измеряется только наша обработка:
+прием, очередь, обработчики aiogram и запись в бд.
+
+Запуск: `python -m benchmarks.webhook_replay --updates 2000 --workers 8`
+"""
+import argparse
+import asyncio
+import os
+import time
+
+from benchmarks.seed import use_temp_db, seed_users, seed_poll
+from benchmarks.fake_telegram import BENCH_ENV, FakeSession, callback_update
+
+use_temp_db()
+os.environ.update(BENCH_ENV)
+os.environ.update(BOT_UPDATE_MODE="webhook", WEBHOOK_BASE_URL="https://bench.invalid", WEBHOOK_SECRET="bench-secret")
+
+
+async def replay(updates: int, batch: int, workers: int, latency: float, polls: int):
+    os.environ["WEBHOOK_WORKERS"] = str(workers)
+    import httpx
+    import db
+    import bot
+    import main
+    import webhook
+
+    db.init_db()
+    session = FakeSession(latency=latency)
+    bot.init_bot()
+    bot.bot.session = session
+    bot.update_queue.workers = workers
+    bot.update_queue.start()
+
+    with db.connection() as conn:
+        user_ids = seed_users(conn, updates)
+        poll_ids = [seed_poll(conn, user_ids[0], options=2) for _ in range(polls)]
+
+    payloads = []
+    for i, telegram_id in enumerate(user_ids):
+        poll_id, option_ids = poll_ids[i % polls]
+        data = f"bet:{poll_id}:{option_ids[i % 2]}:100"
+        payloads.append(callback_update(i + 1, telegram_id, int(bot.CHAT_ID), 10 + poll_id, data))
+
+    headers = {webhook.SECRET_HEADER: bot.WEBHOOK_SECRET}
+    rejected = 0
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        started = time.perf_counter()
+        for offset in range(0, len(payloads), batch):
+            responses = await asyncio.gather(*(client.post(bot.WEBHOOK_PATH, json=p, headers=headers) for p in payloads[offset:offset + batch]))
+            rejected += sum(1 for r in responses if r.status_code != 200)
+        accepted_at = time.perf_counter()
+        await bot.update_queue.join()
+        finished = time.perf_counter()
+    await bot.update_queue.stop()
+
+    with db.connection() as conn:
+        placed = conn.execute("SELECT COUNT(*) FROM bets").fetchone()[0]
+    elapsed = finished - started
+    print(f"Обновлений: {updates}, пачка: {batch}, обработчиков: {workers}, задержка Telegram: {latency * 1000:.0f} мс")
+    print(f"Прием: {accepted_at - started:.2f} с, обработка целиком: {elapsed:.2f} с, {updates / elapsed:.0f} обновлений/с")
+    print(f"Отклонено (503/ошибки): {rejected}, ставок записано: {placed}")
+    print(f"Вызовы Bot API: {dict(session.calls)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--batch", type=int, default=200, help="сколько обновлений отправляется одновременно")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.02, help="задержка ответа поддельного Telegram, с")
+    parser.add_argument("--polls", type=int, default=10)
+    args = parser.parse_args()
+    asyncio.run(replay(args.updates, args.batch, args.workers, args.latency, args.polls))
+
+
+if __name__ == "__main__":
+    main()
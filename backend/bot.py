@@ -1,20 +1,28 @@
 ﻿import os
 import asyncio
+import time
 from datetime import datetime, timedelta, timezone
 import httpx
-from aiogram import Bot, Dispatcher, types
+from aiogram import Bot, Dispatcher, Router, types
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 from aiogram.filters import Command
 from aiogram.types import Message, FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, PhotoSize
 from aiogram.utils.markdown import hbold
-from aiogram.exceptions import TelegramBadRequest
 from dotenv import load_dotenv
-import google.generativeai as genai
 import io
-from PIL import Image
 
 import db
+import adb
+from scheduler import Scheduler
+from edit_coalescer import EditCoalescer
+from webhook import UpdateQueue, WEBHOOK_PATH, WEBHOOK_SECRET
+from poll_events import hub as poll_events
+from ai_gateway import AIGateway, AI_BACKEND, AI_IMAGE_MAX_SIDE, GatewayBusy, RateLimited, make_backend
+import poll_render
+import backup
+import metrics
 from db import DB_PATH 
 
 # --- Конфигурация ---
@@ -24,8 +32,18 @@ CHAT_ID_STR = os.environ.get("CHAT_ID")
 ADMIN_IDS_STR = os.environ.get("ADMIN_IDS")
 BACKEND_URL = os.environ.get("BACKEND_URL")
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
+# Правки одной карточки опроса не чаще раза в EDIT_MIN_INTERVAL секунд, после паузы EDIT_DEBOUNCE на накопление ставок
+EDIT_MIN_INTERVAL = float(os.environ.get("EDIT_MIN_INTERVAL", "3"))
+EDIT_DEBOUNCE = float(os.environ.get("EDIT_DEBOUNCE", "0.5"))
+# polling: бот сам опрашивает Telegram; webhook: Telegram присылает обновления на WEBHOOK_PATH приложения FastAPI
+BOT_UPDATE_MODE = os.environ.get("BOT_UPDATE_MODE", "polling")
+WEBHOOK_BASE_URL = os.environ.get("WEBHOOK_BASE_URL") or BACKEND_URL
+WEBHOOK_QUEUE_SIZE = int(os.environ.get("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", "8"))
+# set_webhook вызывается при каждой смене лидера: сбрасывать накопившиеся обновления стоит только при первом развертывании
+WEBHOOK_DROP_PENDING_UPDATES = os.environ.get("WEBHOOK_DROP_PENDING_UPDATES") == "true"
 
-if not all([BOT_TOKEN, CHAT_ID_STR, ADMIN_IDS_STR, GEMINI_API_KEY]):
+if not all([BOT_TOKEN, CHAT_ID_STR, ADMIN_IDS_STR, GEMINI_API_KEY or AI_BACKEND == "fake"]):
     raise ValueError("Все необходимые переменные окружения (BOT_TOKEN, CHAT_ID, ADMIN_IDS, GEMINI_API_KEY) должны быть установлены")
 
 try:
@@ -34,80 +52,107 @@ try:
 except (ValueError, TypeError):
     raise ValueError("CHAT_ID и ADMIN_IDS должны быть числами")
 
+if BOT_UPDATE_MODE == "webhook" and not (WEBHOOK_BASE_URL and WEBHOOK_SECRET):
+    raise ValueError("В режиме webhook должны быть установлены WEBHOOK_BASE_URL (или BACKEND_URL) и WEBHOOK_SECRET")
+
 # --- Инициализация AI моделей Gemini ---
-genai.configure(api_key=GEMINI_API_KEY)
-text_model = genai.GenerativeModel('gemini-pro')
-vision_model = genai.GenerativeModel('gemini-pro-vision')
+# Все запросы к AI идут через шлюз: ограничение параллельности, лимиты на пользователя, кэш ответов.
+# Клиент Gemini и PIL загружаются при первом /ask или /describe, а не при старте
+ai = AIGateway(make_backend(AI_BACKEND, GEMINI_API_KEY))
 
 # --- Инициализация Бота ---
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher()
-
-# --- ФОРМАТИРОВАНИЕ СООБЩЕНИЙ ---
-def format_poll_text(poll_id: int) -> str | None:
-    poll = db.get_poll(poll_id)
-    if not poll: return None
-    
-    if poll['status'] == 'accepting_bets':
-        status = "🟢 СТАВКИ ПРИНИМАЮТСЯ"
-    elif poll['status'] == 'voting_closed':
-        status = "🔴 СТАВКИ ЗАКРЫТЫ"
-    else:
-        status = "🏁 ЗАВЕРШЕН"
-        
-    text = f"📊 <b>Опрос #{poll['id']}</b> | {status}\n\n"
-    text += f"<b>{poll['question']}</b>\n\n"
-    total_pool = sum(opt['total_bet'] for opt in poll['options'])
-    text += f"💰 Общий банк: {total_pool} монет\n\n"
-    text += "<b>Варианты и ставки:</b>\n"
-    bets = db.get_bets_for_poll(poll_id)
-    for i, opt in enumerate(poll['options'], 1):
-        text += f"  {i}. {opt['option_text']} ({opt['total_bet']} монет)\n"
-        bettors = [b for b in bets if b['option_id'] == opt['id']]
-        if bettors:
-            for bettor in bettors:
-                text += f"      <i>└ {bettor['username']}: {bettor['amount']} монет</i>\n"
-    
-    if poll['status'] == 'accepting_bets' and poll.get('closes_at'):
-        moscow_tz = timezone(timedelta(hours=3))
-        utc_closes_at = datetime.fromisoformat(poll['closes_at'])
-        msk_closes_at = utc_closes_at.astimezone(moscow_tz)
-        closes_at_str = msk_closes_at.strftime('%H:%M')
-        text += f"\n<i>Ставки закроются в {closes_at_str} по МСК</i>"
-        
-    return text
+# Обработчики регистрируются в роутере при импорте, а Bot и Dispatcher создаются в init_bot()
+router = Router()
+bot: Bot | None = None
+dp: Dispatcher | None = None
+update_queue: UpdateQueue | None = None
+poll_edits: EditCoalescer | None = None
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Замеряет длительность и ошибки каждого вызова Bot API."""
+
+    async def __call__(self, make_request, bot, method):
+        if not metrics.ENABLED:
+            return await make_request(bot, method)
+        # Выборкой прореживаются только замеры длительности, ошибки считаются все
+        sampled = metrics.sampled()
+        name = getattr(method, "__api_method__", type(method).__name__)
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            metrics.TELEGRAM_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            if sampled:
+                metrics.TELEGRAM_LATENCY.observe(time.perf_counter() - started, name)
+
+
+async def update_metrics_middleware(handler, event: types.Update, data):
+    with metrics.BOT_UPDATE_LATENCY.time(getattr(event, "event_type", "unknown")):
+        return await handler(event, data)
+
+
+def init_bot():
+    """Создает Bot, Dispatcher и очереди; повторные вызовы ничего не делают."""
+    global bot, dp, update_queue, poll_edits
+    if bot is not None:
+        return
+    bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    bot.session.middleware(TelegramMetricsMiddleware())
+    dp = Dispatcher()
+    dp.update.outer_middleware(update_metrics_middleware)
+    dp.include_router(router)
+    update_queue = UpdateQueue(dp, bot, maxsize=WEBHOOK_QUEUE_SIZE, workers=WEBHOOK_WORKERS)
+    poll_edits = EditCoalescer(bot, min_interval=EDIT_MIN_INTERVAL, debounce=EDIT_DEBOUNCE)
 
 # --- ОТПРАВКА И ОБРАБОТКА КНОПОК ---
-async def send_new_poll_notification(poll_id: int):
-    text = format_poll_text(poll_id)
-    poll = db.get_poll(poll_id)
-    if not text or not poll: return
-    fixed_bets = [100, 200, 500]
+FIXED_BETS = [100, 200, 500]
+
+def build_poll_keyboard(poll: dict) -> InlineKeyboardMarkup:
     keyboard_rows = []
     for option in poll['options']:
-        button_row = [InlineKeyboardButton(text=f"{option['option_text']} - {amount}", callback_data=f"bet:{poll['id']}:{option['id']}:{amount}") for amount in fixed_bets]
+        button_row = [InlineKeyboardButton(text=f"{option['option_text']} - {amount}", callback_data=f"bet:{poll['id']}:{option['id']}:{amount}") for amount in FIXED_BETS]
         keyboard_rows.append(button_row)
-    keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_rows)
-    sent_message = await bot.send_message(chat_id=CHAT_ID, text=text, reply_markup=keyboard)
-    db.set_poll_message_id(poll_id, sent_message.message_id)
+    return InlineKeyboardMarkup(inline_keyboard=keyboard_rows)
+
+def request_poll_card_update(poll_id: int, message_id: int, chat_id: int = CHAT_ID):
+    """Ставит правку карточки опроса в очередь; частые обновления склеиваются в одну правку.
+
+    Правки отправляет только лидер (процесс с работающим планировщиком): склейка
+    правок у каждого процесса своя, и правки из нескольких воркеров превысили бы
+    лимит Telegram. В остальных процессах опрос уже изменен в бд, и лидер
+    заметит его новую версию в poll_card_watch_job.
+    """
+    poll_events.notify(poll_id)
+    if not scheduler.running:
+        return
+    async def render():
+        poll, text = await adb.run(poll_render.poll_card, poll_id)
+        if not poll: return None, None
+        keyboard = build_poll_keyboard(poll) if poll['status'] == 'accepting_bets' else None
+        return text, keyboard
+    poll_edits.request(chat_id, message_id, render)
 
-@dp.callback_query(lambda c: c.data and c.data.startswith('bet:'))
+async def send_new_poll_notification(poll_id: int):
+    poll_events.notify(poll_id)
+    poll, text = await adb.run(poll_render.poll_card, poll_id)
+    if not text or not poll: return
+    if poll.get('closes_at'):
+        arm_poll_close(datetime.fromisoformat(poll['closes_at']))
+    sent_message = await bot.send_message(chat_id=CHAT_ID, text=text, reply_markup=build_poll_keyboard(poll))
+    await adb.set_poll_message_id(poll_id, sent_message.message_id)
+
+@router.callback_query(lambda c: c.data and c.data.startswith('bet:'))
 async def process_bet_callback(query: CallbackQuery):
     try:
         _, poll_id_str, option_id_str, amount_str = query.data.split(':')
         poll_id, option_id, amount, telegram_id, username = int(poll_id_str), int(option_id_str), int(amount_str), query.from_user.id, query.from_user.username or f"user{query.from_user.id}"
-        db.ensure_user(telegram_id, username)
-        result = db.place_bet(telegram_id, poll_id, option_id, amount)
+        result = await adb.place_user_bet(telegram_id, username, poll_id, option_id, amount)
         if result.get("ok"):
             await query.answer(f"✅ Ваша ставка в {amount} монет принята!", show_alert=False)
-            await asyncio.sleep(0.5) 
-            new_text = format_poll_text(poll_id)
-            if new_text:
-                try:
-                    await bot.edit_message_text(text=new_text, chat_id=query.message.chat.id, message_id=query.message.message_id, reply_markup=query.message.reply_markup)
-                except TelegramBadRequest as e:
-                    if "message is not modified" in e.message: print(f"Сообщение для опроса #{poll_id} не изменилось.")
-                    else: raise e
+            request_poll_card_update(poll_id, query.message.message_id, query.message.chat.id)
         else:
             await query.answer(f"❌ Ошибка: {result.get('error')}", show_alert=True)
     except Exception as e:
@@ -115,22 +160,22 @@ async def process_bet_callback(query: CallbackQuery):
         await query.answer("Произошла ошибка при обработке ставки.", show_alert=True)
 
 # --- КОМАНДЫ БОТА ---
-@dp.message(Command("bet"))
+@router.message(Command("bet"))
 async def create_poll_command(message: Message):
     try:
         lines = message.text.strip().split('\n')
         if len(lines) < 3: raise ValueError("Invalid format")
         question, options = lines[1], lines[2:]
         if len(options) < 2: raise ValueError("Minimum 2 options required.")
-        db.ensure_user(message.from_user.id, message.from_user.username or f"user{message.from_user.id}")
-        poll_id = db.create_poll(message.from_user.id, question, options)
+        await adb.ensure_user(message.from_user.id, message.from_user.username or f"user{message.from_user.id}")
+        poll_id = await adb.create_poll(message.from_user.id, question, options)
         await send_new_poll_notification(poll_id)
     except (ValueError, IndexError):
         await message.reply("❌ <b>Неверный формат.</b>\nИспользуйте многострочный формат:\n<code>/bet\nВопрос\nВариант 1\nВариант 2</code>")
     except Exception as e:
         await message.reply(f"Произошла ошибка: {e}")
 
-@dp.message(Command("close"))
+@router.message(Command("close"))
 async def close_poll_command(message: Message):
     try:
         args = message.text.split(maxsplit=2)
@@ -140,7 +185,7 @@ async def close_poll_command(message: Message):
         poll_id = int(args[1])
         winner_identifier = args[2]
 
-        poll = db.get_poll(poll_id)
+        poll = await adb.get_poll(poll_id)
         if not poll:
             return await message.reply("Опрос с таким ID не найден.")
 
@@ -160,7 +205,7 @@ async def close_poll_command(message: Message):
         if winning_option_id is None:
             return await message.reply("Не удалось найти указанный вариант ответа.")
 
-        result = db.close_poll(message.from_user.id, poll_id, winning_option_id)
+        result = await adb.close_poll(message.from_user.id, poll_id, winning_option_id)
         
         if not result.get("ok"):
             return await message.reply(f"❌ {result.get('error')}")
@@ -177,31 +222,34 @@ async def close_poll_command(message: Message):
         await bot.send_message(CHAT_ID, response_text)
         
         if poll.get('message_id'):
-            final_text = format_poll_text(poll_id)
-            if final_text:
-                await bot.edit_message_text(final_text, CHAT_ID, poll['message_id'], reply_markup=None)
+            request_poll_card_update(poll_id, poll['message_id'])
 
     except ValueError:
         await message.reply("❌ ID опроса должен быть числом.")
     except Exception as e:
         await message.reply(f"Произошла непредвиденная ошибка: {e}")
 
-@dp.message(Command("winrate"))
+WINRATE_TOP_SIZE = 20
+
+@router.message(Command("winrate"))
 async def winrate_command(message: Message):
-    rating = db.get_rating()
-    text = "🏆 <b>Рейтинг всех игроков по проценту побед:</b>\n\n"
+    rating = await adb.get_rating(limit=WINRATE_TOP_SIZE)
+    text = f"🏆 <b>Топ-{WINRATE_TOP_SIZE} игроков по проценту побед:</b>\n\n"
     if not rating:
         text += "Пока нет данных для рейтинга."
     else:
-        for i, user in enumerate(rating, 1):
-            text += f"{i}. <b>{user['username']}</b> - {user['winrate']}% ({user['wins']} W / {user['losses']} L)\n"
+        for user in rating:
+            text += f"{user['rank']}. <b>{user['username']}</b> - {user['winrate']}% ({user['wins']} W / {user['losses']} L)\n"
+        me = await adb.get_user_rank(message.from_user.id)
+        if me and me['rank'] > WINRATE_TOP_SIZE:
+            text += f"\n<i>Ваше место: {me['rank']} из {me['total']} - {me['winrate']}% ({me['wins']} W / {me['losses']} L)</i>"
     await message.answer(text)
 
-@dp.message(Command("allpolls"))
+@router.message(Command("allpolls"))
 async def list_all_polls_command(message: Message):
     if message.from_user.id not in ADMIN_IDS: return
     try:
-        all_polls = db.list_all_polls()
+        all_polls = await adb.list_all_polls()
         if not all_polls: return await message.reply("В базе данных пока нет ни одного опроса.")
         response_text = "📋 <b>Полный список всех опросов:</b>\n\n"
         for poll in all_polls:
@@ -216,7 +264,7 @@ async def list_all_polls_command(message: Message):
     except Exception as e:
         await message.reply(f"Произошла ошибка: {e}")
         
-@dp.message(Command("addcoins"))
+@router.message(Command("addcoins"))
 async def add_coins_command(message: Message):
     if message.from_user.id not in ADMIN_IDS: return
     try:
@@ -225,10 +273,10 @@ async def add_coins_command(message: Message):
         target_username = args[1].replace('@', '')
         amount = int(args[2])
         if amount <= 0: return await message.reply("Сумма должна быть положительной.")
-        target_user = db.get_user_by_username(target_username)
+        target_user = await adb.get_user_by_username(target_username)
         if not target_user: return await message.reply(f"❌ Пользователь с ником @{target_username} не найден в базе.")
         target_user_id = target_user['telegram_id']
-        result = db.add_balance(target_user_id, amount)
+        result = await adb.add_balance(target_user_id, amount)
         if result.get("ok"):
             updated_user = result.get("user")
             await message.reply(f"✅ Успешно!\nПользователю: @{updated_user['username']}\nНачислено: {amount} монет\nНовый баланс: {updated_user['balance']} монет.")
@@ -239,111 +287,225 @@ async def add_coins_command(message: Message):
     except Exception as e:
         await message.reply(f"Произошла непредвиденная ошибка: {e}")
 
-@dp.message(Command("uploaddb"))
+@router.message(Command("checktotals"))
+async def check_totals_command(message: Message):
+    if message.from_user.id not in ADMIN_IDS: return
+    rebuild = message.text.split()[1:2] == ["fix"]
+    result = await adb.check_poll_totals(rebuild=rebuild)
+    if not result.get("ok"):
+        return await message.reply(f"❌ Ошибка: {result.get('error')}")
+    mismatched = result["mismatched"]
+    if not mismatched:
+        return await message.reply("✅ Суммы ставок во всех опросах сходятся.")
+    ids = ", ".join(str(poll_id) for poll_id in mismatched)
+    if result["rebuilt"]:
+        await message.reply(f"🛠️ Суммы пересчитаны для опросов: {ids}")
+    else:
+        await message.reply(f"⚠️ Расхождения в опросах: {ids}\nДля пересчета используйте <code>/checktotals fix</code>")
+
+@router.message(Command("uploaddb"))
 async def upload_db_command(message: Message):
     if message.from_user.id not in ADMIN_IDS: return
-    if not message.document: return await message.reply("Пожалуйста, прикрепите файл `tg_miniapp.db` к этой команде.")
-    if message.document.file_name != 'tg_miniapp.db': return await message.reply(f"Неверное имя файла. Ожидается `tg_miniapp.db`, получен `{message.document.file_name}`.")
+    if not message.document: return await message.reply("Пожалуйста, прикрепите файл базы данных (.db или копию .db.gz) к этой команде.")
+    file_name = message.document.file_name or ""
+    if not file_name.endswith((".db", ".db.gz")): return await message.reply(f"Неверный файл. Ожидается `.db` или `.db.gz`, получен `{file_name}`.")
+    upload = backup.upload_path(file_name)
     try:
         await message.reply("Начинаю загрузку файла...")
-        await bot.download(message.document, destination=DB_PATH)
-        await message.reply("✅ Файл базы данных успешно загружен и заменен! Рекомендую перезапустить сервис на Render.")
+        await bot.download(message.document, destination=upload)
+        await message.reply("Файл загружен, проверяю и восстанавливаю базу данных...")
+        # Проверка и переливание данных идут в отдельном потоке; запросы к бд на это время коротко приостанавливаются
+        version = await asyncio.to_thread(backup.restore_backup, upload)
+        poll_render.invalidate()
+        adb.known_users.invalidate()
+        await message.reply(f"✅ База данных восстановлена из копии (схема {version}), перезапуск не нужен.")
+    except ValueError as e:
+        await message.reply(f"❌ Копия отклонена: {e}")
     except Exception as e:
-        await message.reply(f"❌ Произошла ошибка при загрузке файла: {e}")
+        await message.reply(f"❌ Произошла ошибка при восстановлении базы данных: {e}")
+    finally:
+        backup.remove_backup(upload)
 
-@dp.message(Command("getdb"))
+@router.message(Command("getdb"))
 async def get_db_command(message: Message):
     if message.from_user.id not in ADMIN_IDS: return
     try:
         if os.path.exists(DB_PATH):
-            db_file = FSInputFile(DB_PATH)
-            await message.reply_document(db_file, caption="Вот текущая база данных.")
+            # Снимок и сжатие идут в отдельном потоке, чтобы не задерживать обработку ставок
+            backup_path = await asyncio.to_thread(backup.create_backup)
+            try:
+                await message.reply_document(FSInputFile(backup_path), caption="Вот текущая база данных (снимок, сжатый gzip).")
+            finally:
+                backup.remove_backup(backup_path)
         else:
             await message.reply("Файл базы данных не найден на сервере.")
     except Exception as e:
         await message.reply(f"Произошла ошибка при отправке файла: {e}")
 
-@dp.message(Command("ask"))
+@router.message(Command("ask"))
 async def ask_ai_command(message: Message):
     prompt = message.text.replace("/ask", "").strip()
     if not prompt: return await message.reply("Пожалуйста, напишите ваш вопрос после команды /ask.")
     thinking_message = None
     try:
         thinking_message = await message.reply("🧠 Думаю...")
-        response = await text_model.generate_content_async(prompt)
-        if response.parts:
-            await thinking_message.edit_text(response.text)
+        answer = await ai.ask(message.from_user.id, prompt)
+        if answer is not None:
+            await thinking_message.edit_text(answer)
         else:
             await thinking_message.edit_text("Не удалось получить ответ от AI. Возможно, сработали фильтры безопасности.")
+    except (RateLimited, GatewayBusy) as e:
+        if thinking_message: await thinking_message.edit_text(f"⏳ {e}")
+        else: await message.reply(f"⏳ {e}")
     except Exception as e:
         error_text = f"❌ Произошла детальная ошибка:\n\n<code>{e}</code>"
         if thinking_message: await thinking_message.edit_text(error_text)
         else: await message.reply(error_text)
 
-@dp.message(Command("describe"))
+@router.message(Command("describe"))
 async def describe_image_command(message: Message):
     if not message.photo: return await message.reply("Пожалуйста, прикрепите изображение к команде /describe.")
     prompt = message.caption.replace("/describe", "").strip() if message.caption else "Опиши, что на этой картинке."
     thinking_message = None
     try:
         thinking_message = await message.reply("🖼️ Анализирую изображение...")
-        photo: PhotoSize = message.photo[-1] 
-        photo_bytes_io = io.BytesIO()
-        await bot.download(photo, destination=photo_bytes_io)
-        photo_bytes_io.seek(0)
-        img = Image.open(photo_bytes_io)
-        response = await vision_model.generate_content_async([prompt, img])
-        if response.parts:
-            await thinking_message.edit_text(response.text)
+        # Оригинал модели не нужен: берем наименьший размер, который еще не меньше того, до чего шлюз уменьшит картинку
+        photo: PhotoSize = next((p for p in message.photo if max(p.width, p.height) >= AI_IMAGE_MAX_SIDE), message.photo[-1])
+
+        async def load_photo() -> bytes:
+            photo_bytes_io = io.BytesIO()
+            await bot.download(photo, destination=photo_bytes_io)
+            return photo_bytes_io.getvalue()
+
+        answer = await ai.describe(message.from_user.id, prompt, photo.file_unique_id, load_photo)
+        if answer is not None:
+            await thinking_message.edit_text(answer)
         else:
             await thinking_message.edit_text("Не удалось получить ответ от AI. Возможно, изображение было заблокировано фильтрами безопасности.")
+    except (RateLimited, GatewayBusy) as e:
+        if thinking_message: await thinking_message.edit_text(f"⏳ {e}")
+        else: await message.reply(f"⏳ {e}")
     except Exception as e:
         error_text = f"❌ Произошла детальная ошибка:\n\n<code>{e}</code>"
         if thinking_message: await thinking_message.edit_text(error_text)
         else: await message.reply(error_text)
 
 # --- ФОНОВЫЕ ЗАДАЧИ ---
-last_backup_time = None
-async def scheduler():
-    global last_backup_time
-    print("--- Планировщик запущен ---")
-    while True:
-        await asyncio.sleep(60 * 10)
-        if BACKEND_URL:
-            try:
-                async with httpx.AsyncClient() as client:
-                    await client.get(f"{BACKEND_URL}/health")
-                print(f"[{datetime.now().strftime('%H:%M:%S')}] Пинг самого себя для поддержания активности прошел успешно.")
-            except Exception as e:
-                print(f"Ошибка само-пинга: {e}")
-        now_msk = datetime.now(timezone(timedelta(hours=3)))
-        if last_backup_time is None or (now_msk.hour == 9 and last_backup_time.date() != now_msk.date()):
-            try:
-                print("--- Создание ежедневной резервной копии... ---")
-                if os.path.exists(DB_PATH):
-                    backup_file = FSInputFile(DB_PATH)
-                    backup_caption = f"🗓️ Резервная копия бд\nот {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-                    await bot.send_document(chat_id=ADMIN_IDS[0], document=backup_file, caption=backup_caption)
-                    last_backup_time = now_msk
-                    print("✅ Резервная копия успешно отправлена.")
-                else:
-                    print("⚠️ Файл бд не найден для создания бэкапа.")
-            except Exception as e:
-                print(f"❌ Ошибка при создании бэкапа: {e}")
+SELF_PING_INTERVAL = 60 * 10
+BACKUP_HOUR_MSK = 9
+# Старые записи журнала сворачиваются в дневные итоги ночью, когда ставок почти нет
+LEDGER_COMPACT_HOUR_MSK = 4
+# Страховочный обход на случай, если закрытие опроса не было запланировано
+AUTO_CLOSE_SWEEP_INTERVAL = 60 * 5
+# Опросы создаются и в других процессах (воркеры в режиме webhook): лидер замечает их по polls_version
+POLL_CLOSE_WATCH_INTERVAL = float(os.environ.get("POLL_CLOSE_WATCH_INTERVAL", "2"))
+# Как часто лидер проверяет, не изменились ли опросы (ставки в других воркерах), чтобы поправить их карточки
+POLL_CARD_WATCH_INTERVAL = float(os.environ.get("POLL_CARD_WATCH_INTERVAL", "1"))
+MOSCOW_TZ = timezone(timedelta(hours=3))
+
+scheduler = Scheduler()
+
+async def self_ping_job():
+    async with httpx.AsyncClient() as client:
+        await client.get(f"{BACKEND_URL}/health")
+    print(f"[{datetime.now().strftime('%H:%M:%S')}] Пинг самого себя для поддержания активности прошел успешно.")
+
+async def backup_job():
+    print("--- Создание ежедневной резервной копии... ---")
+    if os.path.exists(DB_PATH):
+        backup_path = await asyncio.to_thread(backup.create_backup)
         try:
-            polls_to_close = db.auto_close_due_polls()
-            for poll in polls_to_close:
-                try:
-                    new_text = format_poll_text(poll['id'])
-                    if poll.get('message_id') and new_text:
-                        await bot.edit_message_text(new_text, CHAT_ID, poll['message_id'], reply_markup=None)
-                except Exception as e:
-                    print(f"Не удалось обновить сообщение для опроса #{poll['id']}: {e}")
-        except Exception as e:
-            print(f"Ошибка в планировщике (закрытие опросов): {e}")
+            backup_caption = f"🗓️ Резервная копия бд\nот {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+            await bot.send_document(chat_id=ADMIN_IDS[0], document=FSInputFile(backup_path), caption=backup_caption)
+        finally:
+            backup.remove_backup(backup_path)
+        print("✅ Резервная копия успешно отправлена.")
+    else:
+        print("⚠️ Файл бд не найден для создания бэкапа.")
+
+async def ledger_compaction_job():
+    result = await adb.compact_ledger()
+    print(f"🧾 Журнал свернут в дневные итоги: {result['compacted']} записей.")
+
+def daily_at(hour_msk: int):
+    """Расписание для scheduler.schedule: ежедневно в hour_msk:00 по МСК."""
+    def next_run(after: float) -> float:
+        after_msk = datetime.fromtimestamp(after, MOSCOW_TZ)
+        run_at = after_msk.replace(hour=hour_msk, minute=0, second=0, microsecond=0)
+        if run_at <= after_msk:
+            run_at += timedelta(days=1)
+        return run_at.timestamp()
+    return next_run
+
+async def auto_close_job():
+    polls_to_close = await adb.auto_close_due_polls()
+    for poll in polls_to_close:
+        if poll.get('message_id'):
+            request_poll_card_update(poll['id'], poll['message_id'])
+    arm_poll_close(await adb.next_poll_close_at())
+
+def arm_poll_close(closes_at: datetime | None):
+    """Ставит закрытие опросов точно на closes_at, если на это время закрытие еще не запланировано.
+
+    Работает только в процессе, где запущен планировщик (лидер); опросы из
+    других процессов лидер подхватывает в poll_close_watch_job.
+    """
+    if closes_at is None or not scheduler.running:
+        return
+    run_at = closes_at.timestamp()
+    if not scheduler.has_job_before("auto_close", run_at):
+        scheduler.call_at(run_at, "auto_close", auto_close_job)
+
+_watched_polls_version: int | None = None
+
+async def poll_close_watch_job():
+    global _watched_polls_version
+    version = (await adb.get_versions("polls_version"))["polls_version"]
+    if version != _watched_polls_version:
+        _watched_polls_version = version
+        arm_poll_close(await adb.next_poll_close_at())
+
+# poll_id -> (версия, message_id) карточек, которые видел лидер; message_id помнится, потому что
+# у разрешенного опроса он в бд уже сброшен, а финальную карточку поправить нужно
+_card_versions: dict[int, tuple[int, int]] = {}
+_card_watch_key: tuple | None = None
+
+async def poll_card_watch_job():
+    global _card_watch_key
+    # Имена в карточках меняются с users_version, суммы и статус - с polls_version
+    versions = await adb.get_versions("polls_version", "users_version")
+    key = (versions["polls_version"], versions["users_version"])
+    if key == _card_watch_key:
+        return
+    first_run = _card_watch_key is None
+    _card_watch_key = key
+    polls = await adb.get_poll_card_versions(list(_card_versions))
+    for poll_id in _card_versions.keys() - polls.keys():
+        del _card_versions[poll_id]
+    for poll_id, poll in polls.items():
+        known = _card_versions.get(poll_id)
+        message_id = poll["message_id"] or (known[1] if known else None)
+        if poll["status"] == "resolved":
+            _card_versions.pop(poll_id, None)
+        elif message_id:
+            _card_versions[poll_id] = (poll["version"], message_id)
+        # При запуске лидера карточки считаются актуальными
+        if first_run or not message_id or (known and known[0] == poll["version"]):
+            continue
+        request_poll_card_update(poll_id, message_id)
+
+def setup_scheduler():
+    if BACKEND_URL:
+        scheduler.every(SELF_PING_INTERVAL, "self_ping", self_ping_job)
+    scheduler.schedule("backup", backup_job, daily_at(BACKUP_HOUR_MSK), first_run=time.time() + 60 * 10)
+    scheduler.schedule("ledger_compaction", ledger_compaction_job, daily_at(LEDGER_COMPACT_HOUR_MSK))
+    scheduler.every(AUTO_CLOSE_SWEEP_INTERVAL, "auto_close_sweep", auto_close_job, first_delay=0)
+    scheduler.every(POLL_CLOSE_WATCH_INTERVAL, "poll_close_watch", poll_close_watch_job)
+    scheduler.every(POLL_CARD_WATCH_INTERVAL, "poll_card_watch", poll_card_watch_job, first_delay=0)
 
 # --- ЗАПУСК БОТА ---
 async def start_bot():
+    init_bot()
     try:
         me = await bot.get_me()
         print(f"--- Бот @{me.username} успешно авторизован ---")
@@ -351,10 +513,22 @@ async def start_bot():
         print(f"!!! КРИТИЧЕСКАЯ ОШИБКА: Не удалось подключиться к Telegram. Проверьте BOT_TOKEN. Ошибка: {e}")
         return
     print("--- Запуск планировщика и опроса Telegram ---")
-    asyncio.create_task(scheduler())
+    setup_scheduler()
+    scheduler_task = asyncio.create_task(scheduler.run())
     try:
-        await dp.start_polling(bot, skip_updates=True)
+        if BOT_UPDATE_MODE == "webhook":
+            # Обновления принимают веб-воркеры, лидер только регистрирует webhook и держит планировщик
+            await bot.set_webhook(f"{WEBHOOK_BASE_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET, allowed_updates=dp.resolve_used_update_types(), drop_pending_updates=WEBHOOK_DROP_PENDING_UPDATES)
+            print(f"--- Webhook зарегистрирован: {WEBHOOK_BASE_URL}{WEBHOOK_PATH} ---")
+            await asyncio.Event().wait()
+        else:
+            await bot.delete_webhook()
+            # Сигналы остаются у веб-воркера: иначе SIGTERM остановит только опрос, а воркер продолжит работу без лидера
+            await dp.start_polling(bot, skip_updates=True, handle_signals=False)
     except Exception as e:
         print(f"!!! КРИТИЧЕСКАЯ ОШИБКА: Бот упал во время работы с ошибкой: {e}")
     finally:
+        # Блокировка лидера освобождается после возврата, и задачи планировщика не должны пережить ее
+        scheduler_task.cancel()
+        await asyncio.gather(scheduler_task, return_exceptions=True)
         print("!!! Бот ЗАВЕРШИЛ работу.")
\ No newline at end of file
@@ -0,0 +1,30 @@
+"""Запуск Telegram-бота и планировщика отдельным процессом.
+
+В этом режиме веб-воркеры запускаются с BOT_MODE=external и только обслуживают
+HTTP, а опрос Telegram, бэкапы и автозакрытие опросов выполняются здесь:
+    python bot_runner.py
+Общая база SQLite работает в режиме WAL, поэтому процессы читают параллельно.
+"""
+import asyncio
+
+import db
+import bot
+import metrics
+from leader import LeaderLock, run_as_leader
+
+
+async def main():
+    # Бд пересоздает веб-сервер (RECREATE_DB_ON_STARTUP): он открывает ее первым и в одном процессе
+    db.init_db(recreate=False)
+    # С тем же METRICS_DIR, что у веб-воркеров, метрики бота и планировщика попадают в их /metrics
+    metrics_task = asyncio.create_task(metrics.flush_periodically())
+    try:
+        await run_as_leader(LeaderLock(), bot.start_bot)
+    finally:
+        metrics_task.cancel()
+        await asyncio.gather(metrics_task, return_exceptions=True)
+        db.close_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
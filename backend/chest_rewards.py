@@ -0,0 +1,72 @@
+"""Таблица наград сундуков в памяти.
+
+Определения сундуков (цена, награды и их веса) разбираются один раз и
+превращаются в выборку методом псевдонимов (alias method, алгоритм Воуза):
+одна награда выбирается за O(1) - одно случайное число для ячейки и одно для
+монетки, без прохода по весам при каждом открытии.
+
+Таблица помечается версией из бд (счетчик chests_version) и перестраивается,
+когда сундуки меняются, в том числе из другого процесса.
+"""
+import random
+import threading
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+
+class AliasSampler:
+    def __init__(self, values: Sequence[int], weights: Sequence[float]):
+        if not values or len(values) != len(weights):
+            raise ValueError("Награды и веса должны быть непустыми списками одинаковой длины")
+        total = float(sum(weights))
+        if total <= 0 or any(w < 0 for w in weights):
+            raise ValueError("Веса наград должны быть неотрицательными и не все нулевыми")
+        n = len(values)
+        self.values = list(values)
+        self._prob = [0.0] * n
+        self._alias = list(range(n))
+        scaled = [w * n / total for w in weights]
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self._prob[s] = scaled[s]
+            self._alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            (small if scaled[l] < 1.0 else large).append(l)
+        # Остатки из-за погрешности округления равны 1
+        for i in small + large:
+            self._prob[i] = 1.0
+
+    def sample(self, rng: random.Random = random) -> int:
+        i = rng.randrange(len(self.values))
+        return self.values[i] if rng.random() < self._prob[i] else self.values[self._alias[i]]
+
+    def sample_many(self, count: int, rng: random.Random = random) -> List[int]:
+        return [self.sample(rng) for _ in range(count)]
+
+
+class ChestTable:
+    def __init__(self):
+        self._chests: Dict[int, Tuple[int, AliasSampler]] = {}
+        self._lock = threading.Lock()
+        self.loaded = False
+        self.version = 0
+
+    def load(self, rows: Iterable[Tuple[int, int, dict]], version: int = 0):
+        """Перестраивает таблицу из строк (id, цена, {"rewards": [...], "weights": [...]})."""
+        chests = {chest_id: (price, AliasSampler(rewards["rewards"], rewards["weights"])) for chest_id, price, rewards in rows}
+        with self._lock:
+            self._chests = chests
+            self.version = version
+            self.loaded = True
+
+    def is_current(self, version: int) -> bool:
+        return self.loaded and self.version == version
+
+    def invalidate(self):
+        with self._lock:
+            self.loaded = False
+
+    def get(self, chest_id: int) -> Tuple[int, AliasSampler] | None:
+        """(цена, выборка наград) сундука или None, если такого нет."""
+        return self._chests.get(chest_id)
@@ -1,30 +1,215 @@
 import sqlite3
 from pathlib import Path
-import random
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Sequence
 import json
+import re
 import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
 
-DB_PATH = Path(__file__).resolve().parent.parent / "tg_miniapp.db"
+import metrics
+from leaderboard import Leaderboard, winrate
+from chest_rewards import ChestTable
+import ledger
 
+DB_PATH = Path(os.environ.get("DB_PATH") or Path(__file__).resolve().parent.parent / "tg_miniapp.db")
 
-def get_conn():
-    conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA foreign_keys = ON;")
-    return conn
+# --- Пул соединений ---
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "4"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "30"))
+# Соединение, простоявшее без дела дольше этого времени, перед выдачей проверяется запросом SELECT 1
+DB_HEALTHCHECK_INTERVAL = float(os.environ.get("DB_HEALTHCHECK_INTERVAL", "30"))
+# Сколько всего запись ждет блокировку; делится поровну между первой попыткой BEGIN IMMEDIATE и повторами,
+# так что повторы только показывают конкуренцию в метриках, а не продлевают ожидание
+DB_BUSY_TIMEOUT = float(os.environ.get("DB_BUSY_TIMEOUT", "30"))
+DB_BUSY_RETRIES = int(os.environ.get("DB_BUSY_RETRIES", "2"))
+# Сколько запись ждет окончания восстановления из копии в другом процессе; более старый флаг считается брошенным
+DB_RESTORE_WAIT = float(os.environ.get("DB_RESTORE_WAIT", "600"))
 
+# Выполняются один раз при открытии соединения, а не на каждый запрос
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode = WAL;",
+    "PRAGMA synchronous = NORMAL;",
+    "PRAGMA foreign_keys = ON;",
+    f"PRAGMA mmap_size = {int(os.environ.get('DB_MMAP_SIZE', 64 * 1024 * 1024))};",
+    f"PRAGMA cache_size = {int(os.environ.get('DB_CACHE_SIZE', -16000))};",
+    "PRAGMA temp_store = MEMORY;",
+)
 
-def init_db():
-    if os.environ.get("RECREATE_DB_ON_STARTUP") == "true":
-        if os.path.exists(DB_PATH):
-            os.remove(DB_PATH)
-            print("✅ Старая база данных удалена для принудительного пересоздания.")
 
-    conn = get_conn()
-    cur = conn.cursor()
+class ConnectionPool:
+    """Ограниченный пул долгоживущих соединений SQLite.
+
+    Соединения создаются лениво (не больше `size` одновременно), настраиваются
+    один раз и возвращаются в пул после использования. Незавершенная транзакция
+    при возврате откатывается, сломанные соединения отбрасываются.
+    """
+
+    def __init__(self, path: Path, size: int = DB_POOL_SIZE, timeout: float = DB_POOL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        # Сброшен, пока пул приостановлен (например, на время восстановления бд из копии)
+        self._open = threading.Event()
+        self._open.set()
+        self._paused_slots = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT / (DB_BUSY_RETRIES + 1), isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    @staticmethod
+    def _is_healthy(conn: sqlite3.Connection) -> bool:
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def acquire(self) -> sqlite3.Connection:
+        if not self._open.wait(timeout=self.timeout):
+            raise TimeoutError("База данных временно недоступна: идет восстановление")
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError("Нет свободных соединений с базой данных")
+        try:
+            while True:
+                try:
+                    conn, released_at = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._connect()
+                if time.monotonic() - released_at < DB_HEALTHCHECK_INTERVAL or self._is_healthy(conn):
+                    return conn
+                conn.close()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn: sqlite3.Connection):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put((conn, time.monotonic()))
+        except sqlite3.Error:
+            conn.close()
+        finally:
+            self._slots.release()
+
+    def pause(self, timeout: float | None = None):
+        """Перестает выдавать соединения, дожидается возврата уже выданных и закрывает все соединения пула.
+
+        Новые запросы ждут resume() (не дольше timeout пула). Вызывающий поток не должен сам держать соединение из пула.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        self._open.clear()
+        taken = 0
+        try:
+            for _ in range(self.size):
+                if not self._slots.acquire(timeout=max(0.0, deadline - time.monotonic())):
+                    raise TimeoutError("Не дождались завершения текущих запросов к базе данных")
+                taken += 1
+        except Exception:
+            for _ in range(taken):
+                self._slots.release()
+            self._open.set()
+            raise
+        self._paused_slots = taken
+        self.close_all()
+
+    def resume(self):
+        """Снова выдает соединения; они открываются заново, по мере надобности."""
+        for _ in range(self._paused_slots):
+            self._slots.release()
+        self._paused_slots = 0
+        self._open.set()
+
+    def close_all(self):
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            conn.close()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+
+_pool: ConnectionPool | None = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DB_PATH)
+    return _pool
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close_all()
+            _pool = None
+
+
+@contextmanager
+def connection():
+    with get_pool().connection() as conn:
+        yield conn
+
+
+def restore_flag_path() -> Path:
+    """Файл-флаг восстановления из копии (backup.restore_backup): пока он есть, запись во всех процессах ждет."""
+    return Path(f"{DB_PATH}.restore")
+
 
+def _wait_for_restore():
+    # Переливание копии держит блокировку записи дольше busy timeout; без флага писатели других процессов падали бы по таймауту
+    path = restore_flag_path()
+    while True:
+        try:
+            started_at = path.stat().st_mtime
+        except FileNotFoundError:
+            return
+        if time.time() - started_at > DB_RESTORE_WAIT:
+            return
+        time.sleep(0.05)
+
+
+def _begin_immediate(cur: sqlite3.Cursor):
+    """BEGIN IMMEDIATE с замером ожидания блокировки записи и повтором при "database is locked"."""
+    started = time.perf_counter()
+    _wait_for_restore()
+    for attempt in range(DB_BUSY_RETRIES + 1):
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            break
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e) or attempt == DB_BUSY_RETRIES:
+                raise
+            metrics.DB_BUSY_RETRIES.inc()
+    metrics.DB_LOCK_WAIT.observe(time.perf_counter() - started)
+
+
+# --- Миграции схемы ---
+def _migration_base_schema(cur: sqlite3.Cursor):
     cur.execute("""
     CREATE TABLE IF NOT EXISTS users ( telegram_id INTEGER PRIMARY KEY, username TEXT, balance INTEGER DEFAULT 1000, wins INTEGER DEFAULT 0, losses INTEGER DEFAULT 0 );
     """)
@@ -51,288 +236,826 @@ def init_db():
     cur.execute("""
     CREATE TABLE IF NOT EXISTS transactions ( id INTEGER PRIMARY KEY AUTOINCREMENT, telegram_id INTEGER, amount INTEGER, type TEXT, note TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, FOREIGN KEY(telegram_id) REFERENCES users(telegram_id) ON DELETE CASCADE );
     """)
-    conn.commit()
-
-    if cur.execute("SELECT COUNT(*) FROM chests").fetchone()[0] == 0:
-        small_chest_rewards = json.dumps({"rewards": [20, 50, 100, 300], "weights": [65, 25, 8, 2]})
-        medium_chest_rewards = json.dumps({"rewards": [100, 200, 400, 800], "weights": [60, 28, 10, 2]})
-        large_chest_rewards = json.dumps({"rewards": [300, 500, 1000, 3000], "weights": [55, 30, 13, 2]})
-        chests_data = [
-            ("Малый сундук", 50, small_chest_rewards),
-            ("Средний сундук", 200, medium_chest_rewards),
-            ("Большой сундук", 500, large_chest_rewards),
-        ]
-        cur.executemany("INSERT INTO chests (name, price, rewards_json) VALUES (?, ?, ?)", chests_data)
-        conn.commit()
-    conn.close()
 
 
-def ensure_user(telegram_id: int, username: str | None):
-    conn = get_conn()
+def _migration_poll_totals(cur: sqlite3.Cursor):
+    _ensure_column(cur, "polls", "total_pool", "INTEGER NOT NULL DEFAULT 0")
+    _ensure_column(cur, "poll_options", "total_bet", "INTEGER NOT NULL DEFAULT 0")
+    _ensure_column(cur, "poll_options", "bettors", "INTEGER NOT NULL DEFAULT 0")
+    _rebuild_poll_totals(cur)
+
+
+def _migration_indexes(cur: sqlite3.Cursor):
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_bets_option_id ON bets(option_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_poll_options_poll_id ON poll_options(poll_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_polls_status_closes_at ON polls(status, closes_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_polls_created_at ON polls(created_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_transactions_user_created_at ON transactions(telegram_id, created_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users(lower(username))")
+
+
+def _migration_poll_version(cur: sqlite3.Cursor):
+    _ensure_column(cur, "polls", "version", "INTEGER NOT NULL DEFAULT 0")
+
+
+def _migration_meta(cur: sqlite3.Cursor):
+    cur.execute("CREATE TABLE IF NOT EXISTS meta ( key TEXT PRIMARY KEY, value INTEGER NOT NULL DEFAULT 0 )")
+
+
+_LEDGER_REF = re.compile(r"(?:опросе|poll|chest) (\d+)")
+
+
+def _migration_ledger(cur: sqlite3.Cursor):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS ledger ( id INTEGER PRIMARY KEY, telegram_id INTEGER NOT NULL, amount INTEGER NOT NULL, type INTEGER NOT NULL, poll_id INTEGER, chest_id INTEGER, created_at INTEGER NOT NULL, FOREIGN KEY(telegram_id) REFERENCES users(telegram_id) ON DELETE CASCADE );
+    """)
+    # rowid входит в индекс, поэтому история пользователя по убыванию id читается прямо из него
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_ledger_user ON ledger(telegram_id)")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS ledger_daily ( telegram_id INTEGER NOT NULL, day TEXT NOT NULL, type INTEGER NOT NULL, count INTEGER NOT NULL, total INTEGER NOT NULL, PRIMARY KEY (telegram_id, day, type) ) WITHOUT ROWID;
+    """)
+    if not cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'transactions'").fetchone():
+        return
+    # Старые записи переносятся с разбором ссылки на опрос или сундук из текста примечания
+    rows = cur.execute("SELECT telegram_id, amount, type, note, CAST(strftime('%s', created_at) AS INTEGER) AS created_at FROM transactions WHERE telegram_id IS NOT NULL ORDER BY id").fetchall()
+    entries = []
+    for row in rows:
+        type_code = ledger.TYPE_CODES.get(row["type"])
+        if type_code is None:
+            continue
+        match = _LEDGER_REF.search(row["note"] or "")
+        ref = int(match.group(1)) if match else None
+        poll_id = ref if type_code in (ledger.BET, ledger.BET_WIN) else None
+        chest_id = ref if type_code in (ledger.CHEST_BUY, ledger.CHEST_REWARD) else None
+        entries.append((row["telegram_id"], row["amount"] or 0, type_code, poll_id, chest_id, row["created_at"] or 0))
+    cur.executemany("INSERT INTO ledger (telegram_id, amount, type, poll_id, chest_id, created_at) VALUES (?, ?, ?, ?, ?, ?)", entries)
+    cur.execute("DROP TABLE transactions")
+
+
+def _migration_default_chests(cur: sqlite3.Cursor):
+    # Сундуки по умолчанию; шаг выполняется под блокировкой миграций, поэтому параллельный старт процессов не задвоит их
+    if cur.execute("SELECT COUNT(*) FROM chests").fetchone()[0]:
+        return
+    small_chest_rewards = json.dumps({"rewards": [20, 50, 100, 300], "weights": [65, 25, 8, 2]})
+    medium_chest_rewards = json.dumps({"rewards": [100, 200, 400, 800], "weights": [60, 28, 10, 2]})
+    large_chest_rewards = json.dumps({"rewards": [300, 500, 1000, 3000], "weights": [55, 30, 13, 2]})
+    chests_data = [
+        ("Малый сундук", 50, small_chest_rewards),
+        ("Средний сундук", 200, medium_chest_rewards),
+        ("Большой сундук", 500, large_chest_rewards),
+    ]
+    cur.executemany("INSERT INTO chests (name, price, rewards_json) VALUES (?, ?, ?)", chests_data)
+    _bump_meta(cur, "chests_version")
+
+
+def _migration_open_polls_index(cur: sqlite3.Cursor):
+    # Частичный индекс: страница открытых опросов читается по порядку created_at без сортировки всех открытых
+    cur.execute(f"CREATE INDEX IF NOT EXISTS idx_polls_open_created_at ON polls(created_at) WHERE {OPEN_POLLS_PAGE_FILTER}")
+
+
+# Шаги применяются строго по порядку и только один раз; новые шаги добавляются в конец списка
+MIGRATIONS = [
+    (1, "базовая схема", _migration_base_schema),
+    (2, "накопленные суммы ставок", _migration_poll_totals),
+    (3, "индексы для горячих запросов", _migration_indexes),
+    (4, "версия опроса для кэша отрисовки", _migration_poll_version),
+    (5, "счетчики изменений для кэшей процессов", _migration_meta),
+    (6, "журнал движений баланса вместо transactions", _migration_ledger),
+    (7, "сундуки по умолчанию", _migration_default_chests),
+    (8, "индекс открытых опросов по дате", _migration_open_polls_index),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    conn.execute("CREATE TABLE IF NOT EXISTS schema_version ( version INTEGER PRIMARY KEY, description TEXT, applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP )")
+    return conn.execute("SELECT IFNULL(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """Применяет недостающие миграции, каждую в своей транзакции. Возвращает итоговую версию схемы."""
     cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
-    if not cur.fetchone():
-        cur.execute("INSERT INTO users (telegram_id, username, balance) VALUES (?, ?, ?)", (telegram_id, username or f"user{telegram_id}", 1000))
+    for version, description, step in MIGRATIONS:
+        _begin_immediate(cur)
+        try:
+            # Версию перечитываем под блокировкой: параллельно стартующий процесс мог уже применить шаг
+            if get_schema_version(conn) >= version:
+                conn.commit()
+                continue
+            step(cur)
+            cur.execute("INSERT INTO schema_version (version, description) VALUES (?, ?)", (version, description))
+            conn.commit()
+            print(f"✅ Миграция {version} применена: {description}")
+        except Exception:
+            conn.rollback()
+            raise
+    return get_schema_version(conn)
+
+
+def recreate_db():
+    """Удаляет файл бд вместе с -wal/-shm.
+
+    Допустимо только пока бд не открыта другими процессами: воркер, удаливший
+    файл из-под соседей, оставил бы их работать с удаленным файлом. Поэтому
+    под gunicorn это делает мастер-процесс до запуска воркеров (gunicorn.conf.py).
+    """
+    close_pool()
+    if os.path.exists(DB_PATH):
+        os.remove(DB_PATH)
+        for suffix in ("-wal", "-shm"):
+            if os.path.exists(f"{DB_PATH}{suffix}"):
+                os.remove(f"{DB_PATH}{suffix}")
+        print("✅ Старая база данных удалена для принудительного пересоздания.")
+    LEADERBOARD.invalidate()
+    CHEST_TABLE.invalidate()
+
+
+def init_db(recreate: bool | None = None):
+    """Доводит схему до текущей; recreate (по умолчанию RECREATE_DB_ON_STARTUP=true) сначала удаляет бд."""
+    if recreate is None:
+        recreate = os.environ.get("RECREATE_DB_ON_STARTUP") == "true"
+    if recreate:
+        recreate_db()
+
+    with connection() as conn:
+        migrate(conn)
+        for name, detail in find_slow_plans(conn):
+            print(f"⚠️ Запрос {name} выполняется без подходящего индекса: {detail}")
+
+
+def _ensure_column(cur: sqlite3.Cursor, table: str, column: str, ddl: str) -> bool:
+    columns = {row["name"] for row in cur.execute(f"PRAGMA table_info({table})")}
+    if column in columns:
+        return False
+    cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+    return True
+
+
+# --- Запросы горячих путей ---
+# Эти строки выполняют сами функции ниже, и их же проверяет find_slow_plans: план проверяется у того запроса, который реально выполняется
+OPEN_POLLS_FILTER = "status IN ('accepting_bets', 'voting_closed')"
+# Унарный плюс не дает планировщику взять индекс (status, closes_at) и сортировать все открытые опросы:
+# страница читается по частичному индексу idx_polls_open_created_at (его условие записано так же) сразу в порядке created_at
+OPEN_POLLS_PAGE_FILTER = "+status IN ('accepting_bets', 'voting_closed')"
+USER_BY_ID_SQL = "SELECT * FROM users WHERE telegram_id = ?"
+USER_BY_USERNAME_SQL = "SELECT * FROM users WHERE lower(username) = lower(?)"
+POLL_OPTIONS_SQL = "SELECT id, option_text, total_bet, bettors FROM poll_options WHERE poll_id = ? ORDER BY id"
+POLL_BETS_SQL = "SELECT b.option_id, b.amount, u.username FROM bets b JOIN users u ON u.telegram_id = b.telegram_id WHERE b.poll_id = ? ORDER BY b.created_at"
+BET_EXISTS_SQL = "SELECT 1 FROM bets WHERE poll_id = ? AND telegram_id = ?"
+CLOSE_POLL_BETS_SQL = "SELECT b.telegram_id, b.option_id, b.amount, u.username, u.wins, u.losses FROM bets b JOIN users u ON u.telegram_id = b.telegram_id WHERE b.poll_id = ? ORDER BY b.id"
+CLOSE_POLL_LOSSES_SQL = "UPDATE users SET losses = losses + 1 WHERE telegram_id IN (SELECT telegram_id FROM bets WHERE poll_id = ? AND option_id != ?)"
+AUTO_CLOSE_SQL = "UPDATE polls SET status = 'voting_closed', version = version + 1 WHERE status = 'accepting_bets' AND closes_at <= ? RETURNING id, message_id"
+NEXT_CLOSE_SQL = "SELECT MIN(closes_at) FROM polls WHERE status = 'accepting_bets'"
+ACTIVE_POLL_VERSIONS_SQL = f"SELECT id, version FROM polls WHERE {OPEN_POLLS_FILTER}"
+LEDGER_PAGE_SQL = "SELECT id, amount, type, poll_id, chest_id, created_at FROM ledger WHERE telegram_id = ? AND id < ? ORDER BY id DESC LIMIT ?"
+_LIST_POLLS_SQL = """
+    WITH page AS (
+        SELECT * FROM polls {where}
+        ORDER BY created_at DESC, id DESC
+        LIMIT ? OFFSET ?
+    )
+    SELECT page.*, po.id AS option_id, po.option_text, po.total_bet, po.bettors
+    FROM page
+    LEFT JOIN poll_options po ON po.poll_id = page.id
+    ORDER BY page.created_at DESC, page.id DESC, po.id
+"""
+LIST_OPEN_POLLS_SQL = _LIST_POLLS_SQL.format(where=f"WHERE {OPEN_POLLS_PAGE_FILTER}")
+LIST_ALL_POLLS_SQL = _LIST_POLLS_SQL.format(where="")
+
+
+def poll_card_versions_sql(known_count: int) -> str:
+    known_filter = f" OR id IN ({','.join('?' for _ in range(known_count))})" if known_count else ""
+    return f"SELECT id, version, message_id, status FROM polls WHERE {OPEN_POLLS_FILTER}{known_filter}"
+
+
+# Имя -> (запрос, параметры, допустимое число сортировок во временном B-дереве).
+# Сортировка допускается только для уже ограниченного результата: ставок одного опроса или строк одной страницы
+HOT_QUERIES = {
+    "get_user": (USER_BY_ID_SQL, (0,), 0),
+    "get_user_by_username": (USER_BY_USERNAME_SQL, ("",), 0),
+    "get_poll_options": (POLL_OPTIONS_SQL, (0,), 0),
+    "get_bets_for_poll": (POLL_BETS_SQL, (0,), 1),
+    "bet_exists": (BET_EXISTS_SQL, (0, 0), 0),
+    "close_poll_bets": (CLOSE_POLL_BETS_SQL, (0,), 1),
+    "close_poll_losses": (CLOSE_POLL_LOSSES_SQL, (0, 0), 0),
+    "auto_close_due_polls": (AUTO_CLOSE_SQL, ("",), 0),
+    "next_poll_close_at": (NEXT_CLOSE_SQL, (), 0),
+    "active_poll_versions": (ACTIVE_POLL_VERSIONS_SQL, (), 0),
+    "poll_card_versions": (poll_card_versions_sql(2), (0, 0), 0),
+    "list_open_polls": (LIST_OPEN_POLLS_SQL, (50, 0), 1),
+    "list_all_polls": (LIST_ALL_POLLS_SQL, (50, 0), 1),
+    "ledger_history": (LEDGER_PAGE_SQL, (0, 0, 50), 0),
+}
+
+
+def find_slow_plans(conn: sqlite3.Connection) -> List[tuple]:
+    """Возвращает (имя, строка плана) для горячих запросов с полным SCAN таблицы или с лишней сортировкой во временном B-дереве."""
+    offenders = []
+    for name, (sql, params, allowed_sorts) in HOT_QUERIES.items():
+        sorts, subqueries = [], set()
+        for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params):
+            detail = row["detail"]
+            if detail.startswith(("CO-ROUTINE ", "MATERIALIZE ")):
+                # Проход по результату CTE (уже ограниченной страницы) - не просмотр таблицы
+                subqueries.add(detail.split(" ", 1)[1])
+            elif detail.startswith("SCAN ") and "USING" not in detail and detail[5:] not in subqueries:
+                offenders.append((name, detail))
+            elif detail.startswith("USE TEMP B-TREE"):
+                sorts.append(detail)
+        if len(sorts) > allowed_sorts:
+            offenders.extend((name, detail) for detail in sorts)
+    return offenders
+
+
+def _bump_meta(cur: sqlite3.Cursor, key: str) -> int:
+    """Увеличивает счетчик изменений в таблице meta внутри текущей транзакции и возвращает новое значение."""
+    return cur.execute("INSERT INTO meta (key, value) VALUES (?, 1) ON CONFLICT(key) DO UPDATE SET value = value + 1 RETURNING value", (key,)).fetchone()[0]
+
+
+def _get_meta(conn: sqlite3.Connection, key: str) -> int:
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else 0
+
+
+def get_versions(*keys: str) -> Dict[str, int]:
+    """Счетчики изменений из meta (отсутствующие равны 0): по ним HTTP-кэш строит ETag без чтения самих данных."""
+    with connection() as conn:
+        rows = conn.execute(f"SELECT key, value FROM meta WHERE key IN ({','.join('?' for _ in keys)})", keys).fetchall()
+    found = {row["key"]: row["value"] for row in rows}
+    return {key: found.get(key, 0) for key in keys}
+
+
+def upsert_user(telegram_id: int, username: str | None) -> Dict[str, Any]:
+    """Возвращает пользователя, создавая его или обновляя имя (username=None имя не меняет).
+
+    Писатель берется, только если пользователя нет или имя изменилось; сами
+    вставка и переименование атомарны (INSERT ... ON CONFLICT / UPDATE ... RETURNING).
+    """
+    with connection() as conn:
+        row = conn.execute(USER_BY_ID_SQL, (telegram_id,)).fetchone()
+        if row and (username is None or row["username"] == username):
+            return dict(row)
+        cur = conn.cursor()
+        _begin_immediate(cur)
+        rating_version = None
+        row = cur.execute(
+            "INSERT INTO users (telegram_id, username, balance) VALUES (?, ?, ?) ON CONFLICT(telegram_id) DO NOTHING RETURNING *",
+            (telegram_id, username or f"user{telegram_id}", 1000),
+        ).fetchone()
+        if row:
+            rating_version = _bump_meta(cur, "rating_version")
+            _bump_meta(cur, "users_version")
+        elif username is not None:
+            row = cur.execute("UPDATE users SET username = ? WHERE telegram_id = ? AND username IS NOT ? RETURNING *", (username, telegram_id, username)).fetchone()
+            if row:
+                # Имя видно в рейтинге и в карточках открытых опросов со ставками пользователя
+                _bump_meta(cur, "users_version")
+                cur.execute("UPDATE polls SET version = version + 1 WHERE status IN ('accepting_bets', 'voting_closed') AND EXISTS (SELECT 1 FROM bets WHERE poll_id = polls.id AND telegram_id = ?)", (telegram_id,))
+        if row is None:
+            row = cur.execute(USER_BY_ID_SQL, (telegram_id,)).fetchone()
+        user = dict(row)
         conn.commit()
-    conn.close()
+    if rating_version is not None:
+        LEADERBOARD.apply_changes(rating_version, [(telegram_id, 0, 0)])
+    return user
+
+
+def ensure_user(telegram_id: int, username: str | None):
+    upsert_user(telegram_id, username)
 
 
 def get_user(telegram_id: int) -> Dict[str, Any] | None:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
-    row = cur.fetchone()
-    conn.close()
+    with connection() as conn:
+        row = conn.execute(USER_BY_ID_SQL, (telegram_id,)).fetchone()
     return dict(row) if row else None
 
 
 def get_user_by_username(username: str) -> Dict[str, Any] | None:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE lower(username) = lower(?)", (username,))
-    row = cur.fetchone()
-    conn.close()
+    with connection() as conn:
+        row = conn.execute(USER_BY_USERNAME_SQL, (username,)).fetchone()
     return dict(row) if row else None
 
 
 def create_poll(creator_id: int, question: str, options: List[str]) -> int:
-    conn = get_conn()
-    cur = conn.cursor()
-    closes_at = datetime.now(timezone.utc) + timedelta(minutes=20)
-    cur.execute(
-        "INSERT INTO polls (question, creator_id, closes_at, status) VALUES (?, ?, ?, ?)",
-        (question, creator_id, closes_at.isoformat(), 'accepting_bets'),
-    )
-    poll_id = cur.lastrowid
-    for opt in options:
-        cur.execute("INSERT INTO poll_options (poll_id, option_text) VALUES (?, ?)", (poll_id, opt))
-    conn.commit()
-    conn.close()
+    with connection() as conn:
+        cur = conn.cursor()
+        closes_at = datetime.now(timezone.utc) + timedelta(minutes=20)
+        cur.execute("BEGIN")
+        cur.execute(
+            "INSERT INTO polls (question, creator_id, closes_at, status) VALUES (?, ?, ?, ?)",
+            (question, creator_id, closes_at.isoformat(timespec="microseconds"), 'accepting_bets'),
+        )
+        poll_id = cur.lastrowid
+        cur.executemany("INSERT INTO poll_options (poll_id, option_text) VALUES (?, ?)", [(poll_id, opt) for opt in options])
+        _bump_meta(cur, "polls_version")
+        conn.commit()
     return poll_id
 
 
 def set_poll_message_id(poll_id: int, message_id: int):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE polls SET message_id = ? WHERE id = ?", (message_id, poll_id))
-    conn.commit()
-    conn.close()
+    with connection() as conn:
+        cur = conn.cursor()
+        _begin_immediate(cur)
+        cur.execute("UPDATE polls SET message_id = ? WHERE id = ?", (message_id, poll_id))
+        _bump_meta(cur, "polls_version")
+        conn.commit()
 
 
 def auto_close_due_polls() -> List[Dict[str, Any]]:
-    conn = get_conn()
-    now_utc = datetime.now(timezone.utc)
-    cur = conn.cursor()
-    cur.execute("SELECT id, closes_at FROM polls WHERE status = 'accepting_bets'")
-    all_open_polls = cur.fetchall()
-    
-    polls_to_close_ids = []
-    if all_open_polls:
-        for poll_data in all_open_polls:
-            closes_at_dt = datetime.fromisoformat(poll_data["closes_at"])
-            if closes_at_dt <= now_utc:
-                polls_to_close_ids.append(poll_data["id"])
-
-    if polls_to_close_ids:
-        cur.execute(f"UPDATE polls SET status = 'voting_closed' WHERE id IN ({','.join('?' for _ in polls_to_close_ids)})", polls_to_close_ids)
+    """Закрывает прием ставок во всех опросах, чей closes_at уже наступил, одним запросом по индексу (status, closes_at)."""
+    now_utc = datetime.now(timezone.utc).isoformat(timespec="microseconds")
+    with connection() as conn:
+        cur = conn.cursor()
+        _begin_immediate(cur)
+        rows = cur.execute(AUTO_CLOSE_SQL, (now_utc,)).fetchall()
+        if rows:
+            _bump_meta(cur, "polls_version")
         conn.commit()
-    
-    if polls_to_close_ids:
-        cur.execute(f"SELECT id, message_id FROM polls WHERE id IN ({','.join('?' for _ in polls_to_close_ids)})", polls_to_close_ids)
-        closed_polls_info = [dict(row) for row in cur.fetchall()]
-        conn.close()
-        return closed_polls_info
+    return [dict(row) for row in rows]
 
-    conn.close()
-    return []
 
+def next_poll_close_at() -> datetime | None:
+    with connection() as conn:
+        closes_at = conn.execute(NEXT_CLOSE_SQL).fetchone()[0]
+    return datetime.fromisoformat(closes_at) if closes_at else None
 
-def get_poll(poll_id: int) -> Dict[str, Any] | None:
-    conn = get_conn()
-    cur = conn.cursor()
+
+def _fetch_poll(cur: sqlite3.Cursor, poll_id: int) -> Dict[str, Any] | None:
     cur.execute("SELECT * FROM polls WHERE id = ?", (poll_id,))
     row = cur.fetchone()
     if not row:
-        conn.close()
         return None
     poll = dict(row)
-    cur.execute("SELECT po.id, po.option_text, IFNULL(SUM(b.amount), 0) as total_bet FROM poll_options po LEFT JOIN bets b ON b.option_id = po.id WHERE po.poll_id = ? GROUP BY po.id ORDER BY po.id", (poll_id,))
+    cur.execute(POLL_OPTIONS_SQL, (poll_id,))
     poll["options"] = [dict(r) for r in cur.fetchall()]
-    conn.close()
     return poll
 
 
-def list_polls(open_only: bool = True) -> List[Dict[str, Any]]:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM polls WHERE status IN ('accepting_bets', 'voting_closed') ORDER BY created_at DESC")
-    polls = []
-    for p in cur.fetchall():
-        poll = dict(p)
-        cur2 = conn.cursor()
-        cur2.execute("SELECT po.id, po.option_text, IFNULL(SUM(b.amount), 0) as total_bet FROM poll_options po LEFT JOIN bets b ON b.option_id = po.id WHERE po.poll_id = ? GROUP BY po.id", (poll["id"],))
-        poll["options"] = [dict(r) for r in cur2.fetchall()]
-        polls.append(poll)
-    conn.close()
-    return polls
+def get_poll(poll_id: int) -> Dict[str, Any] | None:
+    with connection() as conn:
+        return _fetch_poll(conn.cursor(), poll_id)
+
+
+def get_poll_version(poll_id: int) -> int | None:
+    with connection() as conn:
+        row = conn.execute("SELECT version FROM polls WHERE id = ?", (poll_id,)).fetchone()
+    return row["version"] if row else None
+
+
+def get_active_poll_versions() -> Dict[int, int]:
+    """Версии неразрешенных опросов; по ним поток событий замечает изменения из других процессов."""
+    with connection() as conn:
+        rows = conn.execute(ACTIVE_POLL_VERSIONS_SQL).fetchall()
+    return {row["id"]: row["version"] for row in rows}
+
+
+def get_poll_card_versions(known_ids: Sequence[int] = ()) -> Dict[int, Dict[str, Any]]:
+    """Версии, message_id и статус неразрешенных опросов и опросов known_ids (чтобы заметить их разрешение)."""
+    known_ids = list(known_ids)
+    with connection() as conn:
+        rows = conn.execute(poll_card_versions_sql(len(known_ids)), known_ids).fetchall()
+    return {row["id"]: {"version": row["version"], "message_id": row["message_id"], "status": row["status"]} for row in rows}
+
+
+def get_poll_with_bets(poll_id: int) -> tuple[Dict[str, Any], List[Dict[str, Any]]] | None:
+    """Опрос и все его ставки из одного снимка бд."""
+    with connection() as conn:
+        cur = conn.cursor()
+        cur.execute("BEGIN")
+        poll = _fetch_poll(cur, poll_id)
+        if not poll:
+            return None
+        cur.execute(POLL_BETS_SQL, (poll_id,))
+        bets = [dict(row) for row in cur.fetchall()]
+        conn.commit()
+    return poll, bets
+
+
+def list_polls(open_only: bool = True, limit: int | None = None, offset: int = 0) -> List[Dict[str, Any]]:
+    """Опросы с вариантами и суммами ставок одним запросом, новые первыми.
+
+    open_only оставляет только еще не разрешенные опросы, limit/offset задают страницу.
+    """
+    with connection() as conn:
+        return _list_polls(conn, open_only, limit, offset)
+
+
+def _list_polls(conn: sqlite3.Connection, open_only: bool, limit: int | None, offset: int) -> List[Dict[str, Any]]:
+    rows = conn.execute(LIST_OPEN_POLLS_SQL if open_only else LIST_ALL_POLLS_SQL, (limit if limit is not None else -1, offset)).fetchall()
+
+    polls: Dict[int, Dict[str, Any]] = {}
+    for r in rows:
+        row = dict(r)
+        option_id, option_text, total_bet, bettors = row.pop("option_id"), row.pop("option_text"), row.pop("total_bet"), row.pop("bettors")
+        poll = polls.setdefault(row["id"], {**row, "options": []})
+        if option_id is not None:
+            poll["options"].append({"id": option_id, "option_text": option_text, "total_bet": total_bet, "bettors": bettors})
+    return list(polls.values())
 
 
 def list_all_polls() -> List[Dict[str, Any]]:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT id, question, status, creator_id FROM polls ORDER BY id DESC")
-    all_polls = [dict(row) for row in cur.fetchall()]
-    conn.close()
-    return all_polls
+    with connection() as conn:
+        rows = conn.execute("SELECT id, question, status, creator_id FROM polls ORDER BY id DESC").fetchall()
+    return [dict(row) for row in rows]
 
 
 def get_bets_for_poll(poll_id: int) -> List[Dict[str, Any]]:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT b.option_id, b.amount, u.username FROM bets b JOIN users u ON u.telegram_id = b.telegram_id WHERE b.poll_id = ? ORDER BY b.created_at", (poll_id,))
-    bets = [dict(row) for row in cur.fetchall()]
-    conn.close()
-    return bets
+    with connection() as conn:
+        rows = conn.execute(POLL_BETS_SQL, (poll_id,)).fetchall()
+    return [dict(row) for row in rows]
+
+
+# Процессы кэшируют известных им пользователей (см. user_cache), поэтому по этой ошибке вызывающий может пересоздать пользователя и повторить запись
+USER_NOT_FOUND = "Пользователь не найден"
+
+
+def _place_bet(cur: sqlite3.Cursor, entries: ledger.LedgerBatch, telegram_id: int, poll_id: int, option_id: int, amount: int) -> Dict[str, Any]:
+    cur.execute("SELECT status FROM polls WHERE id = ?", (poll_id,))
+    poll_row = cur.fetchone()
+    if not poll_row: return {"ok": False, "error": "Опрос не найден"}
+    if poll_row["status"] != 'accepting_bets': return {"ok": False, "error": "Ставки на этот опрос больше не принимаются"}
+    if amount <= 0: return {"ok": False, "error": "Сумма ставки должна быть больше нуля"}
+    cur.execute("SELECT balance FROM users WHERE telegram_id = ?", (telegram_id,))
+    user_row = cur.fetchone()
+    if not user_row: return {"ok": False, "error": USER_NOT_FOUND}
+    if user_row["balance"] < amount: return {"ok": False, "error": "Недостаточно средств"}
+    cur.execute(BET_EXISTS_SQL, (poll_id, telegram_id))
+    if cur.fetchone(): return {"ok": False, "error": "Вы уже сделали ставку в этом опросе"}
+    cur.execute("UPDATE poll_options SET total_bet = total_bet + ?, bettors = bettors + 1 WHERE id = ? AND poll_id = ?", (amount, option_id, poll_id))
+    if cur.rowcount == 0: return {"ok": False, "error": "Такой вариант ответа не принадлежит этому опросу."}
+    cur.execute("UPDATE polls SET total_pool = total_pool + ?, version = version + 1 WHERE id = ?", (amount, poll_id))
+    cur.execute("UPDATE users SET balance = balance - ? WHERE telegram_id = ?", (amount, telegram_id))
+    cur.execute("INSERT INTO bets (poll_id, option_id, telegram_id, amount) VALUES (?, ?, ?, ?)", (poll_id, option_id, telegram_id, amount))
+    entries.add(telegram_id, -amount, ledger.BET, poll_id=poll_id)
+    return {"ok": True}
 
 
 def place_bet(telegram_id: int, poll_id: int, option_id: int, amount: int) -> Dict[str, Any]:
-    conn = get_conn()
-    cur = conn.cursor()
-    try:
-        cur.execute("BEGIN IMMEDIATE")
-        cur.execute("SELECT status FROM polls WHERE id = ?", (poll_id,))
-        poll_row = cur.fetchone()
-        if not poll_row: return {"ok": False, "error": "Опрос не найден"}
-        if poll_row["status"] != 'accepting_bets': return {"ok": False, "error": "Ставки на этот опрос больше не принимаются"}
-        if amount <= 0: return {"ok": False, "error": "Сумма ставки должна быть больше нуля"}
-        cur.execute("SELECT balance FROM users WHERE telegram_id = ?", (telegram_id,))
-        user_row = cur.fetchone()
-        if not user_row: return {"ok": False, "error": "Пользователь не найден"}
-        if user_row["balance"] < amount: return {"ok": False, "error": "Недостаточно средств"}
-        cur.execute("SELECT * FROM bets WHERE poll_id = ? AND telegram_id = ?", (poll_id, telegram_id))
-        if cur.fetchone(): return {"ok": False, "error": "Вы уже сделали ставку в этом опросе"}
-        cur.execute("UPDATE users SET balance = balance - ? WHERE telegram_id = ?", (amount, telegram_id))
-        cur.execute("INSERT INTO bets (poll_id, option_id, telegram_id, amount) VALUES (?, ?, ?, ?)", (poll_id, option_id, telegram_id, amount))
-        cur.execute("INSERT INTO transactions (telegram_id, amount, type, note) VALUES (?, ?, ?, ?)", (telegram_id, -amount, "bet", f"Ставка в опросе {poll_id}"))
-        conn.commit()
-        return {"ok": True}
-    except Exception as e:
-        conn.rollback()
-        return {"ok": False, "error": str(e)}
-    finally:
-        conn.close()
+    return apply_writes([("place_bet", (telegram_id, poll_id, option_id, amount))])[0]
 
 
 def close_poll(user_id: int, poll_id: int, winning_option_id: int) -> Dict[str, Any]:
-    conn = get_conn()
-    cur = conn.cursor()
-    try:
-        cur.execute("BEGIN IMMEDIATE")
-        cur.execute("SELECT id, status FROM polls WHERE id = ?", (poll_id,))
-        poll = cur.fetchone()
-        if not poll: return {"ok": False, "error": "Опрос не найден"}
-        if poll["status"] == 'resolved': return {"ok": False, "error": "Этот опрос уже был разрешен."}
-        
-        cur.execute("SELECT option_text FROM poll_options WHERE poll_id = ? AND id = ?", (poll_id, winning_option_id))
-        option_row = cur.fetchone()
-        if not option_row: return {"ok": False, "error": "Такой вариант ответа не принадлежит этому опросу."}
-        winning_option_text = option_row['option_text']
-        
-        cur.execute("SELECT telegram_id, option_id, amount FROM bets WHERE poll_id = ?", (poll_id,))
-        all_bets = [dict(r) for r in cur.fetchall()]
-        pool = sum(b['amount'] for b in all_bets)
-        win_total = sum(b['amount'] for b in all_bets if b['option_id'] == winning_option_id)
-        
-        winners_data = []
-        if pool > 0 and win_total > 0:
-            is_only_winners = (pool == win_total)
-            for bet in all_bets:
-                bettor_id = bet["telegram_id"]
-                if bet["option_id"] == winning_option_id:
-                    payout = bet["amount"] * 2 if is_only_winners else (bet["amount"] * pool) // win_total
-                    cur.execute("UPDATE users SET balance = balance + ?, wins = wins + 1 WHERE telegram_id = ?", (payout, bettor_id))
-                    cur.execute("INSERT INTO transactions (telegram_id, amount, type, note) VALUES (?, ?, ?, ?)", (bettor_id, payout, "bet_win", f"Win poll {poll_id}"))
-                    user_info = get_user(bettor_id)
-                    if user_info: winners_data.append({"username": user_info.get('username', 'N/A'), "payout": payout})
-                else: 
-                    cur.execute("UPDATE users SET losses = losses + 1 WHERE telegram_id = ?", (bettor_id,))
-        elif pool > 0 and win_total == 0:
-             for bet in all_bets:
-                cur.execute("UPDATE users SET losses = losses + 1 WHERE telegram_id = ?", (bet["telegram_id"],))
-
-        cur.execute("UPDATE polls SET status = 'resolved', message_id = NULL WHERE id = ?", (poll_id,))
-        conn.commit()
-        return {"ok": True, "pool": pool, "winners": winners_data, "winning_option_text": winning_option_text}
-    except Exception as e:
-        conn.rollback()
-        return {"ok": False, "error": str(e)}
-    finally:
-        conn.close()
-        
-def get_rating(limit: int = None) -> List[Dict[str, Any]]:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT telegram_id, username, balance, wins, losses FROM users")
-    users = []
-    for r in cur.fetchall():
-        u = dict(r)
-        total = u["wins"] + u["losses"]
-        u["winrate"] = round((u["wins"] / total) * 100, 2) if total > 0 else 0.0
-        users.append(u)
-    users.sort(key=lambda x: (x["winrate"], x["wins"]), reverse=True)
-    conn.close()
-    if limit:
-        return users[:limit]
-    return users
+    with connection() as conn:
+        cur = conn.cursor()
+        try:
+            _begin_immediate(cur)
+            cur.execute("SELECT id, status, total_pool FROM polls WHERE id = ?", (poll_id,))
+            poll = cur.fetchone()
+            if not poll: return {"ok": False, "error": "Опрос не найден"}
+            if poll["status"] == 'resolved': return {"ok": False, "error": "Этот опрос уже был разрешен."}
+
+            cur.execute("SELECT option_text, total_bet FROM poll_options WHERE poll_id = ? AND id = ?", (poll_id, winning_option_id))
+            option_row = cur.fetchone()
+            if not option_row: return {"ok": False, "error": "Такой вариант ответа не принадлежит этому опросу."}
+            winning_option_text = option_row['option_text']
+
+            # Все выплаты считаются за один проход, а применяются пакетно, чтобы блокировка записи держалась как можно меньше
+            cur.execute(CLOSE_POLL_BETS_SQL, (poll_id,))
+            all_bets = cur.fetchall()
+            pool = poll['total_pool']
+            win_total = option_row['total_bet']
+
+            winners_data, payouts, changed_scores = [], [], []
+            if pool > 0:
+                is_only_winners = (pool == win_total)
+                for bet in all_bets:
+                    if win_total > 0 and bet["option_id"] == winning_option_id:
+                        payout = bet["amount"] * 2 if is_only_winners else (bet["amount"] * pool) // win_total
+                        payouts.append((payout, bet["telegram_id"]))
+                        winners_data.append({"username": bet["username"], "payout": payout})
+                        changed_scores.append((bet["telegram_id"], bet["wins"] + 1, bet["losses"]))
+                    else:
+                        changed_scores.append((bet["telegram_id"], bet["wins"], bet["losses"] + 1))
+                cur.executemany("UPDATE users SET balance = balance + ?, wins = wins + 1 WHERE telegram_id = ?", payouts)
+                entries = ledger.LedgerBatch()
+                for payout, bettor_id in payouts:
+                    entries.add(bettor_id, payout, ledger.BET_WIN, poll_id=poll_id)
+                entries.flush(cur)
+                cur.execute(CLOSE_POLL_LOSSES_SQL, (poll_id, winning_option_id))
+
+            cur.execute("UPDATE polls SET status = 'resolved', message_id = NULL, version = version + 1 WHERE id = ?", (poll_id,))
+            rating_version = _bump_meta(cur, "rating_version")
+            _bump_meta(cur, "polls_version")
+            _bump_meta(cur, "users_version")
+            conn.commit()
+            LEADERBOARD.apply_changes(rating_version, changed_scores)
+            return {"ok": True, "pool": pool, "winners": winners_data, "winning_option_text": winning_option_text}
+        except Exception as e:
+            conn.rollback()
+            return {"ok": False, "error": str(e)}
+
+
+def _rebuild_poll_totals(cur: sqlite3.Cursor):
+    cur.execute("UPDATE poll_options SET total_bet = (SELECT IFNULL(SUM(amount), 0) FROM bets WHERE option_id = poll_options.id), bettors = (SELECT COUNT(*) FROM bets WHERE option_id = poll_options.id)")
+    cur.execute("UPDATE polls SET total_pool = (SELECT IFNULL(SUM(amount), 0) FROM bets WHERE poll_id = polls.id)")
+
+
+def check_poll_totals(rebuild: bool = False) -> Dict[str, Any]:
+    """Сверяет накопленные суммы опросов со ставками; при rebuild=True пересчитывает расхождения."""
+    with connection() as conn:
+        cur = conn.cursor()
+        try:
+            _begin_immediate(cur)
+            cur.execute("""
+                SELECT po.poll_id FROM poll_options po LEFT JOIN bets b ON b.option_id = po.id
+                GROUP BY po.id
+                HAVING po.total_bet != IFNULL(SUM(b.amount), 0) OR po.bettors != COUNT(b.id)
+                UNION
+                SELECT p.id FROM polls p
+                WHERE p.total_pool != (SELECT IFNULL(SUM(amount), 0) FROM bets WHERE poll_id = p.id)
+                ORDER BY 1
+            """)
+            mismatched = [row[0] for row in cur.fetchall()]
+            if rebuild and mismatched:
+                _rebuild_poll_totals(cur)
+                cur.execute(f"UPDATE polls SET version = version + 1 WHERE id IN ({','.join('?' for _ in mismatched)})", mismatched)
+                _bump_meta(cur, "polls_version")
+            conn.commit()
+            return {"ok": True, "mismatched": mismatched, "rebuilt": rebuild and bool(mismatched)}
+        except Exception as e:
+            conn.rollback()
+            return {"ok": False, "error": str(e)}
+
+
+# --- Рейтинг ---
+LEADERBOARD = Leaderboard()
+
+
+def _leaderboard(conn: sqlite3.Connection) -> Leaderboard:
+    # Счетчик rating_version общий для всех процессов, поэтому изменения из другого воркера тоже заметны
+    if not LEADERBOARD.is_current(_get_meta(conn, "rating_version")):
+        # Внутри уже начатой транзакции (снимок get_bootstrap) читаем в ней же
+        own_transaction = not conn.in_transaction
+        if own_transaction:
+            conn.execute("BEGIN")
+        version = _get_meta(conn, "rating_version")
+        LEADERBOARD.load((tuple(row) for row in conn.execute("SELECT telegram_id, wins, losses FROM users")), version)
+        if own_transaction:
+            conn.commit()
+    return LEADERBOARD
+
+
+def _snapshot_rating_page(conn: sqlite3.Connection, version: int, limit: int | None) -> List[tuple]:
+    """Страница рейтинга на версии version читающей транзакции conn.
+
+    Рейтинг в памяти меняется после коммита записи в другом потоке и может
+    оказаться новее снимка; тогда страница строится из самого снимка, а общий
+    рейтинг не откатывается назад.
+    """
+    ranked = LEADERBOARD.page_at(version, limit)
+    if ranked is None and not (LEADERBOARD.loaded and LEADERBOARD.version > version):
+        ranked = _leaderboard(conn).page_at(version, limit)
+    if ranked is None:
+        board = Leaderboard()
+        board.load((tuple(row) for row in conn.execute("SELECT telegram_id, wins, losses FROM users")), version)
+        ranked = board.page(limit)
+    return ranked
+
+
+def _rated_users(conn: sqlite3.Connection, ranked: List[tuple]) -> List[Dict[str, Any]]:
+    if not ranked:
+        return []
+    ids = [telegram_id for _, telegram_id in ranked]
+    rows = conn.execute(f"SELECT telegram_id, username, balance, wins, losses FROM users WHERE telegram_id IN ({','.join('?' for _ in ids)})", ids).fetchall()
+    users = {row["telegram_id"]: dict(row) for row in rows}
+    result = []
+    for rank, telegram_id in ranked:
+        u = users.get(telegram_id)
+        if u is None:
+            continue
+        u["winrate"] = winrate(u["wins"], u["losses"])
+        u["rank"] = rank
+        result.append(u)
+    return result
+
+
+def get_rating(limit: int = None, offset: int = 0) -> List[Dict[str, Any]]:
+    """Страница рейтинга по (winrate, wins); порядок берется из рейтинга в памяти, балансы и ники из бд."""
+    with connection() as conn:
+        ranked = _leaderboard(conn).page(limit, offset)
+        return _rated_users(conn, ranked)
+
+
+def get_user_rank(telegram_id: int) -> Dict[str, Any] | None:
+    with connection() as conn:
+        board = _leaderboard(conn)
+        rank = board.rank_of(telegram_id)
+        if rank is None:
+            return None
+        users = _rated_users(conn, [(rank, telegram_id)])
+        if not users:
+            return None
+        return {**users[0], "total": len(board)}
+
 
 def add_balance(telegram_id: int, amount: int) -> Dict[str, Any]:
-    conn = get_conn()
-    cur = conn.cursor()
-    try:
-        cur.execute("BEGIN IMMEDIATE")
-        cur.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
-        if not cur.fetchone(): return {"ok": False, "error": "Пользователь с таким ID не найден."}
-        cur.execute("UPDATE users SET balance = balance + ? WHERE telegram_id = ?", (amount, telegram_id))
-        cur.execute("INSERT INTO transactions (telegram_id, amount, type, note) VALUES (?, ?, ?, ?)", (telegram_id, amount, "admin_add", "Пополнение от администратора"))
-        conn.commit()
-        updated_user = get_user(telegram_id)
-        return {"ok": True, "user": updated_user}
-    except Exception as e:
-        conn.rollback()
-        return {"ok": False, "error": str(e)}
-    finally:
-        conn.close()
+    with connection() as conn:
+        cur = conn.cursor()
+        try:
+            _begin_immediate(cur)
+            cur.execute(USER_BY_ID_SQL, (telegram_id,))
+            if not cur.fetchone(): return {"ok": False, "error": "Пользователь с таким ID не найден."}
+            cur.execute("UPDATE users SET balance = balance + ? WHERE telegram_id = ?", (amount, telegram_id))
+            entries = ledger.LedgerBatch()
+            entries.add(telegram_id, amount, ledger.ADMIN_ADD)
+            entries.flush(cur)
+            updated_user = dict(cur.execute(USER_BY_ID_SQL, (telegram_id,)).fetchone())
+            _bump_meta(cur, "users_version")
+            conn.commit()
+            return {"ok": True, "user": updated_user}
+        except Exception as e:
+            conn.rollback()
+            return {"ok": False, "error": str(e)}
+
+
+# --- Сундуки ---
+CHEST_TABLE = ChestTable()
+CHEST_MAX_BULK = int(os.environ.get("CHEST_MAX_BULK", "100"))
+
 
 def list_chests() -> List[Dict[str, Any]]:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT id, name, price FROM chests ORDER BY price")
-    res = [dict(r) for r in cur.fetchall()]
-    conn.close()
-    return res
+    with connection() as conn:
+        return _list_chests(conn)
 
-def open_chest(telegram_id: int, chest_id: int) -> Dict[str, Any]:
-    conn = get_conn()
-    cur = conn.cursor()
-    try:
-        cur.execute("BEGIN IMMEDIATE")
-        cur.execute("SELECT price, rewards_json FROM chests WHERE id = ?", (chest_id,))
-        ch = cur.fetchone()
-        if not ch: return {"ok": False, "error": "Chest not found"}
-        price, rewards_data_str = ch["price"], ch["rewards_json"]
-        cur.execute("SELECT balance FROM users WHERE telegram_id = ?", (telegram_id,))
-        u = cur.fetchone()
-        if not u or u["balance"] < price: return {"ok": False, "error": "User not found or insufficient balance"}
-        cur.execute("UPDATE users SET balance = balance - ? WHERE telegram_id = ?", (price, telegram_id))
-        rewards_data = json.loads(rewards_data_str)
-        reward = random.choices(rewards_data["rewards"], weights=rewards_data["weights"], k=1)[0]
-        cur.execute("UPDATE users SET balance = balance + ? WHERE telegram_id = ?", (reward, telegram_id))
-        cur.execute("INSERT INTO transactions (telegram_id, amount, type, note) VALUES (?, ?, ?, ?)", (telegram_id, -price, "chest_buy", f"Buy chest {chest_id}"))
-        cur.execute("INSERT INTO transactions (telegram_id, amount, type, note) VALUES (?, ?, ?, ?)", (telegram_id, reward, "chest_reward", f"Reward chest {chest_id}"))
-        conn.commit()
-        return {"ok": True, "reward": reward}
-    except Exception as e:
-        conn.rollback()
-        return {"ok": False, "error": str(e)}
-    finally:
-        conn.close()
\ No newline at end of file
+
+def _list_chests(conn: sqlite3.Connection) -> List[Dict[str, Any]]:
+    return [dict(r) for r in conn.execute("SELECT id, name, price FROM chests ORDER BY price").fetchall()]
+
+
+def _chest_table(cur: sqlite3.Cursor) -> ChestTable:
+    """Таблица наград, соответствующая chests_version; вызывается внутри транзакции."""
+    version = _get_meta(cur.connection, "chests_version")
+    if not CHEST_TABLE.is_current(version):
+        rows = cur.execute("SELECT id, price, rewards_json FROM chests").fetchall()
+        CHEST_TABLE.load(((row["id"], row["price"], json.loads(row["rewards_json"])) for row in rows), version)
+    return CHEST_TABLE
+
+
+def _open_chest(cur: sqlite3.Cursor, entries: ledger.LedgerBatch, telegram_id: int, chest_id: int, count: int = 1) -> Dict[str, Any]:
+    if count < 1 or count > CHEST_MAX_BULK:
+        return {"ok": False, "error": f"Можно открыть от 1 до {CHEST_MAX_BULK} сундуков за раз"}
+    chest = _chest_table(cur).get(chest_id)
+    if not chest: return {"ok": False, "error": "Chest not found"}
+    price, sampler = chest
+    cost = price * count
+    cur.execute("SELECT balance FROM users WHERE telegram_id = ?", (telegram_id,))
+    u = cur.fetchone()
+    if not u: return {"ok": False, "error": USER_NOT_FOUND}
+    if u["balance"] < cost: return {"ok": False, "error": "User not found or insufficient balance"}
+    rewards = sampler.sample_many(count)
+    total_reward = sum(rewards)
+    cur.execute("UPDATE users SET balance = balance + ? WHERE telegram_id = ?", (total_reward - cost, telegram_id))
+    entries.add(telegram_id, -cost, ledger.CHEST_BUY, chest_id=chest_id)
+    entries.add(telegram_id, total_reward, ledger.CHEST_REWARD, chest_id=chest_id)
+    return {"ok": True, "reward": total_reward, "rewards": rewards, "spent": cost}
+
+
+def open_chest(telegram_id: int, chest_id: int, count: int = 1) -> Dict[str, Any]:
+    """Открывает count сундуков одной транзакцией; цена всех сундуков списывается сразу, баланс меняется одним UPDATE."""
+    return apply_writes([("open_chest", (telegram_id, chest_id, count))])[0]
+
+
+# --- Пакетная запись ---
+# Намерение записи: функция, выполняемая внутри общей транзакции (курсор, общий буфер журнала, аргументы), и счетчики meta, которые она меняет при успехе
+WRITE_INTENTS = {
+    "place_bet": (_place_bet, ("polls_version", "users_version")),
+    "open_chest": (_open_chest, ("users_version",)),
+}
+
+
+def apply_writes(intents: List[tuple]) -> List[Dict[str, Any]]:
+    """Применяет пачку намерений (имя, аргументы) одной транзакцией и возвращает результат каждого.
+
+    Каждое намерение проверяется и выполняется в своем SAVEPOINT: отклоненное
+    (нет денег, повторная ставка, закрытый опрос) откатывается, не задевая
+    соседей по пачке. Счетчики meta увеличиваются один раз на всю пачку, а
+    записи журнала всех принятых намерений вставляются одним flush перед commit.
+    """
+    results = []
+    touched = set()
+    entries = ledger.LedgerBatch()
+    with connection() as conn:
+        cur = conn.cursor()
+        try:
+            _begin_immediate(cur)
+            for name, args in intents:
+                func, counters = WRITE_INTENTS[name]
+                cur.execute("SAVEPOINT intent")
+                savepoint = entries.savepoint()
+                try:
+                    result = func(cur, entries, *args)
+                except Exception as e:
+                    result = {"ok": False, "error": str(e)}
+                if not result.get("ok"):
+                    cur.execute("ROLLBACK TO intent")
+                    entries.rollback_to(savepoint)
+                else:
+                    touched.update(counters)
+                cur.execute("RELEASE intent")
+                results.append(result)
+            entries.flush(cur)
+            for key in sorted(touched):
+                _bump_meta(cur, key)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            return [{"ok": False, "error": str(e)} for _ in intents]
+    return results
+
+
+# --- Журнал движений баланса ---
+LEDGER_RETENTION_DAYS = int(os.environ.get("LEDGER_RETENTION_DAYS", "90"))
+LEDGER_COMPACT_CHUNK = int(os.environ.get("LEDGER_COMPACT_CHUNK", "5000"))
+
+
+def get_ledger(telegram_id: int, limit: int = 50, before_id: int | None = None) -> Dict[str, Any]:
+    """Страница истории пользователя от новых записей к старым; следующая страница запрашивается с before_id=next_before_id."""
+    with connection() as conn:
+        rows = conn.execute(LEDGER_PAGE_SQL, (telegram_id, before_id if before_id is not None else 2 ** 63 - 1, limit)).fetchall()
+    items = [ledger.entry_to_dict(row) for row in rows]
+    return {"items": items, "next_before_id": items[-1]["id"] if len(items) == limit else None}
+
+
+def get_ledger_daily(telegram_id: int, limit: int = 30, before_day: str | None = None) -> Dict[str, Any]:
+    """Дневные итоги свернутой части истории, от новых дней к старым."""
+    with connection() as conn:
+        days = conn.execute(
+            "SELECT DISTINCT day FROM ledger_daily WHERE telegram_id = ? AND day < ? ORDER BY day DESC LIMIT ?",
+            (telegram_id, before_day or "9999-12-31", limit),
+        ).fetchall()
+        if not days:
+            return {"items": [], "next_before_day": None}
+        oldest = days[-1]["day"]
+        rows = conn.execute(
+            "SELECT day, type, count, total FROM ledger_daily WHERE telegram_id = ? AND day < ? AND day >= ? ORDER BY day DESC, type",
+            (telegram_id, before_day or "9999-12-31", oldest),
+        ).fetchall()
+    return {"items": [ledger.daily_to_dict(row) for row in rows], "next_before_day": oldest if len(days) == limit else None}
+
+
+def compact_ledger(retention_days: int = LEDGER_RETENTION_DAYS, chunk: int = LEDGER_COMPACT_CHUNK) -> Dict[str, Any]:
+    """Сворачивает записи старше retention_days в дневные итоги.
+
+    Работает порциями по chunk самых старых записей, каждая в своей короткой
+    транзакции, чтобы не держать блокировку записи во время ставок.
+    """
+    cutoff = int(time.time()) - retention_days * 86400
+    compacted = 0
+    with connection() as conn:
+        cur = conn.cursor()
+        while True:
+            _begin_immediate(cur)
+            try:
+                rows = cur.execute("SELECT id, created_at FROM ledger ORDER BY id LIMIT ?", (chunk,)).fetchall()
+                old = [row["id"] for row in rows if row["created_at"] < cutoff]
+                if old:
+                    upper = old[-1]
+                    cur.execute("""
+                        INSERT INTO ledger_daily (telegram_id, day, type, count, total)
+                        SELECT telegram_id, date(created_at, 'unixepoch'), type, COUNT(*), SUM(amount)
+                        FROM ledger WHERE id <= ? AND created_at < ?
+                        GROUP BY telegram_id, date(created_at, 'unixepoch'), type
+                        ON CONFLICT(telegram_id, day, type) DO UPDATE SET count = count + excluded.count, total = total + excluded.total
+                    """, (upper, cutoff))
+                    cur.execute("DELETE FROM ledger WHERE id <= ? AND created_at < ?", (upper, cutoff))
+                    compacted += cur.rowcount
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            # Дальше идут только свежие записи
+            if len(old) < chunk:
+                break
+    return {"ok": True, "compacted": compacted}
+
+
+# --- Стартовые данные Mini App ---
+BOOTSTRAP_SECTIONS = ("user", "polls", "chests", "rating")
+
+
+def get_bootstrap(telegram_id: int, sections: Sequence[str] = BOOTSTRAP_SECTIONS, polls_limit: int = 50, rating_limit: int = 100) -> Dict[str, Any]:
+    """Данные первого экрана (пользователь, открытые опросы, сундуки, топ рейтинга) из одного снимка бд.
+
+    Все секции читаются в одной читающей транзакции, поэтому баланс
+    пользователя, суммы опросов и рейтинг согласованы между собой.
+    sections выбирает, какие секции включить; в ответе есть и версии
+    счетчиков изменений на момент снимка.
+    """
+    result: Dict[str, Any] = {}
+    with connection() as conn:
+        conn.execute("BEGIN")
+        try:
+            rows = conn.execute("SELECT key, value FROM meta WHERE key IN ('users_version', 'polls_version', 'chests_version', 'rating_version')").fetchall()
+            result["versions"] = {row["key"]: row["value"] for row in rows}
+            if "user" in sections:
+                row = conn.execute(USER_BY_ID_SQL, (telegram_id,)).fetchone()
+                result["user"] = dict(row) if row else None
+            if "polls" in sections:
+                result["polls"] = _list_polls(conn, True, polls_limit, 0)
+            if "chests" in sections:
+                result["chests"] = _list_chests(conn)
+            if "rating" in sections:
+                result["rating"] = _rated_users(conn, _snapshot_rating_page(conn, _get_meta(conn, "rating_version"), rating_limit))
+        finally:
+            conn.commit()
+    return result
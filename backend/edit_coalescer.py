@@ -0,0 +1,113 @@
+"""Склеивание правок сообщений Telegram.
+
+Каждая ставка меняет карточку опроса, но отправлять правку на каждую ставку
+нельзя: Telegram ограничивает частоту правок и отвечает "message is not
+modified" на повторы. Здесь запросы на правку одного сообщения копятся
+короткое время (debounce), затем отправляется только последнее состояние и
+не чаще одного раза в min_interval. Если отрисованный текст и клавиатура не
+изменились с прошлой отправки, правка пропускается. На TelegramRetryAfter
+отправка откладывается на указанное Telegram время.
+"""
+import asyncio
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import InlineKeyboardMarkup
+
+import metrics
+
+# Возвращает (текст, клавиатура) для текущего состояния сообщения или (None, None), если править нечего
+Render = Callable[[], Awaitable[Tuple[str | None, InlineKeyboardMarkup | None]]]
+
+MAX_TRACKED_MESSAGES = 512
+
+
+@dataclass
+class _MessageState:
+    render: Render | None = None
+    task: asyncio.Task | None = None
+    last_sent_at: float = float("-inf")
+    last_digest: str | None = None
+    retries: int = 0
+
+
+class EditCoalescer:
+    def __init__(self, bot: Bot, min_interval: float = 3.0, debounce: float = 0.5, max_retries: int = 3):
+        self.bot = bot
+        self.min_interval = min_interval
+        self.debounce = debounce
+        self.max_retries = max_retries
+        self._states: OrderedDict[tuple[int, int], _MessageState] = OrderedDict()
+
+    def request(self, chat_id: int, message_id: int, render: Render):
+        """Запрашивает правку сообщения; render будет вызван непосредственно перед отправкой."""
+        key = (chat_id, message_id)
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = _MessageState()
+            self._prune()
+        self._states.move_to_end(key)
+        state.render = render
+        if state.task is None or state.task.done():
+            state.task = asyncio.create_task(self._flush(key, state))
+
+    def _prune(self):
+        idle = [key for key, state in self._states.items() if state.task is None or state.task.done()]
+        for key in idle[:max(0, len(self._states) - MAX_TRACKED_MESSAGES)]:
+            del self._states[key]
+
+    @staticmethod
+    def _digest(text: str, markup: InlineKeyboardMarkup | None) -> str:
+        markup_json = markup.model_dump_json() if markup else ""
+        return hashlib.sha1(f"{text}\0{markup_json}".encode()).hexdigest()
+
+    async def _flush(self, key: tuple[int, int], state: _MessageState):
+        loop = asyncio.get_running_loop()
+        await asyncio.sleep(self.debounce)
+        while state.render is not None:
+            wait = state.last_sent_at + self.min_interval - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            render, state.render = state.render, None
+            try:
+                text, markup = await render()
+            except Exception as e:
+                print(f"Не удалось подготовить правку сообщения {key[1]}: {e}")
+                continue
+            if text is None:
+                continue
+            digest = self._digest(text, markup)
+            if digest == state.last_digest:
+                continue
+            await self._send(key, state, render, text, markup, digest)
+
+    async def _send(self, key: tuple[int, int], state: _MessageState, render: Render, text: str, markup: InlineKeyboardMarkup | None, digest: str):
+        chat_id, message_id = key
+        loop = asyncio.get_running_loop()
+        try:
+            await self.bot.edit_message_text(text=text, chat_id=chat_id, message_id=message_id, reply_markup=markup)
+            state.last_digest, state.last_sent_at, state.retries = digest, loop.time(), 0
+        except TelegramRetryAfter as e:
+            metrics.TELEGRAM_EDIT_FAILURES.inc("retry_after")
+            state.retries += 1
+            if state.retries > self.max_retries:
+                print(f"Правка сообщения {message_id} отброшена после {self.max_retries} повторов из-за ограничения Telegram.")
+                state.retries = 0
+                return
+            # Повторяем позже, но с самым свежим состоянием, если оно успело появиться
+            state.last_sent_at = loop.time() + e.retry_after * state.retries - self.min_interval
+            if state.render is None:
+                state.render = render
+        except TelegramBadRequest as e:
+            if "message is not modified" in e.message:
+                state.last_digest = digest
+            else:
+                metrics.TELEGRAM_EDIT_FAILURES.inc("bad_request")
+                print(f"Не удалось изменить сообщение {message_id}: {e.message}")
+        except Exception as e:
+            metrics.TELEGRAM_EDIT_FAILURES.inc("error")
+            print(f"Не удалось изменить сообщение {message_id}: {e}")
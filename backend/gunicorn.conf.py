@@ -0,0 +1,18 @@
+"""Настройки gunicorn; Dockerfile запускает его из этого каталога, и файл подхватывается автоматически."""
+import os
+import tempfile
+
+
+def on_starting(server):
+    # Метрики воркеров сводятся через общий каталог (см. metrics); задается до импорта db,
+    # который импортирует metrics, иначе воркеры унаследуют модуль без каталога
+    os.environ.setdefault("METRICS_DIR", os.path.join(tempfile.gettempdir(), f"tg-miniapp-metrics-{os.getpid()}"))
+    import metrics
+    metrics.clear_dir()
+    # Пересоздание бд и миграции выполняются один раз в мастер-процессе, до запуска воркеров:
+    # иначе каждый воркер удалял бы файл бд, который соседи уже держат открытым
+    import db
+    db.init_db()
+    # Соединения не должны переходить в воркеры через fork
+    db.close_pool()
+    os.environ["RECREATE_DB_ON_STARTUP"] = "false"
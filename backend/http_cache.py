@@ -0,0 +1,82 @@
+"""HTTP-кэш ответов для эндпоинтов чтения.
+
+Каждый ресурс привязан к счетчикам изменений из таблицы meta (polls_version,
+users_version, ...), которые увеличиваются в тех же транзакциях, что и сами
+изменения. ETag строится из ключа ответа и версии, поэтому на If-None-Match
+можно ответить 304 после одного чтения счетчиков, не загружая и не
+сериализуя данные. Готовые байты ответа хранятся в памяти процесса (LRU с
+TTL): TTL ограничивает время жизни записи, даже если изменение прошло мимо
+счетчиков, например при ручной правке бд.
+"""
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable
+
+from fastapi import Request, Response
+
+HTTP_CACHE_SIZE = int(os.environ.get("HTTP_CACHE_SIZE", "1024"))
+HTTP_CACHE_TTL = float(os.environ.get("HTTP_CACHE_TTL", "60"))
+
+# Клиент хранит ответ, но перед использованием обязан перепроверить его по ETag
+REVALIDATE = "no-cache"
+
+
+class ResponseCache:
+    def __init__(self, maxsize: int = HTTP_CACHE_SIZE, ttl: float = HTTP_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict[str, tuple[str, float, bytes]] = OrderedDict()
+
+    def get(self, key: str, version: str) -> bytes | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        cached_version, expires_at, body = entry
+        if cached_version != version or expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return body
+
+    def put(self, key: str, version: str, body: bytes):
+        self._entries[key] = (version, time.monotonic() + self.ttl, body)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+cache = ResponseCache()
+
+
+def make_etag(key: str, version: str) -> str:
+    return '"' + hashlib.sha1(f"{key}:{version}".encode()).hexdigest()[:20] + '"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Слабые ETag (W/"...") сравниваются по значению, как требует RFC 9110 для If-None-Match
+    candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return etag in candidates
+
+
+async def cached_json(request: Request, key: str, version: Any, produce: Callable[[], Awaitable[Any]], cache_control: str = REVALIDATE) -> Response:
+    """Ответ JSON с ETag: 304 по If-None-Match, иначе байты из кэша или свежий результат produce()."""
+    version = str(version)
+    etag = make_etag(key, version)
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    body = cache.get(key, version)
+    if body is None:
+        body = json.dumps(await produce(), ensure_ascii=False, separators=(",", ":")).encode()
+        cache.put(key, version, body)
+    return Response(content=body, media_type="application/json", headers=headers)
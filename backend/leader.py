@@ -0,0 +1,59 @@
+"""Выбор единственного процесса, в котором работают Telegram-бот и планировщик.
+
+Лидер удерживает эксклюзивную блокировку flock на файле рядом с бд. Если
+процесс-лидер завершается, блокировку снимает ОС, и ее забирает следующий
+ожидающий процесс, поэтому при нескольких воркерах gunicorn опрос Telegram,
+бэкапы и автозакрытие опросов никогда не запускаются дважды.
+"""
+import asyncio
+import fcntl
+import os
+from pathlib import Path
+
+import db
+
+BOT_LOCK_PATH = Path(os.environ.get("BOT_LOCK_PATH") or f"{db.DB_PATH}.bot.lock")
+LEADER_RETRY_INTERVAL = float(os.environ.get("LEADER_RETRY_INTERVAL", "5"))
+
+
+class LeaderLock:
+    def __init__(self, path: Path = BOT_LOCK_PATH):
+        self.path = path
+        self._fd: int | None = None
+
+    def try_acquire(self) -> bool:
+        if self._fd is not None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, f"{os.getpid()}\n".encode())
+        self._fd = fd
+        return True
+
+    async def acquire(self, retry_interval: float = LEADER_RETRY_INTERVAL):
+        while not self.try_acquire():
+            await asyncio.sleep(retry_interval)
+
+    def release(self):
+        if self._fd is None:
+            return
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+
+async def run_as_leader(lock: LeaderLock, coro_factory):
+    """Ждет блокировку лидера и выполняет coro_factory(); после завершения блокировка освобождается."""
+    if not lock.try_acquire():
+        print(f"⏳ Бот уже запущен другим процессом (pid {os.getpid()} ждет освобождения {lock.path})")
+        await lock.acquire()
+    print(f"👑 Процесс {os.getpid()} стал лидером: запускаю бота и планировщик")
+    try:
+        await coro_factory()
+    finally:
+        lock.release()
@@ -0,0 +1,95 @@
+"""Рейтинг игроков в памяти.
+
+Игроки хранятся в отсортированном списке ключей (-winrate, -wins, telegram_id),
+поэтому место игрока и любая страница рейтинга находятся бинарным поиском,
+а после разрешения опроса переставляются только игроки, у которых изменились
+победы и поражения.
+
+Рейтинг помечается версией из бд (счетчик rating_version). Изменения
+применяются инкрементально, только если их версия следует сразу за текущей;
+иначе (например, опрос разрешил другой процесс) рейтинг перезагружается.
+"""
+import bisect
+import threading
+from typing import Iterable, List, Tuple
+
+
+def winrate(wins: int, losses: int) -> float:
+    total = wins + losses
+    return round((wins / total) * 100, 2) if total > 0 else 0.0
+
+
+class Leaderboard:
+    def __init__(self):
+        self._keys: List[Tuple[float, int, int]] = []
+        self._by_user: dict[int, Tuple[float, int, int]] = {}
+        self._lock = threading.Lock()
+        self.loaded = False
+        self.version = 0
+
+    @staticmethod
+    def _key(telegram_id: int, wins: int, losses: int) -> Tuple[float, int, int]:
+        return (-winrate(wins, losses), -wins, telegram_id)
+
+    def load(self, rows: Iterable[Tuple[int, int, int]], version: int = 0):
+        """Полностью перестраивает рейтинг из строк (telegram_id, wins, losses)."""
+        by_user = {telegram_id: self._key(telegram_id, wins, losses) for telegram_id, wins, losses in rows}
+        with self._lock:
+            self._by_user = by_user
+            self._keys = sorted(by_user.values())
+            self.version = version
+            self.loaded = True
+
+    def is_current(self, version: int) -> bool:
+        return self.loaded and self.version == version
+
+    def apply_changes(self, version: int, changes: Iterable[Tuple[int, int, int]]):
+        """Применяет изменения (telegram_id, wins, losses), записанные в бд под версией version."""
+        with self._lock:
+            if not self.loaded:
+                return
+            if self.version != version - 1:
+                self.loaded = False
+                return
+            for telegram_id, wins, losses in changes:
+                self._update_locked(telegram_id, wins, losses)
+            self.version = version
+
+    def invalidate(self):
+        """Помечает рейтинг устаревшим: при следующем обращении он будет загружен заново."""
+        with self._lock:
+            self.loaded = False
+
+    def _update_locked(self, telegram_id: int, wins: int, losses: int):
+        key = self._key(telegram_id, wins, losses)
+        old_key = self._by_user.get(telegram_id)
+        if old_key == key:
+            return
+        if old_key is not None:
+            del self._keys[bisect.bisect_left(self._keys, old_key)]
+        bisect.insort(self._keys, key)
+        self._by_user[telegram_id] = key
+
+    def page(self, limit: int | None = None, offset: int = 0) -> List[Tuple[int, int]]:
+        """Возвращает [(место, telegram_id), ...] для страницы рейтинга; места начинаются с 1."""
+        with self._lock:
+            end = len(self._keys) if limit is None else offset + limit
+            return [(offset + i + 1, key[2]) for i, key in enumerate(self._keys[offset:end])]
+
+    def page_at(self, version: int, limit: int | None = None, offset: int = 0) -> List[Tuple[int, int]] | None:
+        """Как page, но только если рейтинг ровно версии version; иначе None."""
+        with self._lock:
+            if not self.is_current(version):
+                return None
+            end = len(self._keys) if limit is None else offset + limit
+            return [(offset + i + 1, key[2]) for i, key in enumerate(self._keys[offset:end])]
+
+    def rank_of(self, telegram_id: int) -> int | None:
+        with self._lock:
+            key = self._by_user.get(telegram_id)
+            if key is None:
+                return None
+            return bisect.bisect_left(self._keys, key) + 1
+
+    def __len__(self) -> int:
+        return len(self._keys)
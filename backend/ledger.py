@@ -0,0 +1,74 @@
+"""Журнал движений баланса.
+
+Каждая запись - это компактная строка: пользователь, сумма, целочисленный
+код типа, ссылка на опрос или сундук и время в секундах эпохи. Записи одной
+транзакции копятся в LedgerBatch и вставляются одним executemany перед commit
+той же транзакции, в которой меняется баланс. При пакетной записи
+(db.apply_writes) буфер общий на всю пачку намерений, а записи отклоненного
+намерения отбрасываются вместе с его SAVEPOINT.
+
+Старые записи сворачиваются в дневные итоги (ledger_daily: пользователь,
+день, тип, количество, сумма), поэтому журнал не растет бесконечно, а
+история пользователя остается доступной в агрегированном виде.
+"""
+import sqlite3
+import time
+from typing import Any, Dict, List
+
+BET = 1
+BET_WIN = 2
+CHEST_BUY = 3
+CHEST_REWARD = 4
+ADMIN_ADD = 5
+
+TYPE_NAMES = {
+    BET: "bet",
+    BET_WIN: "bet_win",
+    CHEST_BUY: "chest_buy",
+    CHEST_REWARD: "chest_reward",
+    ADMIN_ADD: "admin_add",
+}
+TYPE_CODES = {name: code for code, name in TYPE_NAMES.items()}
+
+
+class LedgerBatch:
+    """Записи журнала одной транзакции; flush() вставляет их разом и очищает буфер."""
+
+    def __init__(self):
+        self.created_at = int(time.time())
+        self._rows: List[tuple] = []
+
+    def add(self, telegram_id: int, amount: int, type_code: int, poll_id: int | None = None, chest_id: int | None = None):
+        self._rows.append((telegram_id, amount, type_code, poll_id, chest_id, self.created_at))
+
+    def savepoint(self) -> int:
+        return len(self._rows)
+
+    def rollback_to(self, savepoint: int):
+        """Отбрасывает записи, добавленные после savepoint (вместе с ROLLBACK TO в бд)."""
+        del self._rows[savepoint:]
+
+    def flush(self, cur: sqlite3.Cursor):
+        if self._rows:
+            cur.executemany("INSERT INTO ledger (telegram_id, amount, type, poll_id, chest_id, created_at) VALUES (?, ?, ?, ?, ?, ?)", self._rows)
+            self._rows = []
+
+
+def entry_to_dict(row: sqlite3.Row) -> Dict[str, Any]:
+    return {
+        "id": row["id"],
+        "amount": row["amount"],
+        "type": TYPE_NAMES.get(row["type"], str(row["type"])),
+        "poll_id": row["poll_id"],
+        "chest_id": row["chest_id"],
+        "created_at": row["created_at"],
+    }
+
+
+def daily_to_dict(row: sqlite3.Row) -> Dict[str, Any]:
+    return {
+        "day": row["day"],
+        "type": TYPE_NAMES.get(row["type"], str(row["type"])),
+        "count": row["count"],
+        "total": row["total"],
+    }
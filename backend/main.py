@@ -1,28 +1,87 @@
-import importlib.metadata
-try:
-    version = importlib.metadata.version('google-generativeai')
-    print(f"✅ Обнаружена версия google-generativeai: {version}")
-except importlib.metadata.PackageNotFoundError:
-    print("❌ Библиотека google-generativeai НЕ НАЙДЕНА.")
-
 import asyncio
+import importlib
+import os
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Query, Request
+from pydantic import BaseModel, Field
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
 import traceback
 import db
-import bot 
+import adb
+from leader import LeaderLock, run_as_leader
+import webhook
+import metrics
+import http_cache
+import poll_events
+import time
+
+# embedded: бот работает внутри одного из веб-воркеров (выбирается блокировкой лидера);
+# external: веб-воркеры только обслуживают HTTP, бот запускается отдельно через bot_runner.py
+BOT_MODE = os.environ.get("BOT_MODE", "embedded")
+
+# --- Загрузка бота ---
+# Модуль bot (aiogram, обработчики, AI) импортируется несколько секунд. Чтобы API и /health
+# отвечали сразу после старта воркера, он загружается в фоне, а эндпоинты, которым нужен бот,
+# ждут загрузки через loaded_bot().
+bot = None
+_bot_loading: asyncio.Task | None = None
+
+async def _load_bot():
+    global bot
+    started = time.perf_counter()
+    module = await asyncio.to_thread(importlib.import_module, "bot")
+    module.init_bot()
+    if module.BOT_UPDATE_MODE == "webhook":
+        # Обновления приходят в любой воркер, поэтому очередь обработки есть в каждом из них
+        module.update_queue.start()
+    bot = module
+    print(f"🤖 Модуль бота загружен за {time.perf_counter() - started:.1f} с")
+    return module
+
+async def loaded_bot():
+    global _bot_loading
+    if bot is not None:
+        return bot
+    if _bot_loading is None:
+        _bot_loading = asyncio.create_task(_load_bot())
+    return await asyncio.shield(_bot_loading)
+
+def bot_status() -> str:
+    if bot is not None:
+        return "ready"
+    if _bot_loading is not None and _bot_loading.done():
+        return "failed"
+    return "loading"
+
+async def _run_bot():
+    try:
+        module = await loaded_bot()
+    except Exception:
+        print("❌ Не удалось загрузить модуль бота, API работает без него")
+        traceback.print_exc()
+        return
+    if BOT_MODE == "embedded":
+        print("🤖 Бот и планировщик запускаются в воркере-лидере...")
+        await run_as_leader(LeaderLock(), module.start_bot)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     print("🚀 Startup: инициализация базы данных")
     db.init_db()
-    bot_task = asyncio.create_task(bot.start_bot())
-    print("🤖 Бот и планировщик запущены...")
+    poll_events.hub.start()
+    metrics_task = asyncio.create_task(metrics.flush_periodically())
+    bot_task = asyncio.create_task(_run_bot())
     yield
     print("🛑 Shutting down bot...")
     bot_task.cancel()
+    metrics_task.cancel()
+    await asyncio.gather(metrics_task, return_exceptions=True)
+    if bot is not None:
+        await bot.update_queue.stop()
+    await poll_events.hub.stop()
+    adb.shutdown()
+    db.close_pool()
 
 app = FastAPI(title="TG MiniApp Backend", lifespan=lifespan)
 
@@ -34,10 +93,38 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    if not metrics.ENABLED:
+        return await call_next(request)
+    # Выборкой прореживаются только замеры длительности, ошибки считаются все
+    sampled = metrics.sampled()
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        if sampled or status >= 500:
+            # Метка - шаблон маршрута (/api/me/{telegram_id}), а не конкретный путь, чтобы не плодить ряды
+            route = request.scope.get("route")
+            route_path = getattr(route, "path", "unmatched")
+            if sampled:
+                metrics.HTTP_LATENCY.observe(time.perf_counter() - started, request.method, route_path, str(status))
+            if status >= 500:
+                metrics.HTTP_ERRORS.inc(request.method, route_path)
+
 class InitPayload(BaseModel):
     telegram_id: int
     username: str | None = None
 
+class BootstrapPayload(InitPayload):
+    # Какие секции вернуть (db.BOOTSTRAP_SECTIONS); по умолчанию все, пустой список - ни одной
+    include: list[str] | None = None
+    polls_limit: int = Field(50, ge=1, le=200)
+    rating_limit: int = Field(100, ge=1, le=500)
+
 class PlaceBetPayload(BaseModel):
     telegram_id: int
     poll_id: int
@@ -47,12 +134,13 @@ class PlaceBetPayload(BaseModel):
 class OpenChestPayload(BaseModel):
     telegram_id: int
     chest_id: int
+    # Больше одного - пакетное открытие в одной транзакции
+    count: int = 1
 
 @app.post("/api/auth")
 async def api_auth(payload: InitPayload):
     try:
-        db.ensure_user(payload.telegram_id, payload.username)
-        user = db.get_user(payload.telegram_id)
+        user = await adb.auth_user(payload.telegram_id, payload.username)
         if not user:
             raise HTTPException(status_code=500, detail="User creation failed")
         return {"ok": True, "user": user}
@@ -60,45 +148,71 @@ async def api_auth(payload: InitPayload):
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/bootstrap")
+async def api_bootstrap(payload: BootstrapPayload):
+    # Первый экран Mini App одним запросом вместо auth, me, polls, chests и rating по отдельности
+    sections = list(db.BOOTSTRAP_SECTIONS) if payload.include is None else payload.include
+    unknown = set(sections) - set(db.BOOTSTRAP_SECTIONS)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown sections: {', '.join(sorted(unknown))}")
+    try:
+        data = await adb.bootstrap(payload.telegram_id, payload.username, sections, payload.polls_limit, payload.rating_limit)
+        return {"ok": True, **data}
+    except Exception as e:
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/api/me/{telegram_id}")
-async def api_me(telegram_id: int):
-    user = db.get_user(telegram_id)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    return user
+async def api_me(request: Request, telegram_id: int):
+    async def load():
+        user = await adb.get_user(telegram_id)
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+        return user
+    versions = await adb.get_versions("users_version")
+    return await http_cache.cached_json(request, f"me:{telegram_id}", versions["users_version"], load, cache_control="private, no-cache")
 
 @app.get("/api/polls")
-async def api_list_polls():
-    return db.list_polls(open_only=True)
+async def api_list_polls(request: Request, limit: int = Query(50, ge=1, le=200), offset: int = Query(0, ge=0), open_only: bool = True):
+    versions = await adb.get_versions("polls_version")
+    return await http_cache.cached_json(
+        request, f"polls:{open_only}:{limit}:{offset}", versions["polls_version"],
+        lambda: adb.list_polls(open_only=open_only, limit=limit, offset=offset),
+    )
+
+@app.get("/api/polls/stream")
+async def api_poll_stream():
+    # Дельты опросов (суммы по вариантам, статус) в формате server-sent events
+    return StreamingResponse(
+        poll_events.hub.stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 @app.post("/api/bet")
 async def api_place_bet(payload: PlaceBetPayload):
     try:
-        res = db.place_bet(payload.telegram_id, payload.poll_id, payload.option_id, payload.amount)
+        res = await adb.place_bet(payload.telegram_id, payload.poll_id, payload.option_id, payload.amount)
         if not res.get("ok"):
             raise HTTPException(status_code=400, detail=res.get("error"))
         
-        poll = db.get_poll(payload.poll_id)
-        if poll and poll.get('message_id'):
-            new_text = bot.format_poll_text(payload.poll_id)
-            if new_text and bot.CHAT_ID:
-                try:
-                    await bot.bot.edit_message_text(new_text, bot.CHAT_ID, poll['message_id'])
-                except Exception as e:
-                    print(f"Failed to edit message after web bet: {e}")
+        # Карточку опроса в чате поправит лидер, заметив новую версию опроса
+        poll_events.hub.notify(payload.poll_id)
         return res
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/chests")
-async def api_chests():
-    return db.list_chests()
+async def api_chests(request: Request):
+    # Сундуки - почти статичная настройка, клиенту можно не перепроверять их несколько минут
+    versions = await adb.get_versions("chests_version")
+    return await http_cache.cached_json(request, "chests", versions["chests_version"], adb.list_chests, cache_control="public, max-age=300")
 
 @app.post("/api/chests/open")
 async def api_open_chest(payload: OpenChestPayload):
     try:
-        res = db.open_chest(payload.telegram_id, payload.chest_id)
+        res = await adb.open_user_chest(payload.telegram_id, payload.chest_id, payload.count)
         if not res.get("ok"):
             raise HTTPException(status_code=400, detail=res.get("error"))
         return res
@@ -107,9 +221,68 @@ async def api_open_chest(payload: OpenChestPayload):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/rating")
-async def api_rating():
-    return db.get_rating()
+async def api_rating(request: Request, limit: int = Query(100, ge=1, le=500), offset: int = Query(0, ge=0)):
+    # Рейтинг отдается страницами: без параметров - первые 100 мест (раньше - все пользователи), дальше через offset
+    # В рейтинге есть балансы, поэтому он зависит и от порядка мест, и от любых изменений пользователей
+    versions = await adb.get_versions("rating_version", "users_version")
+    return await http_cache.cached_json(
+        request, f"rating:{limit}:{offset}", f"{versions['rating_version']}.{versions['users_version']}",
+        lambda: adb.get_rating(limit=limit, offset=offset),
+    )
+
+@app.get("/api/rating/{telegram_id}")
+async def api_my_rank(request: Request, telegram_id: int):
+    async def load():
+        rank = await adb.get_user_rank(telegram_id)
+        if not rank:
+            raise HTTPException(status_code=404, detail="User not found")
+        return rank
+    versions = await adb.get_versions("rating_version", "users_version")
+    return await http_cache.cached_json(
+        request, f"rank:{telegram_id}", f"{versions['rating_version']}.{versions['users_version']}", load,
+        cache_control="private, no-cache",
+    )
+
+@app.get("/api/history/{telegram_id}")
+async def api_history(telegram_id: int, limit: int = Query(50, ge=1, le=200), before_id: int | None = Query(None, ge=1)):
+    return await adb.get_ledger(telegram_id, limit=limit, before_id=before_id)
+
+@app.get("/api/history/{telegram_id}/daily")
+async def api_history_daily(telegram_id: int, limit: int = Query(30, ge=1, le=365), before_day: str | None = Query(None, pattern=r"^\d{4}-\d{2}-\d{2}$")):
+    return await adb.get_ledger_daily(telegram_id, limit=limit, before_day=before_day)
+
+@app.post(webhook.WEBHOOK_PATH, include_in_schema=False)
+async def telegram_webhook(request: Request):
+    # Без секрета эндпоинт принял бы обновления от кого угодно
+    if not webhook.WEBHOOK_SECRET:
+        raise HTTPException(status_code=404, detail="Webhook mode is disabled")
+    if not webhook.check_secret(webhook.WEBHOOK_SECRET, request.headers.get(webhook.SECRET_HEADER)):
+        raise HTTPException(status_code=403, detail="Invalid secret token")
+    try:
+        body = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+    # Обновления, пришедшие во время холодного старта, ждут загрузки бота, а не теряются
+    bot = await loaded_bot()
+    if not bot.update_queue.running:
+        raise HTTPException(status_code=404, detail="Webhook mode is disabled")
+    from aiogram.types import Update
+    try:
+        update = Update.model_validate(body, context={"bot": bot.bot})
+    except ValueError:
+        # ValidationError pydantic - подкласс ValueError; повторять такую доставку бесполезно
+        raise HTTPException(status_code=400, detail="Invalid update")
+    if not bot.update_queue.submit(update):
+        # Telegram повторит доставку позже
+        raise HTTPException(status_code=503, detail="Update queue is full")
+    return {"ok": True}
 
 @app.get("/health")
 async def health_check():
-    return {"status": "ok"}
\ No newline at end of file
+    # Отвечает сразу после старта; состояние бота - отдельным полем
+    return {"status": "ok", "bot": bot_status()}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    # Значения остальных воркеров читаются из файлов METRICS_DIR
+    return PlainTextResponse(await asyncio.to_thread(metrics.render), media_type="text/plain; version=0.0.4")
\ No newline at end of file
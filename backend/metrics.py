@@ -0,0 +1,241 @@
+"""Метрики в формате Prometheus для эндпоинта /metrics.
+
+Счетчики и гистограммы хранятся в памяти процесса. METRICS_SAMPLE_RATE задает
+долю замеров длительности, которые записываются (1 - все, 0 - метрики
+выключены); при выключенных метриках таймеры сводятся к одной проверке флага.
+Счетчики ошибок выборкой не прореживаются.
+
+Под gunicorn воркеров несколько, а запрос /metrics попадает в случайный из
+них. Поэтому при заданном METRICS_DIR каждый процесс раз в
+METRICS_FLUSH_INTERVAL секунд сохраняет свои значения в отдельный файл этого
+каталога, а /metrics складывает значения своего процесса с файлами остальных.
+Файлы завершившихся воркеров не удаляются, чтобы счетчики не уменьшались;
+каталог очищает мастер gunicorn при старте (gunicorn.conf.py). Значения
+соседних воркеров в ответе отстают не больше чем на METRICS_FLUSH_INTERVAL.
+"""
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Sequence
+
+METRICS_SAMPLE_RATE = float(os.environ.get("METRICS_SAMPLE_RATE", "1"))
+ENABLED = METRICS_SAMPLE_RATE > 0
+METRICS_DIR = os.environ.get("METRICS_DIR")
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", "5"))
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry: list["_Metric"] = []
+
+
+def sampled() -> bool:
+    return ENABLED and (METRICS_SAMPLE_RATE >= 1 or random.random() < METRICS_SAMPLE_RATE)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _labels(self, labels: tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, labels)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def snapshot(self) -> list:
+        """Значения в виде, пригодном для JSON: [[метки, значение], ...]."""
+        with self._lock:
+            return [[list(labels), self._dump(value)] for labels, value in self._values.items()]
+
+    def render(self, others: Sequence[list] = ()) -> list[str]:
+        """Строки метрики; others - снимки (snapshot) других процессов, которые складываются с текущими значениями."""
+        with self._lock:
+            values = {labels: self._dump(value) for labels, value in self._values.items()}
+        for snapshot in others:
+            for labels, value in snapshot:
+                labels = tuple(labels)
+                values[labels] = self._merge(values[labels], value) if labels in values else value
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for labels, value in sorted(values.items()):
+            lines.extend(self._lines(labels, value))
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        if not ENABLED:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    @staticmethod
+    def _dump(value: float) -> float:
+        return value
+
+    @staticmethod
+    def _merge(value: float, other: float) -> float:
+        return value + other
+
+    def _lines(self, labels: tuple, value: float) -> list[str]:
+        return [f"{self.name}{self._labels(labels)} {value}"]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # по каждому набору меток: [счетчики по корзинам..., +Inf], сумма
+        self._values: dict[tuple, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *labels):
+        if not ENABLED:
+            return
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(labels, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[index] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, *labels):
+        if not sampled():
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    @staticmethod
+    def _dump(value: tuple[list[int], list[float]]) -> list:
+        # [счетчики по корзинам, сумма]
+        counts, total = value
+        return [list(counts), total[0]]
+
+    @staticmethod
+    def _merge(value: list, other: list) -> list:
+        return [[a + b for a, b in zip(value[0], other[0])], value[1] + other[1]]
+
+    def _lines(self, labels: tuple, value: list) -> list[str]:
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            le = self._labels(labels, f'le="{bound}"')
+            lines.append(f"{self.name}_bucket{le} {cumulative}")
+        cumulative += counts[-1]
+        le = self._labels(labels, 'le="+Inf"')
+        lines.append(f"{self.name}_bucket{le} {cumulative}")
+        lines.append(f"{self.name}_sum{self._labels(labels)} {total}")
+        lines.append(f"{self.name}_count{self._labels(labels)} {cumulative}")
+        return lines
+
+
+# --- Сведение метрик воркеров ---
+# Файл процесса: pid и время первого сохранения, чтобы новый воркер с тем же pid не затер файл завершившегося
+_process_file: tuple[int, Path] | None = None
+
+
+def _own_file() -> Path:
+    global _process_file
+    if _process_file is None or _process_file[0] != os.getpid():
+        _process_file = (os.getpid(), Path(METRICS_DIR) / f"{os.getpid()}-{time.time_ns()}.json")
+    return _process_file[1]
+
+
+def flush():
+    """Сохраняет значения процесса в METRICS_DIR, откуда их читают остальные воркеры."""
+    if not (ENABLED and METRICS_DIR):
+        return
+    path = _own_file()
+    data = {metric.name: metric.snapshot() for metric in _registry}
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(data), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+async def flush_periodically(interval: float = METRICS_FLUSH_INTERVAL):
+    if not (ENABLED and METRICS_DIR):
+        return
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            await asyncio.to_thread(flush)
+    finally:
+        flush()
+
+
+def _other_processes() -> dict[str, list[list]]:
+    """Снимки остальных процессов по именам метрик."""
+    others: dict[str, list[list]] = {}
+    if not (ENABLED and METRICS_DIR):
+        return others
+    own = _own_file()
+    for path in Path(METRICS_DIR).glob("*.json"):
+        if path == own:
+            continue
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            continue
+        for name, snapshot in data.items():
+            others.setdefault(name, []).append(snapshot)
+    return others
+
+
+def clear_dir():
+    """Удаляет файлы прошлого запуска; вызывается мастером gunicorn до запуска воркеров."""
+    if not METRICS_DIR:
+        return
+    path = Path(METRICS_DIR)
+    path.mkdir(parents=True, exist_ok=True)
+    for file in path.glob("*.json"):
+        file.unlink(missing_ok=True)
+
+
+def render() -> str:
+    others = _other_processes()
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render(others.get(metric.name, ())))
+    return "\n".join(lines) + "\n"
+
+
+# --- Метрики приложения ---
+HTTP_LATENCY = Histogram("http_request_duration_seconds", "Длительность HTTP-запросов", ("method", "route", "status"))
+HTTP_ERRORS = Counter("http_request_errors_total", "HTTP-запросы, завершившиеся ошибкой 5xx или исключением", ("method", "route"))
+DB_CALL_LATENCY = Histogram("db_call_duration_seconds", "Время выполнения функций db", ("function",))
+DB_LOCK_WAIT = Histogram("db_begin_immediate_wait_seconds", "Ожидание блокировки записи в BEGIN IMMEDIATE")
+DB_BUSY_RETRIES = Counter("db_busy_retries_total", "Повторы BEGIN IMMEDIATE после ошибки database is locked")
+TELEGRAM_LATENCY = Histogram("telegram_api_duration_seconds", "Длительность вызовов Bot API", ("method",))
+TELEGRAM_ERRORS = Counter("telegram_api_errors_total", "Вызовы Bot API, завершившиеся ошибкой", ("method", "error"))
+TELEGRAM_EDIT_FAILURES = Counter("telegram_edit_failures_total", "Неудачные правки карточек опросов", ("reason",))
+BOT_UPDATE_LATENCY = Histogram("bot_update_duration_seconds", "Длительность обработки обновлений Telegram", ("event_type",))
+SCHEDULER_LAG = Histogram("scheduler_lag_seconds", "Опоздание запуска задач планировщика относительно срока", ("job",), buckets=(0.001, 0.01, 0.1, 0.5, 1, 5, 30, 60, 300))
+WRITE_BATCH_SIZE = Histogram("db_write_batch_size", "Намерений записи в одной групповой транзакции", buckets=(1, 2, 4, 8, 16, 32, 64, 128))
@@ -0,0 +1,156 @@
+"""Рассылка изменений опросов подписчикам Mini App (server-sent events).
+
+Все подключенные клиенты процесса получают события из одного хаба: при
+изменении опроса он один раз читает его из бд и раскладывает компактную
+дельту (суммы по вариантам, статус) по очередям подписчиков. Поэтому N
+открытых вкладок стоят одного чтения на изменение, а не N запросов всего
+списка.
+
+Изменения, сделанные в этом процессе, сообщаются через notify() и уходят
+сразу. Изменения из других процессов (бот в отдельном контейнере, другие
+воркеры) хаб замечает, раз в sweep_interval сверяя версии открытых опросов.
+"""
+import asyncio
+import json
+import os
+from typing import Any, AsyncIterator, Dict
+
+import adb
+
+# Как часто хаб сверяет версии опросов, измененных другими процессами
+POLL_EVENTS_SWEEP_INTERVAL = float(os.environ.get("POLL_EVENTS_SWEEP_INTERVAL", "2"))
+
+# Отправляется подписчику, чья очередь переполнилась: клиент должен заново загрузить список
+RESYNC = {"type": "resync"}
+
+
+class _Subscriber:
+    def __init__(self, maxsize: int):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+
+    def put(self, event: Dict[str, Any]):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Медленный клиент: вместо накопленных дельт он получит одну команду перезагрузки
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC)
+
+
+def poll_delta(poll: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "type": "poll",
+        "id": poll["id"],
+        "version": poll["version"],
+        "status": poll["status"],
+        "total_pool": poll["total_pool"],
+        "options": [{"id": opt["id"], "total_bet": opt["total_bet"], "bettors": opt["bettors"]} for opt in poll["options"]],
+    }
+
+
+def format_sse(event: Dict[str, Any]) -> str:
+    return f"data: {json.dumps(event, ensure_ascii=False, separators=(',', ':'))}\n\n"
+
+
+class PollEventHub:
+    def __init__(self, sweep_interval: float = 2.0, heartbeat: float = 15.0, queue_size: int = 100):
+        self.sweep_interval = sweep_interval
+        self.heartbeat = heartbeat
+        self.queue_size = queue_size
+        self._subscribers: set[_Subscriber] = set()
+        self._versions: Dict[int, int] = {}
+        self._dirty: set[int] = set()
+        self._synced = False
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def notify(self, poll_id: int):
+        """Сообщает, что опрос изменился; дельта уйдет подписчикам без ожидания сверки."""
+        if self._task is None or not self._subscribers:
+            return
+        self._dirty.add(poll_id)
+        self._wakeup.set()
+
+    async def stream(self) -> AsyncIterator[str]:
+        """Поток SSE для одного клиента: дельты опросов и комментарии-пинги, чтобы прокси не закрывали соединение."""
+        subscriber = _Subscriber(self.queue_size)
+        self._subscribers.add(subscriber)
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscriber.queue.get(), timeout=self.heartbeat)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                yield format_sse(event)
+        finally:
+            self._subscribers.discard(subscriber)
+
+    def _publish(self, event: Dict[str, Any]):
+        for subscriber in self._subscribers:
+            subscriber.put(event)
+
+    async def _sweep(self):
+        versions = await adb.get_active_poll_versions()
+        if not self._synced:
+            # Первая сверка только запоминает версии: текущее состояние клиент берет из /api/polls
+            self._versions, self._synced = versions, True
+            return
+        # Опрос пропал из открытых - значит, он разрешен, и об этом тоже надо сообщить
+        for poll_id in self._versions.keys() - versions.keys():
+            self._dirty.add(poll_id)
+        for poll_id, version in versions.items():
+            if self._versions.get(poll_id) != version:
+                self._dirty.add(poll_id)
+        self._versions = versions
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_sweep = loop.time()
+        while True:
+            timeout = max(0.0, next_sweep - loop.time())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if not self._subscribers:
+                # Без подписчиков не читаем бд; при первом подключении сверка начнется заново
+                self._dirty.clear()
+                self._versions, self._synced = {}, False
+                next_sweep = loop.time() + self.sweep_interval
+                continue
+            try:
+                if loop.time() >= next_sweep:
+                    await self._sweep()
+                    next_sweep = loop.time() + self.sweep_interval
+                dirty, self._dirty = self._dirty, set()
+                for poll_id in sorted(dirty):
+                    poll = await adb.get_poll(poll_id)
+                    if poll is None:
+                        continue
+                    if poll["status"] == "resolved":
+                        self._versions.pop(poll_id, None)
+                    else:
+                        self._versions[poll_id] = poll["version"]
+                    self._publish(poll_delta(poll))
+            except Exception as e:
+                print(f"❌ Ошибка в рассылке изменений опросов: {e}")
+                next_sweep = loop.time() + self.sweep_interval
+
+
+# Общий хаб процесса: в него сообщают и API, и обработчики бота
+hub = PollEventHub(sweep_interval=POLL_EVENTS_SWEEP_INTERVAL)
@@ -0,0 +1,84 @@
+"""Отрисовка карточки опроса для Telegram.
+
+Готовый текст кэшируется по (poll_id, version): версия опроса увеличивается
+в той же транзакции, что и ставка, закрытие приема ставок или разрешение
+опроса, поэтому повторная отрисовка неизменившегося опроса стоит одного
+чтения версии по первичному ключу.
+"""
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Tuple
+
+import db
+
+MOSCOW_TZ = timezone(timedelta(hours=3))
+RENDER_CACHE_SIZE = 256
+
+_cache: OrderedDict[int, Tuple[int, Dict[str, Any], str]] = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def build_poll_text(poll: Dict[str, Any], bets: List[Dict[str, Any]]) -> str:
+    if poll['status'] == 'accepting_bets':
+        status = "🟢 СТАВКИ ПРИНИМАЮТСЯ"
+    elif poll['status'] == 'voting_closed':
+        status = "🔴 СТАВКИ ЗАКРЫТЫ"
+    else:
+        status = "🏁 ЗАВЕРШЕН"
+
+    # Ставки раскладываются по вариантам за один проход, с сохранением порядка
+    bets_by_option: Dict[int, List[Dict[str, Any]]] = {}
+    for bet in bets:
+        bets_by_option.setdefault(bet['option_id'], []).append(bet)
+
+    lines = [
+        f"📊 <b>Опрос #{poll['id']}</b> | {status}\n\n",
+        f"<b>{poll['question']}</b>\n\n",
+        f"💰 Общий банк: {poll['total_pool']} монет\n\n",
+        "<b>Варианты и ставки:</b>\n",
+    ]
+    for i, opt in enumerate(poll['options'], 1):
+        lines.append(f"  {i}. {opt['option_text']} ({opt['total_bet']} монет)\n")
+        for bettor in bets_by_option.get(opt['id'], ()):
+            lines.append(f"      <i>└ {bettor['username']}: {bettor['amount']} монет</i>\n")
+
+    if poll['status'] == 'accepting_bets' and poll.get('closes_at'):
+        msk_closes_at = datetime.fromisoformat(poll['closes_at']).astimezone(MOSCOW_TZ)
+        lines.append(f"\n<i>Ставки закроются в {msk_closes_at.strftime('%H:%M')} по МСК</i>")
+
+    return "".join(lines)
+
+
+def poll_card(poll_id: int) -> Tuple[Dict[str, Any] | None, str | None]:
+    """Возвращает (опрос, текст карточки); при неизменной версии опроса берет их из кэша."""
+    version = db.get_poll_version(poll_id)
+    if version is None:
+        invalidate(poll_id)
+        return None, None
+    with _cache_lock:
+        cached = _cache.get(poll_id)
+        if cached and cached[0] == version:
+            _cache.move_to_end(poll_id)
+            return cached[1], cached[2]
+
+    loaded = db.get_poll_with_bets(poll_id)
+    if not loaded:
+        return None, None
+    poll, bets = loaded
+    text = build_poll_text(poll, bets)
+    with _cache_lock:
+        _cache[poll_id] = (poll['version'], poll, text)
+        _cache.move_to_end(poll_id)
+        while len(_cache) > RENDER_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return poll, text
+
+
+def invalidate(poll_id: int | None = None):
+    """Сбрасывает кэш одного опроса или целиком (poll_id=None), например после замены файла бд."""
+    with _cache_lock:
+        if poll_id is None:
+            _cache.clear()
+        else:
+            _cache.pop(poll_id, None)
@@ -0,0 +1,99 @@
+"""Планировщик фоновых задач.
+
+Задачи хранятся в куче по времени следующего запуска, и цикл спит ровно до
+ближайшего срока. Новую задачу можно добавить в любой момент: цикл будет
+разбужен и пересчитает время сна, поэтому, например, закрытие опроса
+срабатывает точно в его closes_at, а не при следующем обходе по таймеру.
+"""
+import asyncio
+import heapq
+import itertools
+import time
+import traceback
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+import metrics
+
+
+@dataclass(order=True)
+class Job:
+    run_at: float
+    seq: int
+    name: str = field(compare=False)
+    func: Callable[[], Awaitable[None]] = field(compare=False)
+    # Для повторяющихся задач: по времени текущего запуска возвращает время следующего
+    next_run: Callable[[float], float] | None = field(default=None, compare=False)
+
+
+class Scheduler:
+    def __init__(self):
+        self._heap: list[Job] = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._running: set[asyncio.Task] = set()
+        # Задачи ставятся только в работающий планировщик: в остальных процессах их некому выполнить
+        self.running = False
+
+    def _push(self, job: Job):
+        heapq.heappush(self._heap, job)
+        self._wakeup.set()
+
+    def call_at(self, run_at: float, name: str, func: Callable[[], Awaitable[None]]):
+        """Однократный запуск в момент run_at (секунды эпохи, как time.time())."""
+        self._push(Job(run_at, next(self._seq), name, func))
+
+    def every(self, interval: float, name: str, func: Callable[[], Awaitable[None]], first_delay: float | None = None):
+        first_run = time.time() + (interval if first_delay is None else first_delay)
+        self._push(Job(first_run, next(self._seq), name, func, lambda last_run: last_run + interval))
+
+    def schedule(self, name: str, func: Callable[[], Awaitable[None]], next_run: Callable[[float], float], first_run: float | None = None):
+        """Повторяющаяся задача с произвольным расписанием, например ежедневно в заданный час."""
+        now = time.time()
+        self._push(Job(next_run(now) if first_run is None else first_run, next(self._seq), name, func, next_run))
+
+    def has_job_before(self, name: str, run_at: float) -> bool:
+        return any(job.name == name and job.run_at <= run_at for job in self._heap)
+
+    async def _execute(self, job: Job):
+        try:
+            await job.func()
+        except Exception as e:
+            print(f"❌ Ошибка в задаче планировщика {job.name}: {e}")
+            traceback.print_exc()
+
+    async def run(self):
+        print("--- Планировщик запущен ---")
+        self.running = True
+        try:
+            await self._loop()
+        finally:
+            # Остановленный планировщик не выполняет ничего: следующий лидер поставит задачи заново
+            self.running = False
+            self._heap.clear()
+            for task in list(self._running):
+                task.cancel()
+            await asyncio.gather(*self._running, return_exceptions=True)
+
+    async def _loop(self):
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = self._heap[0].run_at - time.time()
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            job = heapq.heappop(self._heap)
+            metrics.SCHEDULER_LAG.observe(max(0.0, time.time() - job.run_at), job.name)
+            if job.next_run is not None:
+                self._push(Job(max(job.next_run(job.run_at), time.time()), next(self._seq), job.name, job.func, job.next_run))
+            # Каждая задача выполняется отдельно, чтобы долгий бэкап не задерживал закрытие опросов
+            task = asyncio.create_task(self._execute(job))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
@@ -0,0 +1,16 @@
+import pytest
+
+import db
+
+
+@pytest.fixture
+def migrated_db(tmp_path, monkeypatch):
+    """Пустая бд со всеми миграциями во временном каталоге; кэши процесса сброшены."""
+    monkeypatch.setattr(db, "DB_PATH", tmp_path / "test.db")
+    monkeypatch.delenv("RECREATE_DB_ON_STARTUP", raising=False)
+    db.close_pool()
+    db.LEADERBOARD.invalidate()
+    db.CHEST_TABLE.invalidate()
+    db.init_db()
+    yield
+    db.close_pool()
@@ -0,0 +1,118 @@
+"""Выборка наград методом псевдонимов и пакетное открытие сундуков."""
+import asyncio
+import random
+from collections import Counter
+
+import pytest
+
+import adb
+import db
+import ledger
+from chest_rewards import AliasSampler
+
+WEIGHTS = [65, 25, 8, 2]
+VALUES = [20, 50, 100, 300]
+
+
+def _table_probabilities(sampler: AliasSampler) -> dict:
+    """Точные вероятности наград, заложенные в таблицы prob/alias."""
+    n = len(sampler.values)
+    result = Counter()
+    for i in range(n):
+        result[sampler.values[i]] += sampler._prob[i] / n
+        result[sampler.values[sampler._alias[i]]] += (1 - sampler._prob[i]) / n
+    return result
+
+
+@pytest.mark.parametrize("weights", [WEIGHTS, [1, 1, 1, 1], [0, 3, 0, 1], [1000, 1, 1, 1]])
+def test_alias_table_matches_weights(weights):
+    sampler = AliasSampler(VALUES, weights)
+    total = sum(weights)
+    probabilities = _table_probabilities(sampler)
+    for value, weight in zip(VALUES, weights):
+        assert probabilities[value] == pytest.approx(weight / total, abs=1e-12)
+
+
+def test_seeded_sampling_follows_weights():
+    sampler = AliasSampler(VALUES, WEIGHTS)
+    draws = Counter(sampler.sample_many(200_000, random.Random(7)))
+    for value, weight in zip(VALUES, WEIGHTS):
+        assert draws[value] / 200_000 == pytest.approx(weight / 100, abs=0.005)
+    assert sampler.sample_many(5, random.Random(7)) == sampler.sample_many(5, random.Random(7))
+
+
+@pytest.mark.parametrize("values, weights", [([], []), ([1, 2], [1]), ([1, 2], [0, 0]), ([1, 2], [-1, 2])])
+def test_invalid_definitions_are_rejected(values, weights):
+    with pytest.raises(ValueError):
+        AliasSampler(values, weights)
+
+
+@pytest.fixture
+def player(migrated_db):
+    db.upsert_user(1, "alice")
+    db.add_balance(1, 10_000)
+    return 1
+
+
+@pytest.mark.parametrize("count", [0, -1, db.CHEST_MAX_BULK + 1])
+def test_bulk_count_outside_limits_is_rejected(player, count):
+    result = db.open_chest(player, 1, count)
+    assert result == {"ok": False, "error": f"Можно открыть от 1 до {db.CHEST_MAX_BULK} сундуков за раз"}
+    assert db.get_user(player)["balance"] == 11_000
+
+
+def test_bulk_open_updates_balance_once_and_logs_net_ledger(player):
+    with db.connection() as conn:
+        conn.execute("CREATE TABLE balance_updates (n INTEGER)")
+        conn.execute("CREATE TRIGGER count_balance_updates AFTER UPDATE OF balance ON users BEGIN INSERT INTO balance_updates VALUES (1); END")
+
+    result = db.open_chest(player, 1, db.CHEST_MAX_BULK)
+
+    assert result["ok"]
+    assert len(result["rewards"]) == db.CHEST_MAX_BULK
+    assert set(result["rewards"]) <= set(VALUES)
+    assert result["spent"] == 50 * db.CHEST_MAX_BULK
+    assert result["reward"] == sum(result["rewards"])
+    assert db.get_user(player)["balance"] == 11_000 - result["spent"] + result["reward"]
+    with db.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM balance_updates").fetchone()[0] == 1
+        rows = [tuple(row) for row in conn.execute("SELECT amount, type, chest_id FROM ledger WHERE type IN (?, ?) ORDER BY id", (ledger.CHEST_BUY, ledger.CHEST_REWARD))]
+    assert rows == [(-result["spent"], ledger.CHEST_BUY, 1), (result["reward"], ledger.CHEST_REWARD, 1)]
+
+
+def test_bulk_open_without_enough_balance_changes_nothing(migrated_db):
+    db.upsert_user(2, "bob")
+    result = db.open_chest(2, 3, 3)
+    assert result == {"ok": False, "error": "User not found or insufficient balance"}
+    assert db.open_chest(3, 1) == {"ok": False, "error": db.USER_NOT_FOUND}
+    assert db.get_user(2)["balance"] == 1000
+    with db.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM ledger").fetchone()[0] == 0
+
+
+def _open_user_chest(telegram_id: int):
+    async def scenario():
+        try:
+            return await adb.open_user_chest(telegram_id, 1)
+        finally:
+            adb.writes.stop()
+    return asyncio.run(scenario())
+
+
+def test_user_deleted_elsewhere_is_recreated_and_chest_opened(migrated_db):
+    adb.known_users.invalidate()
+    db.upsert_user(1, "alice")
+    adb.known_users.put(1, "alice")
+    # Пользователя удалили в другом процессе (например, восстановлением из копии), кэш об этом не знает
+    with db.connection() as conn:
+        conn.execute("DELETE FROM users WHERE telegram_id = 1")
+
+    result = _open_user_chest(1)
+    assert result["ok"]
+    assert db.get_user(1)["balance"] == 1000 - result["spent"] + result["reward"]
+
+
+def test_unknown_user_is_not_created_by_chest_opening(migrated_db):
+    adb.known_users.invalidate()
+    assert _open_user_chest(5) == {"ok": False, "error": db.USER_NOT_FOUND}
+    assert db.get_user(5) is None
@@ -0,0 +1,132 @@
+"""Склеивание правок карточек: debounce, min_interval, пропуск повторов и TelegramRetryAfter."""
+import asyncio
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.methods import EditMessageText
+
+from edit_coalescer import EditCoalescer
+
+METHOD = EditMessageText(text="", chat_id=1, message_id=1)
+
+
+class FakeBot:
+    def __init__(self, failures=()):
+        self.edits: list[tuple[float, str]] = []
+        # Исключения для первых вызовов по порядку
+        self.failures = list(failures)
+
+    async def edit_message_text(self, text, chat_id, message_id, reply_markup=None):
+        if self.failures:
+            raise self.failures.pop(0)
+        self.edits.append((asyncio.get_running_loop().time(), text))
+
+
+def retry_after(seconds: float) -> TelegramRetryAfter:
+    error = TelegramRetryAfter(METHOD, "Too Many Requests", 1)
+    error.retry_after = seconds
+    return error
+
+
+def render(text):
+    async def _render():
+        return text, None
+    return _render
+
+
+def _run(scenario):
+    return asyncio.run(scenario())
+
+
+def test_burst_is_sent_once_with_latest_state_after_debounce():
+    async def scenario():
+        bot = FakeBot()
+        coalescer = EditCoalescer(bot, min_interval=0.1, debounce=0.05)
+        started = asyncio.get_running_loop().time()
+        for i in range(5):
+            coalescer.request(1, 10, render(f"ставок: {i}"))
+            await asyncio.sleep(0.005)
+        await asyncio.sleep(0.1)
+        return started, bot.edits
+
+    started, edits = _run(scenario)
+    assert [text for _, text in edits] == ["ставок: 4"]
+    assert edits[0][0] - started >= 0.05
+
+
+def test_edits_of_one_message_respect_min_interval():
+    async def scenario():
+        bot = FakeBot()
+        coalescer = EditCoalescer(bot, min_interval=0.15, debounce=0.01)
+        coalescer.request(1, 10, render("1"))
+        await asyncio.sleep(0.05)
+        coalescer.request(1, 10, render("2"))
+        coalescer.request(1, 11, render("другое сообщение"))
+        await asyncio.sleep(0.25)
+        return bot.edits
+
+    edits = _run(scenario)
+    texts = [text for _, text in edits]
+    assert texts == ["1", "другое сообщение", "2"]
+    first, second = edits[0][0], edits[2][0]
+    assert second - first >= 0.15
+
+
+def test_unchanged_and_empty_renders_are_skipped():
+    async def scenario():
+        bot = FakeBot()
+        coalescer = EditCoalescer(bot, min_interval=0.01, debounce=0.01)
+        coalescer.request(1, 10, render("тот же текст"))
+        await asyncio.sleep(0.05)
+        coalescer.request(1, 10, render("тот же текст"))
+        await asyncio.sleep(0.05)
+        coalescer.request(1, 10, render(None))
+        await asyncio.sleep(0.05)
+        return bot.edits
+
+    assert [text for _, text in _run(scenario)] == ["тот же текст"]
+
+
+def test_retry_after_resends_latest_state_after_the_pause():
+    async def scenario():
+        bot = FakeBot(failures=[retry_after(0.1)])
+        coalescer = EditCoalescer(bot, min_interval=0.01, debounce=0.01)
+        started = asyncio.get_running_loop().time()
+        coalescer.request(1, 10, render("старое"))
+        await asyncio.sleep(0.05)
+        coalescer.request(1, 10, render("новое"))
+        await asyncio.sleep(0.2)
+        return started, bot.edits
+
+    started, edits = _run(scenario)
+    assert [text for _, text in edits] == ["новое"]
+    assert edits[0][0] - started >= 0.1
+
+
+def test_retry_after_gives_up_after_max_retries():
+    async def scenario():
+        bot = FakeBot(failures=[retry_after(0.01) for _ in range(3)])
+        coalescer = EditCoalescer(bot, min_interval=0.01, debounce=0.01, max_retries=2)
+        coalescer.request(1, 10, render("текст"))
+        await asyncio.sleep(0.2)
+        dropped = list(bot.edits)
+        # Следующий запрос снова отправляется: счетчик повторов сброшен
+        coalescer.request(1, 10, render("текст"))
+        await asyncio.sleep(0.1)
+        return dropped, bot.edits
+
+    dropped, edits = _run(scenario)
+    assert dropped == []
+    assert [text for _, text in edits] == ["текст"]
+
+
+def test_not_modified_is_remembered_as_sent():
+    async def scenario():
+        bot = FakeBot(failures=[TelegramBadRequest(METHOD, "Bad Request: message is not modified")])
+        coalescer = EditCoalescer(bot, min_interval=0.01, debounce=0.01)
+        coalescer.request(1, 10, render("текст"))
+        await asyncio.sleep(0.05)
+        coalescer.request(1, 10, render("текст"))
+        await asyncio.sleep(0.05)
+        return bot.edits
+
+    assert _run(scenario) == []
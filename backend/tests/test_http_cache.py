@@ -0,0 +1,86 @@
+"""HTTP-кэш: ETag и 304, устаревание по версии, TTL и LRU."""
+import pytest
+from fastapi.testclient import TestClient
+
+import adb
+import db
+import http_cache
+import main
+
+
+def test_entry_is_dropped_on_version_change_and_ttl(monkeypatch):
+    cache = http_cache.ResponseCache(maxsize=10, ttl=5)
+    now = [100.0]
+    monkeypatch.setattr(http_cache.time, "monotonic", lambda: now[0])
+    cache.put("polls", "1", b"[]")
+    assert cache.get("polls", "1") == b"[]"
+    assert cache.get("polls", "2") is None
+    # Запись другой версии удалена, а не отдана позже
+    assert cache.get("polls", "1") is None
+    cache.put("polls", "2", b"[1]")
+    now[0] += 6
+    assert cache.get("polls", "2") is None
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = http_cache.ResponseCache(maxsize=2, ttl=60)
+    cache.put("a", "1", b"a")
+    cache.put("b", "1", b"b")
+    cache.get("a", "1")
+    cache.put("c", "1", b"c")
+    assert cache.get("b", "1") is None
+    assert cache.get("a", "1") == b"a" and cache.get("c", "1") == b"c"
+
+
+@pytest.mark.parametrize("header, matches", [
+    (None, False),
+    ("", False),
+    ("*", True),
+    ('"other"', False),
+    ('"other", ETAG', True),
+    ("W/ETAG", True),
+])
+def test_if_none_match_forms(header, matches):
+    etag = http_cache.make_etag("polls", "3")
+    header = header.replace("ETAG", etag) if header else header
+    assert http_cache.etag_matches(header, etag) is matches
+
+
+@pytest.fixture
+def client(migrated_db):
+    http_cache.cache.clear()
+    yield TestClient(main.app)
+    adb.writes.stop()
+    http_cache.cache.clear()
+
+
+def test_conditional_get_answers_304_until_a_write_bumps_the_version(client):
+    db.upsert_user(1, "alice")
+    first = client.get("/api/polls")
+    assert first.status_code == 200 and first.json() == []
+    etag = first.headers["etag"]
+    assert first.headers["cache-control"] == "no-cache"
+
+    again = client.get("/api/polls", headers={"If-None-Match": etag})
+    assert again.status_code == 304 and again.content == b""
+    assert again.headers["etag"] == etag
+
+    poll_id = db.create_poll(1, "Вопрос", ["A", "B"])
+    changed = client.get("/api/polls", headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["etag"] != etag
+    assert [poll["id"] for poll in changed.json()] == [poll_id]
+
+
+def test_bet_changes_user_etag(client):
+    db.upsert_user(1, "alice")
+    poll_id = db.create_poll(1, "Вопрос", ["A", "B"])
+    option_id = db.get_poll(poll_id)["options"][0]["id"]
+    me = client.get("/api/me/1")
+    assert me.json()["balance"] == 1000
+
+    assert client.post("/api/bet", json={"telegram_id": 1, "poll_id": poll_id, "option_id": option_id, "amount": 100}).json()["ok"]
+
+    after = client.get("/api/me/1", headers={"If-None-Match": me.headers["etag"]})
+    assert after.status_code == 200
+    assert after.json()["balance"] == 900
@@ -0,0 +1,109 @@
+"""Рейтинг в памяти: порядок, равенства, место игрока и перезагрузка по rating_version."""
+import db
+from leaderboard import Leaderboard
+
+
+def _board(rows, version=1) -> Leaderboard:
+    board = Leaderboard()
+    board.load(rows, version)
+    return board
+
+
+def _ids(board: Leaderboard) -> list:
+    return [telegram_id for _, telegram_id in board.page()]
+
+
+def test_order_by_winrate_then_wins_then_id():
+    board = _board([(1, 1, 1), (2, 2, 2), (3, 3, 0), (4, 0, 0), (5, 2, 2), (6, 1, 0)])
+    # 3 и 6 по 100%, у 3 больше побед; 2 и 5 полностью равны - порядок по telegram_id
+    assert _ids(board) == [3, 6, 2, 5, 1, 4]
+    assert board.page(2, 2) == [(3, 2), (4, 5)]
+    assert board.page(10, 6) == []
+
+
+def test_changes_move_only_changed_players():
+    board = _board([(1, 1, 1), (2, 2, 0), (3, 0, 2)])
+    board.apply_changes(2, [(3, 5, 2), (2, 2, 1)])
+    assert _ids(board) == [3, 2, 1]
+    assert board.version == 2
+    # Новый игрок вставляется на свое место
+    board.apply_changes(3, [(4, 0, 0)])
+    assert _ids(board) == [3, 2, 1, 4]
+    # Изменение, совпадающее с текущим ключом, ничего не переставляет
+    board.apply_changes(4, [(1, 1, 1)])
+    assert _ids(board) == [3, 2, 1, 4]
+    assert len(board) == 4
+
+
+def test_gap_in_versions_marks_board_stale():
+    board = _board([(1, 1, 0)], version=5)
+    board.apply_changes(7, [(1, 0, 1)])
+    assert not board.is_current(5) and not board.is_current(7)
+    # Устаревший рейтинг изменения больше не принимает
+    board.apply_changes(8, [(2, 1, 0)])
+    assert _ids(board) == [1]
+
+
+def test_rank_boundaries():
+    board = _board([(1, 3, 0), (2, 0, 3), (3, 1, 1)])
+    assert board.rank_of(1) == 1
+    assert board.rank_of(2) == 3
+    assert board.rank_of(99) is None
+
+
+def test_user_rank_from_db(migrated_db):
+    assert db.get_user_rank(1) is None
+    for telegram_id in (1, 2, 3):
+        db.upsert_user(telegram_id, f"u{telegram_id}")
+    first = db.get_user_rank(1)
+    assert first["rank"] == 1 and first["total"] == 3
+    assert db.get_user_rank(3)["rank"] == 3
+    assert db.get_user_rank(4) is None
+
+
+def test_close_poll_updates_rating_incrementally(migrated_db):
+    for telegram_id in (1, 2):
+        db.upsert_user(telegram_id, f"u{telegram_id}")
+    poll_id = db.create_poll(1, "Вопрос", ["A", "B"])
+    option_a, option_b = (option["id"] for option in db.get_poll(poll_id)["options"])
+    db.place_bet(1, poll_id, option_b, 10)
+    db.place_bet(2, poll_id, option_a, 10)
+    assert [u["telegram_id"] for u in db.get_rating()] == [1, 2]
+    version = db.LEADERBOARD.version
+
+    assert db.close_poll(1, poll_id, option_a)["ok"]
+
+    assert db.LEADERBOARD.version == version + 1
+    assert [(u["telegram_id"], u["wins"], u["losses"]) for u in db.get_rating()] == [(2, 1, 0), (1, 0, 1)]
+
+
+def test_reload_after_change_in_another_process(migrated_db):
+    for telegram_id in (1, 2):
+        db.upsert_user(telegram_id, f"u{telegram_id}")
+    assert [u["telegram_id"] for u in db.get_rating()] == [1, 2]
+    # Другой процесс записал результаты и увеличил rating_version, этот процесс об изменениях не знает
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute("UPDATE users SET wins = 4 WHERE telegram_id = 2")
+        db._bump_meta(cur, "rating_version")
+        conn.commit()
+
+    assert [u["telegram_id"] for u in db.get_rating()] == [2, 1]
+    assert db.get_user_rank(2)["rank"] == 1
+
+
+def test_bootstrap_rating_comes_from_its_own_snapshot(migrated_db):
+    for telegram_id in (1, 2):
+        db.upsert_user(telegram_id, f"u{telegram_id}")
+    version = db.get_bootstrap(1, sections=("rating",))["versions"]["rating_version"]
+    assert db.LEADERBOARD.is_current(version)
+    # Другой поток уже применил к рейтингу в памяти изменение, которого в снимке еще нет
+    db.LEADERBOARD.apply_changes(version + 1, [(2, 5, 0)])
+    assert db.LEADERBOARD.page_at(version) is None
+
+    bootstrap = db.get_bootstrap(1, sections=("rating",))
+
+    assert [(u["telegram_id"], u["rank"]) for u in bootstrap["rating"]] == [(1, 1), (2, 2)]
+    # Общий рейтинг не откатился к версии снимка
+    assert db.LEADERBOARD.is_current(version + 1)
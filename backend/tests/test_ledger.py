@@ -0,0 +1,105 @@
+"""Журнал движений баланса: страницы истории и сворачивание старых записей в дневные итоги."""
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+import db
+import ledger
+
+DAY = 86400
+
+
+@pytest.fixture(autouse=True)
+def users(migrated_db):
+    db.upsert_user(1, "alice")
+    db.upsert_user(2, "bob")
+
+
+def _insert(rows):
+    """rows: (telegram_id, amount, type, created_at) в порядке вставки."""
+    with db.connection() as conn:
+        conn.execute("BEGIN")
+        conn.executemany("INSERT INTO ledger (telegram_id, amount, type, created_at) VALUES (?, ?, ?, ?)", rows)
+        conn.commit()
+
+
+def _day(ts: int) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%d")
+
+
+def _daily() -> dict:
+    with db.connection() as conn:
+        return {(r["telegram_id"], r["day"], r["type"]): (r["count"], r["total"]) for r in conn.execute("SELECT * FROM ledger_daily")}
+
+
+def _remaining() -> list:
+    with db.connection() as conn:
+        return [row[0] for row in conn.execute("SELECT amount FROM ledger ORDER BY id")]
+
+
+def test_old_entries_are_folded_into_daily_rows_in_chunks(migrated_db):
+    now = int(time.time())
+    day_a, day_b = now - 40 * DAY, now - 35 * DAY
+    _insert([
+        (1, -10, ledger.BET, day_a),
+        (1, -20, ledger.BET, day_a + 60),
+        (1, 50, ledger.BET_WIN, day_a + 120),
+        (2, -5, ledger.BET, day_a + 180),
+        (1, -30, ledger.BET, day_b),
+        (1, -40, ledger.BET, day_b + 60),
+        (1, 7, ledger.ADMIN_ADD, day_b + 120),
+        (1, -1, ledger.BET, now - DAY),
+        (2, -2, ledger.BET, now),
+    ])
+
+    result = db.compact_ledger(retention_days=30, chunk=3)
+
+    assert result == {"ok": True, "compacted": 7}
+    assert _remaining() == [-1, -2]
+    assert _daily() == {
+        (1, _day(day_a), ledger.BET): (2, -30),
+        (1, _day(day_a), ledger.BET_WIN): (1, 50),
+        (2, _day(day_a), ledger.BET): (1, -5),
+        (1, _day(day_b), ledger.BET): (2, -70),
+        (1, _day(day_b), ledger.ADMIN_ADD): (1, 7),
+    }
+
+
+def test_repeated_compaction_adds_to_existing_days(migrated_db):
+    old = int(time.time()) - 40 * DAY
+    _insert([(1, -10, ledger.BET, old)])
+    db.compact_ledger(retention_days=30, chunk=10)
+    _insert([(1, -15, ledger.BET, old + 10)])
+
+    assert db.compact_ledger(retention_days=30, chunk=10)["compacted"] == 1
+    assert _daily() == {(1, _day(old), ledger.BET): (2, -25)}
+    assert db.compact_ledger(retention_days=30, chunk=10)["compacted"] == 0
+
+
+def test_chunk_boundary_exactly_full(migrated_db):
+    old = int(time.time()) - 40 * DAY
+    _insert([(1, -i, ledger.BET, old) for i in range(1, 7)])
+    assert db.compact_ledger(retention_days=30, chunk=3)["compacted"] == 6
+    assert _remaining() == []
+    assert _daily() == {(1, _day(old), ledger.BET): (6, -21)}
+
+
+def test_history_pages_and_daily_totals(migrated_db):
+    now = int(time.time())
+    _insert([(1, -i, ledger.BET, now) for i in range(1, 6)] + [(2, 100, ledger.ADMIN_ADD, now)])
+    _insert([(1, -1, ledger.BET, now - (40 + d) * DAY) for d in range(3)])
+    db.compact_ledger(retention_days=30)
+
+    first = db.get_ledger(1, limit=3)
+    assert [item["amount"] for item in first["items"]] == [-5, -4, -3]
+    second = db.get_ledger(1, limit=3, before_id=first["next_before_id"])
+    assert [item["amount"] for item in second["items"]] == [-2, -1]
+    assert second["next_before_id"] is None
+    assert first["items"][0]["type"] == "bet"
+
+    daily = db.get_ledger_daily(1, limit=2)
+    assert [item["day"] for item in daily["items"]] == [_day(now - 40 * DAY), _day(now - 41 * DAY)]
+    rest = db.get_ledger_daily(1, limit=2, before_day=daily["next_before_day"])
+    assert [item["day"] for item in rest["items"]] == [_day(now - 42 * DAY)]
+    assert rest["next_before_day"] is None
@@ -0,0 +1,57 @@
+"""Сведение метрик воркеров и подсчет ошибок при выборке замеров."""
+import json
+
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+
+import main
+import metrics
+
+
+def test_render_sums_other_processes(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_DIR", str(tmp_path))
+    counter = metrics.Counter("test_merge_total", "тест", ("kind",))
+    histogram = metrics.Histogram("test_merge_seconds", "тест", buckets=(1.0,))
+    try:
+        counter.inc("a", amount=2)
+        histogram.observe(0.5)
+        other = {"test_merge_total": [[["a"], 3], [["b"], 1]], "test_merge_seconds": [[[], [[0, 2], 7.0]]]}
+        (tmp_path / "1-1.json").write_text(json.dumps(other), encoding="utf-8")
+
+        lines = metrics.render().splitlines()
+        assert 'test_merge_total{kind="a"} 5' in lines
+        assert 'test_merge_total{kind="b"} 1' in lines
+        assert 'test_merge_seconds_bucket{le="1.0"} 1' in lines
+        assert 'test_merge_seconds_bucket{le="+Inf"} 3' in lines
+        assert "test_merge_seconds_sum 7.5" in lines
+    finally:
+        metrics._registry.remove(counter)
+        metrics._registry.remove(histogram)
+
+
+def test_flush_writes_own_file_only_once_per_process(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_DIR", str(tmp_path))
+    monkeypatch.setattr(metrics, "_process_file", None)
+    metrics.flush()
+    metrics.flush()
+    files = list(tmp_path.glob("*.json"))
+    assert len(files) == 1
+    # Свой файл не складывается с живыми значениями второй раз
+    assert metrics._other_processes() == {}
+
+
+def test_errors_are_counted_without_sampling(monkeypatch):
+    app = FastAPI()
+    app.middleware("http")(main.record_request_metrics)
+
+    @app.get("/boom")
+    async def boom():
+        raise HTTPException(status_code=503)
+
+    monkeypatch.setattr(metrics, "sampled", lambda: False)
+    before = metrics.HTTP_ERRORS._values.get(("GET", "/boom"), 0)
+    with TestClient(app) as client:
+        for _ in range(3):
+            assert client.get("/boom").status_code == 503
+    assert metrics.HTTP_ERRORS._values[("GET", "/boom")] == before + 3
+    assert not any(labels[1] == "/boom" for labels in metrics.HTTP_LATENCY._values)
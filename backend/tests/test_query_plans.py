@@ -0,0 +1,45 @@
+"""Горячие запросы должны идти по индексам: EXPLAIN QUERY PLAN без полного просмотра таблиц и лишних сортировок.
+
+HOT_QUERIES ссылается на те же строки SQL, что выполняют функции db, поэтому
+изменение запроса в коде сразу проверяется здесь.
+"""
+import db
+
+
+def test_hot_queries_use_indexes(migrated_db):
+    with db.connection() as conn:
+        assert db.find_slow_plans(conn) == []
+
+
+def test_full_scan_is_reported(migrated_db, monkeypatch):
+    monkeypatch.setitem(db.HOT_QUERIES, "by_balance", ("SELECT * FROM users WHERE balance = ?", (0,), 0))
+    with db.connection() as conn:
+        assert [name for name, _ in db.find_slow_plans(conn)] == ["by_balance"]
+
+
+def test_extra_sort_is_reported(migrated_db, monkeypatch):
+    monkeypatch.setitem(db.HOT_QUERIES, "users_by_balance", ("SELECT * FROM users WHERE telegram_id > ? ORDER BY balance", (0,), 0))
+    with db.connection() as conn:
+        assert db.find_slow_plans(conn) == [("users_by_balance", "USE TEMP B-TREE FOR ORDER BY")]
+
+
+def test_open_polls_page_is_read_in_index_order(migrated_db):
+    with db.connection() as conn:
+        plan = [row["detail"] for row in conn.execute(f"EXPLAIN QUERY PLAN {db.LIST_OPEN_POLLS_SQL}", (50, 0))]
+    assert "SCAN polls USING INDEX idx_polls_open_created_at" in plan
+    # Сортируется только страница вместе с вариантами ответов
+    assert plan.count("USE TEMP B-TREE FOR ORDER BY") == 1
+
+
+def test_hot_queries_are_the_ones_executed(migrated_db):
+    executed = []
+    with db.connection() as conn:
+        conn.set_trace_callback(executed.append)
+        try:
+            db._list_polls(conn, True, 10, 0)
+            db._list_polls(conn, False, 10, 0)
+        finally:
+            conn.set_trace_callback(None)
+    # В трассировке параметры уже подставлены
+    expected = [sql.replace("LIMIT ? OFFSET ?", "LIMIT 10 OFFSET 0") for sql in (db.LIST_OPEN_POLLS_SQL, db.LIST_ALL_POLLS_SQL)]
+    assert executed == expected
@@ -0,0 +1,128 @@
+"""Восстановление рабочей бд из копии: проверки копии, переливание через ATTACH и сдвиг счетчиков."""
+import gzip
+import os
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import backup
+import db
+
+
+CHESTS_MIGRATION = next(version for version, _, step in db.MIGRATIONS if step is db._migration_default_chests)
+
+
+@pytest.fixture
+def backup_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(backup, "BACKUP_DIR", str(tmp_path))
+    return tmp_path
+
+
+def _meta() -> dict:
+    with db.connection() as conn:
+        return {row["key"]: row["value"] for row in conn.execute("SELECT key, value FROM meta")}
+
+
+def _poll_versions() -> dict:
+    with db.connection() as conn:
+        return {row["id"]: row["version"] for row in conn.execute("SELECT id, version FROM polls")}
+
+
+def _copy_for_upload(packed, backup_dir):
+    upload = backup.upload_path(packed.name)
+    upload.write_bytes(packed.read_bytes())
+    return upload
+
+
+def test_round_trip_restores_snapshot_and_moves_counters_forward(migrated_db, backup_dir):
+    db.upsert_user(1, "alice")
+    poll_id = db.create_poll(1, "Вопрос", ["A", "B"])
+    option_a = db.get_poll(poll_id)["options"][0]["id"]
+    assert db.place_bet(1, poll_id, option_a, 100)["ok"]
+    packed = backup.create_backup()
+    try:
+        # После снимка бд продолжает меняться: эти изменения восстановление отменит
+        db.upsert_user(2, "bob")
+        assert db.open_chest(1, 1)["ok"]
+        db.create_poll(2, "Лишний", ["X", "Y"])
+        meta_before, versions_before = _meta(), _poll_versions()
+
+        version = backup.restore_backup(_copy_for_upload(packed, backup_dir))
+    finally:
+        backup.remove_backup(packed)
+
+    assert version == db.SCHEMA_VERSION
+    assert db.get_user(2) is None
+    assert db.get_user(1)["balance"] == 900
+    assert list(_poll_versions()) == [poll_id]
+    assert db.get_poll(poll_id)["total_pool"] == 100
+    # Счетчики выше прежних: кэши всех процессов сочтут свои данные устаревшими
+    meta_after = _meta()
+    assert all(meta_after[key] > value for key, value in meta_before.items())
+    assert _poll_versions()[poll_id] > versions_before[poll_id]
+    assert not db.restore_flag_path().exists()
+    # Пул снова выдает соединения, и запись идет как обычно
+    assert db.place_bet(1, poll_id, option_a, 10)["error"] == "Вы уже сделали ставку в этом опросе"
+    db.upsert_user(3, "carol")
+    assert db.get_user(3)["balance"] == 1000
+
+
+def test_older_schema_is_migrated_before_copying(migrated_db, backup_dir, tmp_path):
+    old = tmp_path / "old.db"
+    backup.snapshot(old)
+    with sqlite3.connect(old) as conn:
+        conn.execute("DELETE FROM chests")
+        conn.execute("DELETE FROM schema_version WHERE version >= ?", (CHESTS_MIGRATION,))
+    upload = backup.upload_path("old.db.gz")
+    with open(old, "rb") as raw, gzip.open(upload, "wb") as packed:
+        packed.write(raw.read())
+
+    assert backup.restore_backup(upload) == CHESTS_MIGRATION - 1
+    assert len(db.list_chests()) == 3
+    with db.connection() as conn:
+        assert db.get_schema_version(conn) == db.SCHEMA_VERSION
+
+
+@pytest.mark.parametrize("prepare_copy, message", [
+    (lambda path: path.write_bytes(b"not a database" * 100), "не является базой данных"),
+    (lambda path: sqlite3.connect(path).execute("CREATE TABLE other (x)").connection.commit(), "нет таблиц приложения"),
+])
+def test_bad_copies_are_rejected_without_touching_live_db(migrated_db, backup_dir, prepare_copy, message):
+    db.upsert_user(1, "alice")
+    upload = backup.upload_path("bad.db")
+    prepare_copy(upload)
+    with pytest.raises(ValueError, match=message):
+        backup.restore_backup(upload)
+    assert db.get_user(1)["username"] == "alice"
+    assert not db.restore_flag_path().exists()
+
+
+def test_newer_schema_is_rejected(migrated_db, backup_dir, tmp_path):
+    upload = backup.upload_path("new.db")
+    backup.snapshot(upload)
+    with sqlite3.connect(upload) as conn:
+        conn.execute("INSERT INTO schema_version (version, description) VALUES (?, 'из будущего')", (db.SCHEMA_VERSION + 1,))
+    with pytest.raises(ValueError, match="более новой версией"):
+        backup.restore_backup(upload)
+
+
+def test_writers_wait_for_restore_flag(migrated_db):
+    flag = db.restore_flag_path()
+    flag.touch()
+    threading.Timer(0.3, flag.unlink).start()
+    started = time.monotonic()
+    db.upsert_user(1, "alice")
+    assert time.monotonic() - started >= 0.25
+
+
+def test_abandoned_restore_flag_is_ignored(migrated_db, monkeypatch):
+    monkeypatch.setattr(db, "DB_RESTORE_WAIT", 1)
+    flag = db.restore_flag_path()
+    flag.touch()
+    stale = time.time() - 10
+    os.utime(flag, (stale, stale))
+    started = time.monotonic()
+    db.upsert_user(1, "alice")
+    assert time.monotonic() - started < 0.25
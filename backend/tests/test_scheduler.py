@@ -0,0 +1,111 @@
+"""Планировщик на куче: порядок запусков, повторы, пробуждение и остановка."""
+import asyncio
+import time
+
+from scheduler import Scheduler
+
+
+def _run(scenario):
+    return asyncio.run(scenario())
+
+
+def _recorder(log: list, name: str):
+    async def job():
+        log.append((name, time.time()))
+    return job
+
+
+def test_jobs_run_in_due_order_not_insertion_order():
+    async def scenario():
+        scheduler, log = Scheduler(), []
+        now = time.time()
+        scheduler.call_at(now + 0.09, "c", _recorder(log, "c"))
+        scheduler.call_at(now + 0.03, "a", _recorder(log, "a"))
+        scheduler.call_at(now + 0.06, "b", _recorder(log, "b"))
+        task = asyncio.create_task(scheduler.run())
+        await asyncio.sleep(0.15)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return now, log
+
+    now, log = _run(scenario)
+    assert [name for name, _ in log] == ["a", "b", "c"]
+    assert all(at >= now + delay - 0.005 for (_, at), delay in zip(log, (0.03, 0.06, 0.09)))
+
+
+def test_earlier_job_added_while_sleeping_wakes_the_loop():
+    async def scenario():
+        scheduler, log = Scheduler(), []
+        scheduler.call_at(time.time() + 10, "late", _recorder(log, "late"))
+        task = asyncio.create_task(scheduler.run())
+        await asyncio.sleep(0.02)
+        added = time.time()
+        scheduler.call_at(added + 0.03, "soon", _recorder(log, "soon"))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return added, log
+
+    added, log = _run(scenario)
+    assert [name for name, _ in log] == ["soon"]
+    assert log[0][1] - added < 0.08
+
+
+def test_repeating_job_is_rescheduled_and_survives_errors():
+    async def scenario():
+        scheduler, calls = Scheduler(), []
+
+        async def flaky():
+            calls.append(time.time())
+            if len(calls) == 1:
+                raise RuntimeError("сбой первого запуска")
+
+        scheduler.every(0.03, "flaky", flaky, first_delay=0)
+        task = asyncio.create_task(scheduler.run())
+        await asyncio.sleep(0.115)
+        pending = scheduler.has_job_before("flaky", time.time() + 0.03)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return calls, pending
+
+    calls, pending = _run(scenario)
+    # Первый запуск упал, но задача осталась в расписании; время следующего считается от срока, а не от окончания
+    assert 3 <= len(calls) <= 4
+    assert all(0.02 < b - a < 0.05 for a, b in zip(calls, calls[1:]))
+    assert pending
+
+
+def test_custom_schedule_uses_next_run():
+    async def scenario():
+        scheduler, log = Scheduler(), []
+        scheduler.schedule("stepped", _recorder(log, "stepped"), lambda last: last + 0.05, first_run=time.time() + 0.01)
+        task = asyncio.create_task(scheduler.run())
+        await asyncio.sleep(0.085)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return log
+
+    assert len(_run(scenario)) == 2
+
+
+def test_stopped_scheduler_drops_jobs_and_cancels_running_ones():
+    async def scenario():
+        scheduler, started, finished = Scheduler(), [], []
+
+        async def slow():
+            started.append(1)
+            await asyncio.sleep(10)
+            finished.append(1)
+
+        scheduler.every(0.02, "slow", slow, first_delay=0)
+        task = asyncio.create_task(scheduler.run())
+        await asyncio.sleep(0.01)
+        assert scheduler.running
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return scheduler, started, finished
+
+    scheduler, started, finished = _run(scenario)
+    assert started == [1] and finished == []
+    assert not scheduler.running
+    assert not scheduler.has_job_before("slow", float("inf"))
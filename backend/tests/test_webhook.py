@@ -0,0 +1,67 @@
+"""Эндпоинт webhook: секретный токен и разбор тела запроса."""
+from types import SimpleNamespace
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+import webhook
+
+SECRET = "s3cret"
+
+
+class FakeQueue:
+    running = True
+
+    def __init__(self):
+        self.updates = []
+
+    def submit(self, update) -> bool:
+        self.updates.append(update)
+        return True
+
+
+@pytest.fixture
+def queue(monkeypatch):
+    queue = FakeQueue()
+    monkeypatch.setattr(webhook, "WEBHOOK_SECRET", SECRET)
+    # Загруженный бот подменен: тест проверяет только прием запроса
+    monkeypatch.setattr(main, "bot", SimpleNamespace(update_queue=queue, bot=None))
+    return queue
+
+
+@pytest.fixture
+def client():
+    return TestClient(main.app)
+
+
+def _post(client, body, secret=SECRET):
+    headers = {"Content-Type": "application/json"}
+    if secret is not None:
+        headers[webhook.SECRET_HEADER] = secret
+    return client.post(webhook.WEBHOOK_PATH, content=body, headers=headers)
+
+
+def test_valid_update_is_queued(client, queue):
+    response = _post(client, '{"update_id": 7}')
+    assert response.status_code == 200
+    assert [update.update_id for update in queue.updates] == [7]
+
+
+@pytest.mark.parametrize("secret", [None, "", "wrong"])
+def test_wrong_secret_is_rejected(client, queue, secret):
+    assert _post(client, '{"update_id": 7}', secret=secret).status_code == 403
+    assert queue.updates == []
+
+
+def test_endpoint_is_disabled_without_configured_secret(client, queue, monkeypatch):
+    monkeypatch.setattr(webhook, "WEBHOOK_SECRET", None)
+    assert _post(client, '{"update_id": 7}', secret="").status_code == 404
+    assert not webhook.check_secret(None, None)
+    assert queue.updates == []
+
+
+@pytest.mark.parametrize("body", ["not json", b"\xff\xfe", "[1, 2]", '{"update_id": "x"}'])
+def test_malformed_body_is_bad_request(client, queue, body):
+    assert _post(client, body).status_code == 400
+    assert queue.updates == []
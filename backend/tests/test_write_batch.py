@@ -0,0 +1,160 @@
+"""Групповая запись: SAVEPOINT на намерение, общий буфер журнала и доставка результатов вызывающим."""
+import asyncio
+import sqlite3
+import time
+
+import pytest
+
+import db
+import ledger
+from write_queue import WriteQueue
+
+
+@pytest.fixture
+def poll(migrated_db):
+    for telegram_id in (1, 2, 3):
+        db.upsert_user(telegram_id, f"u{telegram_id}")
+    poll_id = db.create_poll(1, "Кто победит?", ["A", "B"])
+    options = [option["id"] for option in db.get_poll(poll_id)["options"]]
+    return poll_id, options
+
+
+def _balance(telegram_id: int) -> int:
+    return db.get_user(telegram_id)["balance"]
+
+
+def _ledger_rows() -> list:
+    with db.connection() as conn:
+        return [tuple(row) for row in conn.execute("SELECT telegram_id, amount, type FROM ledger ORDER BY id")]
+
+
+def _meta(key: str) -> int:
+    with db.connection() as conn:
+        return db._get_meta(conn, key)
+
+
+def test_rejected_intent_rolls_back_only_itself(poll):
+    poll_id, (option_a, option_b) = poll
+    results = db.apply_writes([
+        ("place_bet", (1, poll_id, option_a, 100)),
+        ("place_bet", (1, poll_id, option_b, 50)),   # повторная ставка
+        ("place_bet", (2, poll_id, option_b, 5000)),  # нет денег
+        ("place_bet", (3, poll_id, option_b, 30)),
+    ])
+
+    assert [r["ok"] for r in results] == [True, False, False, True]
+    assert results[1]["error"] == "Вы уже сделали ставку в этом опросе"
+    assert results[2]["error"] == "Недостаточно средств"
+    assert (_balance(1), _balance(2), _balance(3)) == (900, 1000, 970)
+    assert _ledger_rows() == [(1, -100, ledger.BET), (3, -30, ledger.BET)]
+    stored = db.get_poll(poll_id)
+    assert stored["total_pool"] == 130
+    assert {o["id"]: o["total_bet"] for o in stored["options"]} == {option_a: 100, option_b: 30}
+
+
+def test_failing_intent_discards_its_writes_and_ledger_rows(poll, monkeypatch):
+    poll_id, (option_a, _) = poll
+
+    def broken(cur, entries, telegram_id):
+        cur.execute("UPDATE users SET balance = 0 WHERE telegram_id = ?", (telegram_id,))
+        entries.add(telegram_id, -1000, ledger.ADMIN_ADD)
+        raise RuntimeError("сбой посреди намерения")
+
+    monkeypatch.setitem(db.WRITE_INTENTS, "broken", (broken, ("users_version",)))
+    results = db.apply_writes([
+        ("place_bet", (1, poll_id, option_a, 10)),
+        ("broken", (2,)),
+        ("open_chest", (3, 1, 2)),
+    ])
+
+    assert [r["ok"] for r in results] == [True, False, True]
+    assert results[1]["error"] == "сбой посреди намерения"
+    assert _balance(2) == 1000
+    rows = _ledger_rows()
+    assert [row[0] for row in rows] == [1, 3, 3]
+    assert [row[2] for row in rows] == [ledger.BET, ledger.CHEST_BUY, ledger.CHEST_REWARD]
+    assert _balance(3) == 1000 + rows[2][1] + rows[1][1]
+
+
+def test_counters_bumped_once_and_only_for_accepted_intents(poll):
+    poll_id, (option_a, _) = poll
+    polls_before, users_before = _meta("polls_version"), _meta("users_version")
+
+    db.apply_writes([("place_bet", (2, poll_id, option_a, 10)), ("place_bet", (3, poll_id, option_a, 10))])
+    assert (_meta("polls_version"), _meta("users_version")) == (polls_before + 1, users_before + 1)
+
+    db.apply_writes([("place_bet", (2, poll_id, option_a, 10)), ("open_chest", (3, 999, 1))])
+    assert (_meta("polls_version"), _meta("users_version")) == (polls_before + 1, users_before + 1)
+
+
+def test_queue_returns_each_result_to_its_caller():
+    batches = []
+
+    async def apply(intents):
+        batches.append(list(intents))
+        return [{"ok": args[0] % 2 == 0, "echo": args} for _, args in intents]
+
+    async def scenario():
+        queue = WriteQueue(apply, batch_size=4, linger=0.01)
+        try:
+            return await asyncio.gather(*(queue.submit("place_bet", (i,)) for i in range(10)))
+        finally:
+            queue.stop()
+
+    results = asyncio.run(scenario())
+    assert [r["echo"] for r in results] == [(i,) for i in range(10)]
+    assert [r["ok"] for r in results] == [i % 2 == 0 for i in range(10)]
+    assert [len(batch) for batch in batches] == [4, 4, 2]
+
+
+def test_queue_reports_failed_batch_to_every_caller():
+    async def apply(intents):
+        raise RuntimeError("database is locked")
+
+    async def scenario():
+        queue = WriteQueue(apply, batch_size=8, linger=0.01)
+        try:
+            return await asyncio.gather(*(queue.submit("open_chest", (i,)) for i in range(3)))
+        finally:
+            queue.stop()
+
+    assert asyncio.run(scenario()) == [{"ok": False, "error": "database is locked"}] * 3
+
+
+def test_queue_on_real_db_keeps_callers_apart(poll):
+    import adb
+    poll_id, (option_a, option_b) = poll
+
+    async def scenario():
+        try:
+            return await asyncio.gather(
+                adb.place_bet(1, poll_id, option_a, 10),
+                adb.place_bet(1, poll_id, option_b, 20),
+                adb.place_bet(2, poll_id, option_b, 2000),
+                adb.open_chest(3, 1),
+            )
+        finally:
+            adb.writes.stop()
+
+    bet, duplicate, too_big, chest = asyncio.run(scenario())
+    assert bet == {"ok": True}
+    assert duplicate["error"] == "Вы уже сделали ставку в этом опросе"
+    assert too_big["error"] == "Недостаточно средств"
+    assert chest["ok"] and chest["spent"] == 50
+    assert _balance(1) == 990
+
+
+def test_busy_writer_waits_no_longer_than_busy_timeout(migrated_db, monkeypatch):
+    monkeypatch.setattr(db, "DB_BUSY_TIMEOUT", 0.3)
+    # Новые соединения берут busy timeout из настройки
+    db.close_pool()
+    holder = sqlite3.connect(db.DB_PATH, isolation_level=None)
+    holder.execute("BEGIN IMMEDIATE")
+    started = time.monotonic()
+    try:
+        with pytest.raises(sqlite3.OperationalError, match="locked"):
+            db.upsert_user(1, "alice")
+    finally:
+        holder.rollback()
+        holder.close()
+    assert time.monotonic() - started < 0.6
@@ -0,0 +1,56 @@
+"""Кэш известных процессу пользователей.
+
+Каждое нажатие кнопки ставки и каждое открытие Mini App начинается с
+проверки, что пользователь есть в бд и его имя не изменилось. Здесь
+хранится только это: telegram_id -> username (LRU с TTL). Балансы в кэш не
+попадают, поэтому записи, меняющие баланс, его не затрагивают, а свежие
+данные пользователя всегда читаются из бд.
+
+Если пользователь с тем же именем уже известен, обращение к бд пропускается.
+Удаление пользователя другим процессом (например, восстановление бд из
+копии) процесс замечает по ошибке записи: ставка сбрасывает запись кэша,
+пересоздает пользователя и повторяется (adb.place_user_bet). Чтения
+(auth_user) при отсутствии пользователя сразу создают его заново.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", "600"))
+
+
+class UserCache:
+    def __init__(self, maxsize: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict[int, tuple[str, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def matches(self, telegram_id: int, username: str | None) -> bool:
+        """Пользователь известен и его имя совпадает (username=None - имя не проверяется)."""
+        with self._lock:
+            entry = self._entries.get(telegram_id)
+            if entry is None:
+                return False
+            cached_username, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[telegram_id]
+                return False
+            self._entries.move_to_end(telegram_id)
+            return username is None or cached_username == username
+
+    def put(self, telegram_id: int, username: str):
+        with self._lock:
+            self._entries[telegram_id] = (username, time.monotonic() + self.ttl)
+            self._entries.move_to_end(telegram_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, telegram_id: int | None = None):
+        with self._lock:
+            if telegram_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(telegram_id, None)
@@ -0,0 +1,78 @@
+"""Прием обновлений Telegram через webhook.
+
+Эндпоинт в main.py только проверяет секретный токен и кладет обновление в
+ограниченную очередь, а обработку выполняют несколько фоновых обработчиков.
+Поэтому Telegram быстро получает ответ 200, а при переполненной очереди
+получает 503 и повторит доставку позже.
+"""
+import asyncio
+import hmac
+import os
+from typing import TYPE_CHECKING
+
+# aiogram нужен только обработчикам: main.py импортирует этот модуль, не дожидаясь загрузки бота
+if TYPE_CHECKING:
+    from aiogram import Bot, Dispatcher
+    from aiogram.types import Update
+
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram/webhook")
+# Проверяется до загрузки бота, чтобы чужие запросы не запускали его импорт
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def check_secret(expected: str | None, received: str | None) -> bool:
+    """Без настроенного секрета не принимается ни один запрос."""
+    if not expected:
+        return False
+    return received is not None and hmac.compare_digest(expected, received)
+
+
+class UpdateQueue:
+    def __init__(self, dp: "Dispatcher", bot: "Bot", maxsize: int = 1000, workers: int = 8):
+        self.dp = dp
+        self.bot = bot
+        self.maxsize = maxsize
+        self.workers = workers
+        self._queue: asyncio.Queue | None = None
+        self._tasks: list[asyncio.Task] = []
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    def start(self):
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, update: "Update") -> bool:
+        """Ставит обновление в очередь; False, если очередь заполнена или не запущена."""
+        if self._queue is None:
+            return False
+        try:
+            self._queue.put_nowait(update)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def join(self):
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def _worker(self):
+        while True:
+            update = await self._queue.get()
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                print(f"Ошибка при обработке обновления {update.update_id}: {e}")
+            finally:
+                self._queue.task_done()
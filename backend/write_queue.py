@@ -0,0 +1,81 @@
+"""Групповая фиксация записей (group commit).
+
+Ставки и открытия сундуков не открывают каждая свою транзакцию, а ставятся
+в очередь намерений. Один писатель на процесс забирает из очереди до
+batch_size намерений (подождав не дольше linger после первого) и применяет
+их одной транзакцией через db.apply_writes. Каждый вызывающий получает свой
+результат через future. Пока пачка применяется, следующие намерения
+копятся в очереди, поэтому при всплеске нажатий на кнопки ставок за одну
+блокировку и одну синхронизацию с диском проходит сразу много записей.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List
+
+import metrics
+
+ApplyBatch = Callable[[List[tuple]], Awaitable[List[Dict[str, Any]]]]
+
+
+class WriteQueue:
+    def __init__(self, apply: ApplyBatch, batch_size: int = 32, linger: float = 0.002):
+        self.apply = apply
+        self.batch_size = max(1, batch_size)
+        self.linger = linger
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+
+    def _ensure_writer(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._queue = asyncio.Queue()
+            self._task = loop.create_task(self._run())
+
+    async def submit(self, name: str, args: tuple) -> Dict[str, Any]:
+        """Ставит намерение в очередь и ждет результат его применения."""
+        self._ensure_writer()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((name, args, future))
+        return await future
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _collect(self) -> list:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.linger
+        while len(batch) < self.batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        batch = []
+        try:
+            while True:
+                batch = await self._collect()
+                metrics.WRITE_BATCH_SIZE.observe(len(batch))
+                try:
+                    results = await self.apply([(name, args) for name, args, _ in batch])
+                except Exception as e:
+                    results = [{"ok": False, "error": str(e)} for _ in batch]
+                for (_, _, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+                batch = []
+        finally:
+            # Писатель остановлен: ожидающие не должны висеть вечно
+            pending = batch + [self._queue.get_nowait() for _ in range(self._queue.qsize())]
+            for _, _, future in pending:
+                if not future.done():
+                    future.set_result({"ok": False, "error": "Запись в базу данных остановлена"})
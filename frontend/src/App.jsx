@@ -1,10 +1,12 @@
-import React, { useEffect, useState } from "react";
+import React, { useEffect, useRef, useState } from "react";
 import Polls from "./tabs/Polls";
 import Chests from "./tabs/Chests";
 import Rating from "./tabs/Rating";
 
 // URL вашего бэкенда
 const API_URL = "https://tgapp-4ugf.onrender.com"; 
+// Данные вкладок из /api/bootstrap показываются, только если вкладку открыли вскоре после входа
+const PRELOAD_MAX_AGE = 60 * 1000;
 
 function TabButton({ children, active, onClick }) {
   return (
@@ -21,23 +23,38 @@ export default function App() {
   const [tab, setTab] = useState("polls");
   const [user, setUser] = useState(null);
   const [loadingUser, setLoadingUser] = useState(true);
+  // Секции /api/bootstrap, которые вкладки еще не забрали
+  const preloaded = useRef({ at: 0, sections: {} });
+
+  // Каждая вкладка забирает свою секцию один раз; null - загрузить самой
+  const takePreloaded = (section) => {
+    const { at, sections } = preloaded.current;
+    const data = sections[section];
+    delete sections[section];
+    return data && Date.now() - at < PRELOAD_MAX_AGE ? data : null;
+  };
 
   useEffect(() => {
+    // Пользователь, опросы, сундуки и рейтинг одним запросом вместо пяти
     const initUser = async (telegram_id, username) => {
       try {
-        const res = await fetch(`${API_URL}/api/auth`, {
+        const res = await fetch(`${API_URL}/api/bootstrap`, {
           method: "POST",
           headers: { "Content-Type": "application/json" },
           body: JSON.stringify({ telegram_id, username }),
         });
         const data = await res.json();
         if (data?.ok && data.user) {
+          preloaded.current = {
+            at: Date.now(),
+            sections: { polls: data.polls, chests: data.chests, rating: data.rating },
+          };
           setUser(data.user);
         } else {
           console.warn("⚠️ Сервер вернул ошибку:", data);
         }
       } catch (e) {
-        console.error("🔥 Ошибка запроса api/auth:", e);
+        console.error("🔥 Ошибка запроса api/bootstrap:", e);
       } finally {
         setLoadingUser(false);
       }
@@ -100,15 +117,16 @@ export default function App() {
       </div>
 
       <div className="content">
-        {tab === "polls" && <Polls user={user} apiRoot={API_URL} />}
+        {tab === "polls" && <Polls user={user} apiRoot={API_URL} takePreloaded={takePreloaded} />}
         {tab === "chests" && (
           <Chests 
             user={user} 
             apiRoot={API_URL} 
             onBalanceChange={refreshUser} // Передаем функцию как пропс
+            takePreloaded={takePreloaded}
           />
         )}
-        {tab === "rating" && <Rating apiRoot={API_URL} />}
+        {tab === "rating" && <Rating apiRoot={API_URL} takePreloaded={takePreloaded} />}
       </div>
     </div>
   );
@@ -3,7 +3,7 @@
 import React, { useEffect, useState, useRef } from "react";
 import Fireworks from "./Fireworks";
 
-export default function Chests({ user, apiRoot, onBalanceChange }) {
+export default function Chests({ user, apiRoot, onBalanceChange, takePreloaded }) {
   const [chests, setChests] = useState([]);
   const [msg, setMsg] = useState("");
   const [animationState, setAnimationState] = useState({ id: null, reward: null, spinning: false });
@@ -25,7 +25,9 @@ export default function Chests({ user, apiRoot, onBalanceChange }) {
   };
 
   useEffect(() => {
-    fetchChests();
+    const preloaded = takePreloaded?.("chests");
+    if (preloaded) setChests(preloaded);
+    else fetchChests();
     return () => {
       if (animationTimeoutRef.current) clearTimeout(animationTimeoutRef.current);
     };
@@ -1,12 +1,16 @@
 // frontend/src/tabs/Polls.jsx (Новая, упрощенная версия)
 
-import React, { useEffect, useState } from "react";
+import React, { useEffect, useRef, useState } from "react";
 
-export default function Polls({ user, apiRoot }) {
+export default function Polls({ user, apiRoot, takePreloaded }) {
   const [polls, setPolls] = useState([]);
   // Состояние для хранения сумм ставок пользователя для каждого опроса
   const [betAmounts, setBetAmounts] = useState({});
   const [error, setError] = useState("");
+  // Пока открыт поток изменений, суммы обновляются сами и список после ставки не перезагружается
+  const streamOpen = useRef(false);
+  const pollsRef = useRef(polls);
+  pollsRef.current = polls;
 
   const fetchPolls = async () => {
     try {
@@ -19,8 +23,59 @@ export default function Polls({ user, apiRoot }) {
     }
   };
 
+  // Применяет дельту опроса из /api/polls/stream: новые суммы по вариантам и статус
+  const applyDelta = (delta) => {
+    if (delta.type === "resync") {
+      fetchPolls();
+      return;
+    }
+    if (!pollsRef.current.some(p => p.id === delta.id)) {
+      // Новый опрос, которого еще нет в списке, загружаем целиком
+      if (delta.status !== "resolved") fetchPolls();
+      return;
+    }
+    setPolls(prev => {
+      if (delta.status === "resolved") return prev.filter(p => p.id !== delta.id);
+      return prev.map(p => {
+        if (p.id !== delta.id || (p.version ?? -1) > delta.version) return p;
+        const totals = Object.fromEntries(delta.options.map(o => [o.id, o]));
+        return {
+          ...p,
+          version: delta.version,
+          status: delta.status,
+          total_pool: delta.total_pool,
+          options: (p.options || []).map(opt => totals[opt.id] ? { ...opt, ...totals[opt.id] } : opt)
+        };
+      });
+    });
+  };
+
   useEffect(() => {
-    fetchPolls();
+    const preloaded = takePreloaded?.("polls");
+    if (preloaded) setPolls(preloaded);
+    else fetchPolls();
+    if (typeof EventSource === "undefined") return;
+    const source = new EventSource(`${apiRoot}/api/polls/stream`);
+    source.onopen = () => {
+      // После переподключения могли пропустить изменения
+      if (streamOpen.current === null) fetchPolls();
+      streamOpen.current = true;
+    };
+    source.onerror = () => {
+      // null - поток был открыт и оборвался; EventSource переподключится сам
+      if (streamOpen.current) streamOpen.current = null;
+    };
+    source.onmessage = (e) => {
+      try {
+        applyDelta(JSON.parse(e.data));
+      } catch (err) {
+        console.error(err);
+      }
+    };
+    return () => {
+      source.close();
+      streamOpen.current = false;
+    };
   }, []);
 
   // Функция для отслеживания изменения суммы ставки в поле ввода
@@ -57,8 +112,8 @@ export default function Polls({ user, apiRoot }) {
         const jd = await res.json();
         throw new Error(jd.detail || "Ошибка ставки");
       }
-      // Обновляем список опросов, чтобы увидеть новую общую сумму
-      fetchPolls();
+      // Без потока изменений обновляем список сами, чтобы увидеть новую общую сумму
+      if (!streamOpen.current) fetchPolls();
     } catch (e) {
       setError(e.message);
     }
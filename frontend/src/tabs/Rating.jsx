@@ -1,6 +1,6 @@
 import React, { useEffect, useState } from "react";
 
-export default function Rating({ apiRoot }) {
+export default function Rating({ apiRoot, takePreloaded }) {
   const [list, setList] = useState([]);
 
   const fetchRating = async () => {
@@ -14,7 +14,9 @@ export default function Rating({ apiRoot }) {
   };
 
   useEffect(() => {
-    fetchRating();
+    const preloaded = takePreloaded?.("rating");
+    if (preloaded) setList(preloaded);
+    else fetchRating();
   }, []);
 
   return (
@@ -34,7 +36,7 @@ export default function Rating({ apiRoot }) {
         <tbody>
           {list.map((u, i) => (
             <tr key={u.telegram_id}>
-              <td>{i + 1}</td>
+              <td>{u.rank ?? i + 1}</td>
               <td>{u.username || u.telegram_id}</td>
               <td>{u.balance}</td>
               <td>{u.wins}</td>